@@ -1,23 +1,194 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db.models import Max, Min, Q, QuerySet
+from django.utils.functional import cached_property
+
+import datetime
 
 # Register your models here.
 
-from .models import User, Specialty, Appointment
+from .models import (
+    User, Specialty, Appointment, AppointmentArchive, OutboxEmail, Schedule, WorkingHours, ScheduleException, Holiday)
+from .db import estimated_count
+from .export import export_response
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Paginator of the changelists of large tables: without filters, the number
+    of rows is estimated from the database statistics instead of counted
+    '''
+    # below this estimate, counting is cheap
+    EXACT_COUNT_BELOW = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.EXACT_COUNT_BELOW:
+                return estimate
+        return super().count
+
+
+class DateIndexQuerySet(QuerySet):
+    '''
+    Queryset of the changelists with a date hierarchy on an indexed date 
+    field. The hierarchy lists the years and months with data, and the first
+    and last dates, which Django reads by truncating the date of every row:
+    these read a few entries of the index instead
+    '''
+    def aggregate(self, *args, **kwargs):
+        # SQLite reads the MIN or MAX of an indexed field from one end of the
+        #   index only when it is the single aggregate of the query
+        if not args and len(kwargs) > 1 and all(
+                isinstance(aggregate, (Min, Max)) for aggregate in kwargs.values()):
+            result = {}
+            for name, aggregate in kwargs.items():
+                result.update(super().aggregate(**{name: aggregate}))
+            return result
+        return super().aggregate(*args, **kwargs)
+
+    def dates(self, field_name, kind, order='ASC'):
+        if kind not in ('year', 'month'):
+            return super().dates(field_name, kind, order)
+        # jump from the first date of each year or month to the first date
+        #   of the next ones
+        dates = []
+        date = self.aggregate(first=Min(field_name))['first']
+        while date is not None:
+            if kind == 'year':
+                date = date.replace(month=1, day=1)
+                after = date.replace(year=date.year + 1)
+            else:
+                date = date.replace(day=1)
+                after = (date + datetime.timedelta(days=31)).replace(day=1)
+            dates.append(date)
+            date = self.filter(**{f'{field_name}__gte': after}).aggregate(first=Min(field_name))['first']
+        return dates if order == 'ASC' else dates[::-1]
+
+
+def prefix_range(field, prefix):
+    '''
+    Values of field starting with prefix as a range of its index, the 
+    default LIKE '%word%' search of the admin reads every row
+    '''
+    after = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': after})
 
 
 class UserAdmin(admin.ModelAdmin):
     list_display = ('username', 'is_doctor', 'specialty')
+    list_select_related = ('specialty',)
+    # unique, so pages are read in the order of its index
+    ordering = ('username',)
+    # also used by the autocomplete widgets of the other models
+    search_fields = ('username', 'email', 'first_name', 'last_name')
+    search_help_text = 'Username, email, or the start of the first or last name.'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # each word is a username, an email, or the start of a name, all 
+        #   indexed. Names are stored capitalized (see User.save)
+        for word in search_term.split():
+            queryset = queryset.filter(
+                Q(username=word) | Q(email=word) | 
+                prefix_range('first_name', word.title()) | prefix_range('last_name', word.title()))
+        # only doctors are suggested for the doctor of an appointment
+        if request.GET.get('field_name') == 'doctor':
+            queryset = queryset.filter(is_doctor=True)
+        return queryset, False
 
 admin.site.register(User, UserAdmin)
 
 
 class SpecialtyAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('name',)
+    search_fields = ('name',)
+    ordering = ('name',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # names are stored capitalized (see Specialty.save)
+        for word in search_term.split():
+            queryset = queryset.filter(prefix_range('name', word.title()))
+        return queryset, False
 
 admin.site.register(Specialty, SpecialtyAdmin)
 
 
+@admin.action(description='Export selected appointments as CSV')
+def export_csv(modeladmin, request, queryset):
+    return export_response([queryset], 'csv')
+
+@admin.action(description='Export selected appointments as JSON lines')
+def export_jsonl(modeladmin, request, queryset):
+    return export_response([queryset], 'jsonl')
+
+
 class AppointmentAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('date', 'time', 'duration', 'doctor', 'patient')
+    list_select_related = ('doctor', 'patient')
+    # users are searched as they are typed instead of all loaded in <select>
+    autocomplete_fields = ('doctor', 'patient')
+    date_hierarchy = 'date'
+    # the date index also orders by id, so a page is read without sorting
+    ordering = ('-date', '-id')
+    # with "select all", the actions export every appointment of the filters
+    list_filter = ('doctor__specialty',)
+    actions = (export_csv, export_jsonl)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return DateIndexQuerySet(model=queryset.model, query=queryset.query, using=queryset._db)
+
+    def delete_queryset(self, request, queryset):
+        # through the queryset of the model, e.g. AppointmentQuerySet which
+        #   frees the busy slots of the appointments
+        self.model.objects.filter(pk__in=queryset.values('pk')).delete()
+
+admin.site.register(Appointment, AppointmentAdmin)
+
+
+class AppointmentArchiveAdmin(AppointmentAdmin):
+    # archived appointments are history, they are only read and exported
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+admin.site.register(AppointmentArchive, AppointmentArchiveAdmin)
+
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to_email', 'status', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('status',)
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
+
+class WorkingHoursInline(admin.TabularInline):
+    model = WorkingHours
+    extra = 0
+
+
+class ScheduleExceptionInline(admin.TabularInline):
+    model = ScheduleException
+    extra = 0
+
+
+class ScheduleAdmin(admin.ModelAdmin):
+    list_display = ('doctor', 'slot_minutes')
+    list_select_related = ('doctor',)
+    autocomplete_fields = ('doctor',)
+    inlines = (WorkingHoursInline, ScheduleExceptionInline)
+
+admin.site.register(Schedule, ScheduleAdmin)
+
+
+class HolidayAdmin(admin.ModelAdmin):
+    list_display = ('date', 'name')
 
-admin.site.register(Appointment, AppointmentAdmin)
\ No newline at end of file
+admin.site.register(Holiday, HolidayAdmin)
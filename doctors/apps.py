@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class DoctorsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'doctors'
+
+    def ready(self):
+        # connect the signal handlers that keep the typeahead suggestions trie
+        # up to date. The trie itself is filled from the database on the first
+        # suggest request: querying here would run before migrations and 
+        # before the test database is set up
+        from . import signals
+        # pragmas of the SQLite connections, e.g. write-ahead logging
+        from django.db.backends.signals import connection_created
+        from .db import configure_sqlite
+        connection_created.connect(configure_sqlite)
@@ -0,0 +1,57 @@
+from django.db import transaction
+
+from .models import Appointment, AppointmentArchive, BusySlots
+
+# the archived appointments are older than the current ones, and have the
+#   same fields
+MODELS = (AppointmentArchive, Appointment)
+# fields copied to the archive
+ARCHIVED_FIELDS = ('id', 'patient_id', 'doctor_id', 'date', 'time', 'duration')
+
+
+def appointments(*args, using=None, **kwargs):
+    '''
+    Querysets of the archived and of the current appointments with the given
+    filters, e.g. appointments(doctor_id=4, date__gte=start), for the views 
+    reading past appointments
+    '''
+    return [model.objects.using(using).filter(*args, **kwargs) for model in MODELS]
+
+def rows(querysets, fields, order_by, chunk_size):
+    '''
+    Rows of fields of the appointments of the querysets, one queryset after
+    the other, each ordered by order_by and read chunk_size rows at a time
+    '''
+    for queryset in querysets:
+        yield from queryset.order_by(*order_by).values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def archive_batch(before, batch_size):
+    '''
+    Moves the batch_size oldest appointments before the given date to the
+    archive, with the busy slots of the dates fully archived. Returns the 
+    number of appointments moved, 0 when done. Call within a transaction: 
+    the appointments are copied and deleted together, so an interrupted run
+    is resumed by running it again
+    '''
+    batch = list(Appointment.objects.filter(date__lt=before).order_by('date', 'id').values_list(
+        *ARCHIVED_FIELDS)[:batch_size])
+    if not batch:
+        return 0
+    AppointmentArchive.objects.bulk_create([
+        AppointmentArchive(**dict(zip(ARCHIVED_FIELDS, row))) for row in batch])
+    # frees the busy slots of the batch, see AppointmentQuerySet.delete
+    Appointment.objects.filter(id__in=[row[0] for row in batch]).delete()
+    # the appointments of the dates before the last one of the batch are all
+    #   archived. Past busy slots are never read, bookings are in the future
+    BusySlots.objects.filter(date__lt=batch[-1][3]).delete()
+    return len(batch)
+
+def finish(before):
+    '''
+    Deletes the busy slots left before the given date once all the 
+    appointments before it are archived
+    '''
+    with transaction.atomic():
+        if not Appointment.objects.filter(date__lt=before).exists():
+            BusySlots.objects.filter(date__lt=before).delete()
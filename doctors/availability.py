@@ -0,0 +1,65 @@
+import numpy as np
+
+from .models import User, BusySlots, Appointment, compiled_schedules
+
+NUM_SLOTS = len(Appointment.TIME_SLOTS)
+
+
+def free_matrix(specialty, dates):
+    '''
+    Returns the ids of the doctors of the given specialty and a boolean array
+    of shape (doctors, dates, slots) where [i, j, k] is true when the doctor 
+    doctor_ids[i] can be booked at Appointment.TIME_SLOTS[k] on dates[j]:
+    the doctor's schedule has an appointment starting then, and none of the
+    slots it covers is taken. The masks of all the doctors are read with a
+    single query, the schedules come from the cache
+    '''
+    doctor_ids = list(User.objects.filter(
+        is_doctor=True, specialty=specialty).order_by('id').values_list('id', flat=True))
+    masks = np.zeros((len(doctor_ids), len(dates)), dtype=np.uint32)
+    if doctor_ids and dates:
+        doctor_index = {doctor_id: index for index, doctor_id in enumerate(doctor_ids)}
+        date_index = {date: index for index, date in enumerate(dates)}
+        rows = BusySlots.objects.filter(
+            user__is_doctor=True, user__specialty=specialty, 
+            date__range=(dates[0], dates[-1]), mask__gt=0,
+        ).values_list('user_id', 'date', 'mask')
+        for user_id, date, mask in rows.iterator():
+            if user_id in doctor_index and date in date_index:
+                masks[doctor_index[user_id], date_index[date]] = mask
+    schedules = compiled_schedules(doctor_ids)
+    # most doctors share the default schedule, compute its starts once
+    starts_by_schedule = {}
+    for schedule in schedules.values():
+        if id(schedule) not in starts_by_schedule:
+            starts_by_schedule[id(schedule)] = [schedule.starts(date) for date in dates]
+    starts = np.array(
+        [starts_by_schedule[id(schedules[doctor_id])] for doctor_id in doctor_ids],
+        dtype=np.uint32).reshape(masks.shape)
+    units = np.array(
+        [schedules[doctor_id].units for doctor_id in doctor_ids], dtype=np.uint32)[:, np.newaxis]
+    # an appointment of n slots starting at slot k is blocked when one of the
+    #   slots k to k + n - 1 is taken, i.e. when bit k of mask >> i is set
+    #   for some i < n
+    blocked = masks.copy()
+    for shift in range(1, int(units.max(initial=1))):
+        blocked |= np.where(units > shift, masks >> shift, 0).astype(np.uint32)
+    free = starts & ~blocked
+    # expand each mask into one boolean per slot, bit k is slot k
+    return doctor_ids, (free[..., np.newaxis] >> np.arange(NUM_SLOTS, dtype=np.uint32)) & 1 == 1
+
+
+def earliest_available(specialty, dates, count):
+    '''
+    Returns the count earliest free (doctor_id, date, time) triples among the
+    doctors of the given specialty on the given (sorted) dates, ordered by
+    date, time and doctor id
+    '''
+    doctor_ids, free = free_matrix(specialty, dates)
+    # reorder axes to (dates, slots, doctors) so that free slots come out
+    #   of np.nonzero in chronological order
+    date_indexes, slot_indexes, doctor_indexes = np.nonzero(free.transpose(1, 2, 0))
+    return [
+        (doctor_ids[doctor_index], dates[date_index], Appointment.TIME_SLOTS[slot_index])
+        for date_index, slot_index, doctor_index in zip(
+            date_indexes[:count], slot_indexes[:count], doctor_indexes[:count])]
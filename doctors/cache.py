@@ -0,0 +1,182 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+import collections
+import hashlib
+import threading
+import time
+
+# Results of the search and time_availabilities views, kept between requests.
+# By default each process has its own in-memory LRU caches. With the
+#   RESULT_CACHE setting naming one of the CACHES, e.g. a shared Redis or
+#   Memcached cache, the results are stored there instead.
+DEFAULTS = {
+    'search': {'MAXSIZE': 2048, 'TTL': 60},
+    'time_slots': {'MAXSIZE': 10000, 'TTL': 30},
+    'schedules': {'MAXSIZE': 10000, 'TTL': 300},
+}
+
+
+class LRUCache:
+    '''
+    In-process cache of at most maxsize entries, evicting the least recently
+    used entry first. Entries expire ttl seconds after being set.
+    Entries can be tagged, e.g. with the ids of the doctors of a search
+    result, to be deleted together
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (expiry time, value, tags), least recently used first
+        self.entries = collections.OrderedDict()
+        # tag -> keys of the entries with that tag
+        self.tags = collections.defaultdict(set)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._delete(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags=()):
+        with self.lock:
+            self._delete(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value, frozenset(tags))
+            for tag in tags:
+                self.tags[tag].add(key)
+            while len(self.entries) > self.maxsize:
+                self._delete(next(iter(self.entries)))
+
+    # the entries are in memory, async views read and write them without
+    #   leaving the event loop
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, tags=()):
+        self.set(key, value, tags)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def delete_tag(self, tag):
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self._delete(key)
+
+    def delete_where(self, predicate):
+        '''
+        Deletes the entries for which predicate(key, value) is true
+        '''
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if predicate(key, entry[1])]:
+                self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedCache:
+    '''
+    Same interface as LRUCache, storing the entries in a cache of the Django
+    cache framework so that all the processes share them. Entries are
+    deleted by key, but the shared cache cannot look up entries by tag or
+    value, so delete_tag and delete_where drop all the entries of this cache
+    by changing the version in their keys
+    '''
+    def __init__(self, alias, prefix, ttl):
+        self.alias = alias
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        # caches[alias] is specific to each thread
+        return caches[self.alias]
+
+    def _version(self):
+        return self.cache.get_or_set(f'{self.prefix}:version', 1, timeout=None)
+
+    def _key(self, key):
+        # keys may hold spaces and quotes, which memcached does not accept
+        digest = hashlib.sha1(str(key).encode()).hexdigest()
+        return f'{self.prefix}:{self._version()}:{digest}'
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, tags=()):
+        self.cache.set(self._key(key), value, timeout=self.ttl)
+
+    # the cache backend, e.g. DatabaseCache, may only be used synchronously,
+    #   async views call it in a thread
+    async def aget(self, key):
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key, value, tags=()):
+        await sync_to_async(self.set)(key, value, tags)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+    def delete_tag(self, tag):
+        self.clear()
+
+    def delete_where(self, predicate):
+        self.clear()
+
+    def clear(self):
+        try:
+            self.cache.incr(f'{self.prefix}:version')
+        except ValueError:
+            # the version expired or was never set
+            self.cache.set(f'{self.prefix}:version', 2, timeout=None)
+
+
+def make_cache(name):
+    options = {**DEFAULTS[name], **getattr(settings, 'RESULT_CACHE_OPTIONS', {}).get(name, {})}
+    alias = getattr(settings, 'RESULT_CACHE', None)
+    if alias:
+        return SharedCache(alias, f'results:{name}', options['TTL'])
+    return LRUCache(options['MAXSIZE'], options['TTL'])
+
+
+def etag(content):
+    '''
+    Strong ETag of a response body
+    '''
+    return f'"{hashlib.sha1(content).hexdigest()}"'
+
+
+# JSON responses of the search view, keyed by normalized search term
+search_results = make_cache('search')
+# JSON responses of the time_availabilities view, keyed by slots_key
+time_slots = make_cache('time_slots')
+# CompiledSchedule of the doctors, keyed by doctor id (see models.compiled_schedules)
+schedules = make_cache('schedules')
+
+
+def slots_key(doctor_id, date):
+    return f"{doctor_id}:{date.strftime('%Y%m%d')}"
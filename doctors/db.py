@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+
+import functools
+import random
+import time
+
+# attempts of a transaction that fails because SQLite is locked by another
+#   writer, and delay before the first retry in seconds, doubled after each
+LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 0.05
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    '''
+    Receiver of the connection_created signal applying the SQLITE_PRAGMAS
+    setting to each new SQLite connection, e.g. write-ahead logging, so that
+    readers do not block the writer nor the writer the readers
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    # e.g. read-only replicas have their own pragmas
+    pragmas = connection.settings_dict.get('SQLITE_PRAGMAS', getattr(settings, 'SQLITE_PRAGMAS', {}))
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def is_locked(error):
+    # "database is locked", or "database table is locked" with shared cache
+    return 'locked' in str(error)
+
+
+def run_atomic(func, *args, **kwargs):
+    '''
+    Calls func in a transaction. SQLite has a single writer: when another
+    connection holds the write lock longer than busy_timeout, or when the
+    transaction read before writing and another writer committed meanwhile,
+    SQLite raises "database is locked" and the whole transaction is retried
+    after a random exponential backoff. Within an outer transaction, func is
+    called once and errors are left to the retries of the outer transaction
+    '''
+    if transaction.get_connection().in_atomic_block:
+        with transaction.atomic():
+            return func(*args, **kwargs)
+    delay = LOCK_RETRY_DELAY
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as error:
+            if not is_locked(error) or attempt == LOCK_RETRIES:
+                raise
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay *= 2
+
+
+def retry_when_locked(func):
+    '''
+    Decorator running the function with run_atomic
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_atomic(func, *args, **kwargs)
+    return wrapper
+
+
+def estimated_count(model, using='default'):
+    '''
+    Estimate of the number of rows of the table of model, read without 
+    scanning it: on SQLite the row count stored by ANALYZE, or else the span
+    of the primary keys, on PostgreSQL the planner statistics. None when no
+    estimate is available
+    '''
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk = connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                # the first number of the statistics of an index is the 
+                #   number of rows of its table
+                cursor.execute(
+                    "SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [model._meta.db_table])
+                row = cursor.fetchone()
+                if row:
+                    return int(row[0].split()[0])
+            # few rows are deleted, the span of the keys is close to the 
+            #   count. Each subquery reads one end of the primary key b-tree
+            cursor.execute(
+                f"SELECT (SELECT MAX({pk}) FROM {table}) - (SELECT MIN({pk}) FROM {table}) + 1")
+            row = cursor.fetchone()
+            return row[0] if row and row[0] is not None else 0
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [model._meta.db_table])
+            row = cursor.fetchone()
+            # -1 when the table has never been analyzed
+            if row and row[0] >= 0:
+                return int(row[0])
+    return None
@@ -0,0 +1,116 @@
+import csv
+import datetime
+import json
+
+from .helpers import streaming_response
+from . import archive
+
+# appointments read from the database at a time
+CHUNK_SIZE = 5000
+# bytes sent to the client at a time
+BUFFER_SIZE = 64 * 1024
+
+# columns of the exports, the doctor, specialty and patient are joined in the
+#   query of the appointments
+COLUMNS = (
+    ('appointment_id', 'id'),
+    ('date', 'date'),
+    ('time', 'time'),
+    ('duration', 'duration'),
+    ('doctor_id', 'doctor_id'),
+    ('doctor_first_name', 'doctor__first_name'),
+    ('doctor_last_name', 'doctor__last_name'),
+    ('specialty', 'doctor__specialty__name'),
+    ('patient_id', 'patient_id'),
+    ('patient_first_name', 'patient__first_name'),
+    ('patient_last_name', 'patient__last_name'),
+    ('patient_email', 'patient__email'),
+)
+HEADER = [name for name, field in COLUMNS]
+FIELDS = [field for name, field in COLUMNS]
+
+# spreadsheets evaluate cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def filter_appointments(appointments, start=None, end=None, doctor_id=None, specialty_id=None):
+    '''
+    Appointments from start to end, both included, with the given doctor
+    and of the given specialty, when given
+    '''
+    if start is not None:
+        appointments = appointments.filter(date__gte=start)
+    if end is not None:
+        appointments = appointments.filter(date__lte=end)
+    if doctor_id is not None:
+        appointments = appointments.filter(doctor_id=doctor_id)
+    if specialty_id is not None:
+        appointments = appointments.filter(doctor__specialty_id=specialty_id)
+    return appointments
+
+def rows(querysets):
+    '''
+    Rows of FIELDS of the appointments of the querysets, read CHUNK_SIZE at a
+    time in the order of their ids, so that no sort delays the first row
+    '''
+    return archive.rows(querysets, FIELDS, ('id',), CHUNK_SIZE)
+
+def buffered(lines):
+    '''
+    Joins the lines of bytes into chunks of about BUFFER_SIZE bytes
+    '''
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+class Line:
+    '''
+    File-like object of csv.writer returning the line written
+    '''
+    def write(self, line):
+        return line
+
+
+def safe_cell(value):
+    # user generated names are not run as formulas by spreadsheets
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def csv_lines(rows):
+    writer = csv.writer(Line())
+    yield writer.writerow(HEADER).encode()
+    for row in rows:
+        yield writer.writerow([safe_cell(value) for value in row]).encode()
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(HEADER, row)), default=str).encode() + b'\n'
+
+# format: (lines of the rows, content type, file extension)
+FORMATS = {
+    'csv': (csv_lines, 'text/csv; charset=utf-8', 'csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson', 'jsonl'),
+}
+
+def export_response(querysets, format):
+    '''
+    Response streaming the appointments of the querysets, of Appointment or
+    AppointmentArchive, in the given format, in constant memory whatever 
+    their number
+    '''
+    lines, content_type, extension = FORMATS[format]
+    filename = f"appointments-{datetime.date.today():%Y%m%d}.{extension}"
+    return streaming_response(buffered(lines(rows(querysets))), content_type, {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+    })
@@ -1,9 +1,12 @@
 from django import forms
 from django.core.exceptions import ValidationError
-from django.conf import settings
-from .models import User, Specialty, Appointment, user_picture_path
 
-import os
+import datetime
+from .models import User, Specialty, Appointment
+from .helpers import MAX_SERIES_SLOTS, expand_rule
+from .storage import delete_unused_picture
+from .thumbnails import has_renditions, make_renditions
+
 
 class BookForm(forms.Form):
     doctor_id = forms.IntegerField()
@@ -12,6 +15,44 @@ class BookForm(forms.Form):
     # string of the form '<hour>:<minutes>', e.g.: '10:30' 
     time = forms.CharField(max_length=5)
 
+def parse_slot(date_string, time_string):
+    return (datetime.datetime.strptime(date_string, "%Y%m%d").date(),
+            datetime.datetime.strptime(time_string, "%H:%M").time())
+
+class BookSeriesForm(forms.Form):
+    '''
+    Series of appointments with a doctor, either the given slots or the 
+    dates of a recurrence rule at the same time. cleaned_data['series'] is
+    the list of their (date, time)
+    '''
+    doctor_id = forms.IntegerField()
+    # comma separated '<date>-<time>', e.g.: '20240125-10:30,20240201-11:00'
+    slots = forms.CharField(required=False)
+    # first appointment of the recurrence rule, as in BookForm
+    date = forms.CharField(max_length=8, required=False)
+    time = forms.CharField(max_length=5, required=False)
+    # e.g.: 'FREQ=WEEKLY;COUNT=6', see helpers.expand_rule
+    rule = forms.CharField(max_length=128, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        slots = cleaned_data.get('slots')
+        rule = cleaned_data.get('rule')
+        if bool(slots) == bool(rule):
+            raise ValidationError("Give either slots or a recurrence rule.")
+        try:
+            if slots:
+                series = [parse_slot(*slot.strip().split('-')) for slot in slots.split(',')]
+            else:
+                first, time = parse_slot(cleaned_data.get('date'), cleaned_data.get('time'))
+                series = [(date, time) for date in expand_rule(first, rule)]
+        except (TypeError, ValueError):
+            raise ValidationError("Invalid slots or recurrence rule.")
+        if len(series) > MAX_SERIES_SLOTS:
+            raise ValidationError(f"Book at most {MAX_SERIES_SLOTS} appointments at once.")
+        cleaned_data['series'] = series
+        return cleaned_data
+
 class CancelForm(forms.Form):
     appointment_id = forms.IntegerField()
 
@@ -20,22 +61,21 @@ class PictureForm(forms.ModelForm):
         model = User
         fields = ('picture',)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.previous_picture = self.instance.picture.name
+
     def save(self):
-        # Make sure no new filename (and file) is added to storage folder 
-        #  when updating the picture
-        # First save the user so we can rely on actual file name on disk
+        # Pictures are named by the hash of their content (see user_picture_path),
+        #   so a new picture is stored as a new file with a new URL, and the
+        #   previous file is deleted once no user has it
         user = super().save()
-        if user.picture:
-            # new name is the target name we want to have of the form 
-            #   <username>.<ext>, e.g. alice.jpg
-            new_name = user_picture_path(user, user.picture.name)
-            if user.picture.name != new_name:
-                initial_path = user.picture.path
-                user.picture.name = new_name
-                new_path = os.path.join(settings.MEDIA_ROOT, user.picture.name)
-                os.remove(new_path)
-                os.rename(initial_path, new_path)
-                user.save()
+        if user.picture and 'picture' in self.changed_data:
+            # smaller pictures for the cards and search results
+            if not has_renditions(user.picture.name):
+                make_renditions(user.picture.name)
+            if self.previous_picture != user.picture.name:
+                delete_unused_picture(self.previous_picture)
         return user
 
 USER_TEXT_FIELDS = (
@@ -1,7 +1,13 @@
 from django.utils.html import escape
-from django.core.mail import send_mail
+from django.utils.cache import get_conditional_response
+from django.core.handlers.asgi import ASGIHandler
+from django.http import HttpResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
 from django.conf import settings
 import datetime
+import functools
+
+from .thumbnails import srcset
 
 # used in the search view
 def doctor_to_dict(doctor):
@@ -15,30 +21,189 @@ def doctor_to_dict(doctor):
         'doctor_name': escape(f"{doctor['first_name']} {doctor['last_name']}"),
         'doctor_specialty': doctor['specialty__name'],
         'doctor_img': escape(doctor['picture']),
+        # resized renditions of the picture
+        'doctor_srcset': escape(srcset(doctor['picture'], 'jpg')),
+        'doctor_srcset_webp': escape(srcset(doctor['picture'], 'webp')),
     }
 
+# used in the appointments views
+def appointment_cursor(appointment):
+    '''
+    Keyset pagination cursor of an appointment, e.g.: '20240125-1030-42'
+    '''
+    return f"{appointment.date.strftime('%Y%m%d')}-{appointment.time.strftime('%H%M')}-{appointment.id}"
+
+def parse_appointment_cursor(cursor):
+    '''
+    Returns the (date, time, id) of a cursor built by appointment_cursor,
+    raises ValueError when the cursor is not valid
+    '''
+    date_string, time_string, id_string = cursor.split('-')
+    return (
+        datetime.datetime.strptime(date_string, "%Y%m%d").date(),
+        datetime.datetime.strptime(time_string, "%H%M").time(),
+        int(id_string))
+
+# used by the API endpoints whose responses are cached
+def json_response_with_etag(request, content, etag, cache_control='no-cache'):
+    '''
+    JSON response with the given ETag, or 304 not modified when the client
+    already has that version (If-None-Match). no-cache makes browsers
+    revalidate their copy on each use
+    '''
+    response = HttpResponse(content, content_type='application/json', headers={
+        'ETag': etag, 'Cache-Control': cache_control})
+    return get_conditional_response(request, etag=etag, response=response)
+
+# Django 4.1 login_required does not support async views
+def login_required_async(view):
+    '''
+    login_required for async views. The user is loaded from the session in a
+    thread, after which request.user can be used on the event loop
+    '''
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            # imported here because it imports the user model
+            from django.contrib.auth.views import redirect_to_login
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+class ThreadedStreamingHttpResponse(StreamingHttpResponse):
+    '''
+    Streaming response whose chunks are also iterated asynchronously, each
+    one generated in the thread that ran the view with sync_to_async, e.g.
+    by a database query. Sent by StreamingASGIHandler under ASGI
+    '''
+    async def __aiter__(self):
+        # streaming_content, in case a middleware wrapped the chunks
+        chunks = iter(self.streaming_content)
+        next_chunk = sync_to_async(next, thread_sensitive=True)
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+class StreamingASGIHandler(ASGIHandler):
+    '''
+    Django ASGI application sending the ThreadedStreamingHttpResponse as
+    their chunks are generated. Django 4.1 iterates streaming responses on
+    the event loop, where the ORM cannot run
+    '''
+    async def send_response(self, response, send):
+        if not isinstance(response, ThreadedStreamingHttpResponse):
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode('ascii'), value.encode('latin1')) for header, value in response.items()]
+        headers += [
+            (b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+            for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        async for part in response:
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+# used by the views streaming data from the database
+def streaming_response(chunks, content_type, headers=None):
+    '''
+    Response sending the chunks of bytes as they are generated, in constant
+    memory under WSGI and ASGI
+    '''
+    return ThreadedStreamingHttpResponse(chunks, content_type=content_type, headers=headers)
+
+# days from each day of the week to the next weekday, Monday first
+NEXT_WEEKDAY_DAYS = (1, 1, 1, 1, 3, 2, 1)
+
 def next_weekday(date):
-    next_day = date + datetime.timedelta(days=1)
-    while next_day.weekday() >= 5:  # 5 means Saturday, 6 Sunday
-        next_day += datetime.timedelta(days=1)
-    return next_day
+    return date + datetime.timedelta(days=NEXT_WEEKDAY_DAYS[date.weekday()])
+
+def weekdays_from(first, num_days):
+    '''
+    Returns num_days weekdays starting with first, a weekday
+    '''
+    # weekday i counted from the Monday of first is i // 5 weeks and 
+    #   i % 5 days after that Monday
+    monday = first - datetime.timedelta(days=first.weekday())
+    return [
+        monday + datetime.timedelta(days=7 * (index // 5) + index % 5)
+        for index in range(first.weekday(), first.weekday() + num_days)]
 
-# used in the book view
+# e.g. the dates of the earliest view, the dates of the booking page are
+#   the working days of the doctor (see schedules.py)
 def next_weekdays(date, num_days):
     '''
     Returns the next num_days weekdays (skipping weekend days) 
     starting with the day after the given date
     '''
-    next_days = []
-    next_day = next_weekday(date)
-    while len(next_days) < num_days:
-        next_days.append(next_day)
-        next_day = next_weekday(next_day)
-    return next_days
+    return weekdays_from(next_weekday(date), num_days)
+
+def weekdays_between(start, end):
+    '''
+    Returns the weekdays (skipping weekend days) from start to end, 
+    both included
+    '''
+    first = start if start.weekday() < 5 else next_weekday(start)
+    if first > end:
+        return []
+    # at most 5 weekdays per started week
+    days = weekdays_from(first, ((end - first).days // 7 + 1) * 5)
+    return [day for day in days if day <= end]
+
+# most appointments booked at once as a series, e.g. weekly for half a year
+MAX_SERIES_SLOTS = 26
+# days between the dates of the recurrence rules, by FREQ
+RULE_FREQUENCIES = {'DAILY': 1, 'WEEKLY': 7}
+
+def expand_rule(first, rule, max_count=MAX_SERIES_SLOTS):
+    '''
+    Returns the dates of a recurrence rule starting on first. Rules are a
+    subset of the RRULE of iCalendar (RFC 5545, 3.3.10): FREQ, DAILY or 
+    WEEKLY, an optional INTERVAL, and either COUNT or UNTIL, a date of the
+    form '<year><month><day>', e.g.: 'FREQ=WEEKLY;COUNT=6'. Raises 
+    ValueError when the rule is not supported or has more than max_count 
+    dates
+    '''
+    parts = dict(part.split('=', 1) for part in rule.upper().split(';') if part)
+    if set(parts) - {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL'} or parts.get('FREQ') not in RULE_FREQUENCIES:
+        raise ValueError(f"Unsupported recurrence rule {rule}.")
+    if ('COUNT' in parts) == ('UNTIL' in parts):
+        raise ValueError("Recurrence rules need either a COUNT or an UNTIL.")
+    interval = int(parts.get('INTERVAL', 1))
+    if interval < 1:
+        raise ValueError(f"Invalid INTERVAL {interval}.")
+    step = datetime.timedelta(days=RULE_FREQUENCIES[parts['FREQ']] * interval)
+    if 'COUNT' in parts:
+        count = int(parts['COUNT'])
+    else:
+        # dates only, a time of UNTIL is ignored
+        until = datetime.datetime.strptime(parts['UNTIL'][:8], "%Y%m%d").date()
+        count = max((until - first) // step + 1, 0)
+    if not 1 <= count <= max_count:
+        raise ValueError(f"Recurrence rules have from 1 to {max_count} dates.")
+    return [first + step * index for index in range(count)]
+
+def queue_email(subject, message, to_email):
+    '''
+    Add an email to the outbox, it is sent by the send_emails management 
+    command. Call within the transaction that changes the appointment so that
+    the email is only sent if the change is committed
+    '''
+    from .models import OutboxEmail
+    return OutboxEmail.objects.create(
+        subject=subject,
+        message=message,
+        from_email=f'''"Doctors App" <{settings.EMAIL_HOST_USER}@gmail.com>''',
+        to_email=to_email,
+    )
 
 def confirmation_email(to_first_name, to_email, doctor, date, time):
     '''
-    Send email to confirm an appointment
+    Queue email to confirm an appointment
     to_first_name and to_mail refer to the recipient of the message (the patient)
     doctor is the doctor the recipient will have the appointment with
     '''
@@ -47,16 +212,11 @@ def confirmation_email(to_first_name, to_email, doctor, date, time):
                f"We are glad to confirm your appointment with Doctor {doctor} on {date} at {time}.\n"
                 "Best regards,\n"
                 "The Doctors Team")
-    send_mail(
-        subject=subject,
-        message=message,
-        from_email=f'''"Doctors App" <{settings.EMAIL_HOST_USER}@gmail.com>''',
-        recipient_list=[to_email]
-    )
+    return queue_email(subject, message, to_email)
 
 def cancellation_email(to_first_name, to_email, doctor, date, time):
     '''
-    Send email to confirm a cancellation
+    Queue email to confirm a cancellation
     to_first_name and to_mail refer to the recipient of the message (the patient)
     doctor is the doctor the recipient had the appointment with
     '''
@@ -65,9 +225,18 @@ def cancellation_email(to_first_name, to_email, doctor, date, time):
                f"Your appointment with Doctor {doctor} on {date} at {time} has been cancelled.\n"
                 "Best regards,\n"
                 "The Doctors Team")
-    send_mail(
-        subject=subject,
-        message=message,
-        from_email=f'''"Doctors App" <{settings.EMAIL_HOST_USER}@gmail.com>''',
-        recipient_list=[to_email]
-    )
\ No newline at end of file
+    return queue_email(subject, message, to_email)
+
+def series_confirmation_email(to_first_name, to_email, doctor, dates_and_times):
+    '''
+    Queue a single email to confirm a series of appointments
+    dates_and_times are the (date, time) of the appointments, as strings
+    '''
+    subject = 'Appointments confirmation'
+    appointments = ''.join(f"- {date} at {time}\n" for date, time in dates_and_times)
+    message = (f"Dear {to_first_name},\n"
+               f"We are glad to confirm your appointments with Doctor {doctor} on:\n"
+               f"{appointments}"
+                "Best regards,\n"
+                "The Doctors Team")
+    return queue_email(subject, message, to_email)
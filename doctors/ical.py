@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.db.models import Q
+
+import datetime
+import zoneinfo
+
+from . import archive
+
+# appointments read from the database at a time
+CHUNK_SIZE = 2000
+# bytes of events sent to the client at a time
+BUFFER_SIZE = 64 * 1024
+# how often calendar clients should poll the feed
+REFRESH_INTERVAL = 'PT1H'
+
+# appointment dates and times are local times of the clinic
+LOCAL_TIME_ZONE = zoneinfo.ZoneInfo(settings.TIME_ZONE)
+
+FIELDS = (
+    'id', 'date', 'time', 'duration', 'doctor_id', 'doctor__first_name', 'doctor__last_name',
+    'doctor__specialty__name', 'patient__first_name', 'patient__last_name')
+
+
+def escape_text(text):
+    '''
+    Escapes a TEXT value (RFC 5545, 3.3.11)
+    '''
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def content_line(name, value):
+    '''
+    Content line folded to lines of at most 75 octets (RFC 5545, 3.1)
+    '''
+    line = f"{name}:{value}".encode()
+    if len(line) <= 75:
+        return line + b'\r\n'
+    lines = []
+    start = 0
+    while start < len(line):
+        # continuation lines start with a space, not counted in the content
+        end = start + (75 if start == 0 else 74)
+        # do not split UTF-8 sequences, continuation bytes are 10xxxxxx
+        while end < len(line) and line[end] & 0xC0 == 0x80:
+            end -= 1
+        lines.append(line[start:end])
+        start = end
+    return b'\r\n '.join(lines) + b'\r\n'
+
+def utc_stamp(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def event(row, user_id, host, stamp):
+    '''
+    VEVENT of an appointment given as a row of FIELDS, seen by the user
+    '''
+    (id, date, time, duration, doctor_id, doctor_first_name, doctor_last_name,
+        specialty, patient_first_name, patient_last_name) = row
+    start = datetime.datetime.combine(date, time, tzinfo=LOCAL_TIME_ZONE)
+    end = start + datetime.timedelta(minutes=duration)
+    # doctors may also have appointments as patients
+    if doctor_id == user_id:
+        summary = f"Appointment with {patient_first_name} {patient_last_name}"
+    else:
+        summary = f"Appointment with Doctor {doctor_first_name} {doctor_last_name}"
+    return b''.join([
+        b'BEGIN:VEVENT\r\n',
+        content_line('UID', f"appointment-{id}@{host}"),
+        content_line('DTSTAMP', stamp),
+        content_line('DTSTART', utc_stamp(start)),
+        content_line('DTEND', utc_stamp(end)),
+        content_line('SUMMARY', escape_text(summary)),
+        content_line('DESCRIPTION', escape_text(specialty or '')),
+        b'END:VEVENT\r\n',
+    ])
+
+def feed(user_id, changed, host, using='default'):
+    '''
+    Generates the iCalendar feed of the appointments of the user, as a doctor
+    or as a patient, in chunks of about BUFFER_SIZE bytes. The appointments
+    are read CHUNK_SIZE rows at a time with their doctor, specialty and
+    patient, so memory does not depend on their number
+    '''
+    stamp = utc_stamp(changed)
+    yield b''.join([
+        b'BEGIN:VCALENDAR\r\n',
+        b'VERSION:2.0\r\n',
+        b'PRODID:-//Doctors//Appointments//EN\r\n',
+        b'CALSCALE:GREGORIAN\r\n',
+        b'METHOD:PUBLISH\r\n',
+        content_line('X-WR-CALNAME', 'Appointments'),
+        content_line('REFRESH-INTERVAL;VALUE=DURATION', REFRESH_INTERVAL),
+        content_line('X-PUBLISHED-TTL', REFRESH_INTERVAL),
+    ])
+    # archived appointments included
+    rows = archive.rows(
+        archive.appointments(Q(patient_id=user_id) | Q(doctor_id=user_id), using=using), 
+        FIELDS, ('date', 'time', 'id'), CHUNK_SIZE)
+    buffer = []
+    size = 0
+    for row in rows:
+        buffer.append(event(row, user_id, host, stamp))
+        size += len(buffer[-1])
+        if size >= BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append(b'END:VCALENDAR\r\n')
+    yield b''.join(buffer)
@@ -0,0 +1,213 @@
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.db import transaction
+
+import datetime
+import itertools
+
+from .models import Specialty, User, Appointment, BusySlots, busy_slots_changed, compiled_schedules
+from .search import index_new_doctors
+from .schedules import DEFAULT_SLOT_MINUTES, TIME_SLOTS, slot_bits
+
+# how the password column of the users is imported
+PREHASHED = 'prehashed'   # already hashed by Django, e.g. exported from another instance
+HASH = 'hash'             # plain text, hashed on import (slow: one PBKDF2 per user)
+UNUSABLE = 'unusable'     # deferred, users set a password with a password reset
+PASSWORD_MODES = (PREHASHED, HASH, UNUSABLE)
+
+
+def batches(rows, size):
+    '''
+    Splits an iterable of rows into lists of at most size rows
+    '''
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+class Importer:
+    '''
+    Streams specialties, users and appointments (iterables of dictionaries,
+    e.g. rows of a CSV file) into the database with bulk inserts.
+    Specialties are resolved with an in-memory map of their names to ids, 
+    and usernames with one query per batch, so that no query is made per row.
+    Rows are inserted in batches of batch_size, and batches_per_transaction
+    batches are committed at once. Only the current batch is held in memory
+    '''
+    def __init__(self, batch_size=1000, batches_per_transaction=10, passwords=PREHASHED):
+        if passwords not in PASSWORD_MODES:
+            raise ValueError(f"Unknown password mode {passwords}.")
+        self.batch_size = batch_size
+        self.batches_per_transaction = batches_per_transaction
+        self.passwords = passwords
+        self.specialty_ids = dict(Specialty.objects.values_list('name', 'id'))
+        self.specialty_names = {id: name for name, id in self.specialty_ids.items()}
+        # appointments not imported since their doctor or patient is busy
+        self.skipped = 0
+        # appointments not imported since their doctor does not work then
+        self.off_schedule = 0
+
+    def _import(self, rows, insert_batch):
+        '''
+        Returns the number of rows inserted, insert_batch returns that of a batch
+        '''
+        count = 0
+        for chunk in batches(batches(rows, self.batch_size), self.batches_per_transaction):
+            with transaction.atomic():
+                for batch in chunk:
+                    count += insert_batch(batch)
+        return count
+
+    def specialties(self, rows):
+        return self._import(rows, self._insert_specialties)
+
+    def _insert_specialties(self, rows):
+        names = set()
+        for row in rows:
+            # same formatting as Specialty.save
+            name = row['name'].strip().title()
+            if name not in self.specialty_ids:
+                names.add(name)
+        Specialty.objects.bulk_create([Specialty(name=name) for name in names])
+        self.specialty_ids.update(Specialty.objects.filter(name__in=names).values_list('name', 'id'))
+        self.specialty_names = {id: name for name, id in self.specialty_ids.items()}
+        return len(names)
+
+    def doctors(self, rows):
+        return self._import(rows, lambda batch: self._insert_users(batch, is_doctor=True))
+
+    def patients(self, rows):
+        return self._import(rows, lambda batch: self._insert_users(batch, is_doctor=False))
+
+    def _password(self, row):
+        password = row.get('password') or ''
+        if self.passwords == PREHASHED and password:
+            # plain text would be stored as is, and checked against as a hash
+            try:
+                identify_hasher(password)
+            except ValueError:
+                raise ValueError(f"The password of {row['username']} is not a Django password hash.")
+            return password
+        if self.passwords == HASH and password:
+            return make_password(password)
+        return make_password(None) # unusable password
+
+    def _insert_users(self, rows, is_doctor):
+        users = []
+        for row in rows:
+            specialty_id = None
+            if is_doctor:
+                specialty_id = self.specialty_ids.get(row['specialty'].strip().title())
+                if specialty_id is None:
+                    raise ValueError(f"Unknown specialty {row['specialty']} of {row['username']}.")
+            users.append(User(
+                username=row['username'],
+                email=row['email'],
+                password=self._password(row),
+                # same formatting as User.save
+                first_name=row['first_name'].title(),
+                last_name=row['last_name'].title(),
+                is_doctor=is_doctor,
+                specialty_id=specialty_id,
+                description=(row.get('description') or '') if is_doctor else '',
+                picture=row.get('picture') or None,
+            ))
+        User.objects.bulk_create(users)
+        # backends that cannot return the ids of bulk inserts
+        if users and users[0].pk is None:
+            ids = dict(User.objects.filter(
+                username__in=[user.username for user in users]).values_list('username', 'id'))
+            for user in users:
+                user.pk = ids[user.username]
+        # bulk_create does not call User.save, which updates the search index
+        if is_doctor:
+            index_new_doctors([
+                (user.pk, user.first_name, user.last_name,
+                 self.specialty_names[user.specialty_id], user.description)
+                for user in users])
+        return len(users)
+
+    def appointments(self, rows):
+        '''
+        Appointments are checked as bookings are: the doctor must be a doctor,
+        the date in the future, the time offered by the schedule of the doctor
+        and the slots free for both the doctor and the patient. Rows at a time
+        the doctor does not work are counted in off_schedule, those whose
+        slots are already taken, before or by an earlier row, are skipped and
+        counted in skipped. The busy slots of the appointments are taken in
+        the same transaction
+        '''
+        return self._import(rows, self._insert_appointments)
+
+    def _insert_appointments(self, rows):
+        # the users of the batch only, a map of all the usernames would grow
+        #   with the input
+        user_ids = {}
+        doctor_ids = set()
+        for username, id, is_doctor in User.objects.filter(
+                username__in={username for row in rows for username in (row['patient'], row['doctor'])}
+                ).values_list('username', 'id', 'is_doctor'):
+            user_ids[username] = id
+            if is_doctor:
+                doctor_ids.add(id)
+        today = datetime.date.today()
+        parsed = []
+        for row in rows:
+            time = datetime.time.fromisoformat(row['time'])
+            if time not in Appointment.TIME_SLOTS_SET:
+                raise ValueError(f"{row['time']} is not a time slot, in appointment {row}.")
+            date = datetime.date.fromisoformat(row['date'])
+            if date <= today:
+                raise ValueError(f"{row['date']} is not a future date, in appointment {row}.")
+            # optional column, in minutes
+            duration = int(row.get('duration') or DEFAULT_SLOT_MINUTES)
+            bits = slot_bits(time, duration)
+            if bits >> len(TIME_SLOTS):
+                raise ValueError(f"The appointment ends after the last time slot, in appointment {row}.")
+            try:
+                patient_id = user_ids[row['patient']]
+                doctor_id = user_ids[row['doctor']]
+            except KeyError as e:
+                raise ValueError(f"Unknown user {e} in appointment {row}.")
+            if doctor_id not in doctor_ids:
+                raise ValueError(f"{row['doctor']} is not a doctor, in appointment {row}.")
+            if doctor_id == patient_id:
+                raise ValueError(f"The doctor is also the patient, in appointment {row}.")
+            parsed.append((patient_id, doctor_id, date, time, duration, bits))
+
+        # the schedules as they are now, as bookings are checked
+        schedules = compiled_schedules({row[1] for row in parsed}, cached=False)
+        on_schedule = [row for row in parsed if schedules[row[1]].offers(row[2], row[3])]
+        self.off_schedule += len(parsed) - len(on_schedule)
+        parsed = on_schedule
+
+        # the busy slots of the users on the dates of the batch, read with a
+        #   single query and taken as the rows are checked
+        busy_slots = {
+            (busy.user_id, busy.date): busy for busy in BusySlots.objects.filter(
+                user_id__in={user_id for row in parsed for user_id in row[:2]},
+                date__in={row[2] for row in parsed})}
+        changed = {}
+        appointments = []
+        for patient_id, doctor_id, date, time, duration, bits in parsed:
+            keys = ((doctor_id, date), (patient_id, date))
+            if any(key in busy_slots and busy_slots[key].mask & bits for key in keys):
+                self.skipped += 1
+                continue
+            for user_id, date in keys:
+                busy = busy_slots.setdefault(
+                    (user_id, date), BusySlots(user_id=user_id, date=date, mask=0))
+                busy.mask |= bits
+                changed[user_id, date] = busy
+            appointments.append(Appointment(
+                patient_id=patient_id, doctor_id=doctor_id, date=date, time=time, duration=duration))
+        # the unique constraints are a last line of defence, IntegrityError
+        #   means the busy slots do not match the appointments
+        Appointment.objects.bulk_create(appointments)
+        BusySlots.objects.bulk_update([busy for busy in changed.values() if busy.pk], ['mask'])
+        BusySlots.objects.bulk_create([busy for busy in changed.values() if not busy.pk])
+        user_ids_by_date = {}
+        for user_id, date in changed:
+            user_ids_by_date.setdefault(date, []).append(user_id)
+        for date, user_ids in user_ids_by_date.items():
+            busy_slots_changed.send(sender=BusySlots, user_ids=user_ids, date=date)
+        return len(appointments)
@@ -0,0 +1,308 @@
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+
+import asyncio
+import collections
+import datetime
+import io
+import json
+import threading
+import urllib.parse
+
+from .models import User, BusySlots, acompiled_schedule
+
+# path of the stream of the time slots of a doctor, e.g.
+#   /book/slots/stream?doctor_id=3&dates=20240125,20240126
+STREAM_PATH = '/book/slots/stream'
+# maximum number of dates a stream follows
+MAX_DATES = 31
+# seconds between two checks of the busy slots when no change was notified,
+#   to see the changes made by other processes. The streams following the
+#   same doctor and dates share the checks (see SlotsWatch)
+POLL_SECONDS = 5
+# seconds between two comments keeping idle connections open through proxies
+KEEPALIVE_SECONDS = 15
+# milliseconds browsers wait before reconnecting a closed stream
+RETRY_MILLISECONDS = 3000
+
+
+class SlotsBroker:
+    '''
+    Wakes up the streams following a doctor when the busy slots of the doctor
+    change in this process. Changes are published from the threads running
+    the views and delivered to the event loops of the streams
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # doctor id -> (event loop, queue of the changed dates) of the streams
+        self.subscribers = collections.defaultdict(set)
+
+    def subscribe(self, doctor_id):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            self.subscribers[doctor_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, doctor_id, subscriber):
+        with self.lock:
+            self.subscribers[doctor_id].discard(subscriber)
+            if not self.subscribers[doctor_id]:
+                del self.subscribers[doctor_id]
+
+    def publish(self, user_ids, date):
+        with self.lock:
+            subscribers = [
+                subscriber for user_id in user_ids
+                for subscriber in self.subscribers.get(user_id, ())]
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, date)
+            except RuntimeError:
+                # the event loop is closed
+                pass
+
+broker = SlotsBroker()
+
+
+def parse_query(query_string):
+    '''
+    Returns the doctor id and the dates of the query string of a stream,
+    raising ValueError when they are missing or malformed
+    '''
+    query = urllib.parse.parse_qs(query_string.decode('latin1'))
+    doctor_id = int(query['doctor_id'][0])
+    today = datetime.date.today()
+    dates = set()
+    for date in query['dates'][0].split(','):
+        date = datetime.datetime.strptime(date, '%Y%m%d').date()
+        # slots of the past cannot be booked
+        if date > today:
+            dates.add(date)
+    if len(dates) > MAX_DATES:
+        raise ValueError('too many dates')
+    return doctor_id, sorted(dates)
+
+
+def slots_event(date, time_slots, previous_time_slots):
+    '''
+    Server-sent event with the free time slots of the doctor on date, and
+    the slots taken and freed since previous_time_slots, None for the first
+    event
+    '''
+    data = {'date': date.strftime('%Y%m%d'), 'time_slots': time_slots}
+    if previous_time_slots is not None:
+        data['taken'] = [time for time in previous_time_slots if time not in time_slots]
+        data['freed'] = [time for time in time_slots if time not in previous_time_slots]
+    return f"event: slots\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def free_time_slots(doctor_id, dates):
+    '''
+    Returns a dictionary mapping each of the dates to the free time slots of
+    the doctor, e.g. ['10:00', '10:30']
+    '''
+    # the schedule may have changed too
+    schedule = await acompiled_schedule(doctor_id)
+    masks = dict.fromkeys(dates, 0)
+    async for date, mask in BusySlots.objects.filter(
+            user_id=doctor_id, date__in=dates).values_list('date', 'mask'):
+        masks[date] = mask
+    return {
+        date: [time.strftime('%H:%M') for time in schedule.free_times(date, mask)]
+        for date, mask in masks.items()}
+
+
+class SlotsWatch:
+    '''
+    Free time slots of a doctor on some dates, shared by the streams that
+    follow them: a single task reads them again when the broker notifies a
+    change, or every POLL_SECONDS, and hands the events of the slots that
+    changed to the queue of each stream. None in a queue ends the stream
+    '''
+    def __init__(self, doctor_id, dates):
+        self.doctor_id = doctor_id
+        self.dates = dates
+        self.listeners = set()
+        # None until the first read, and if the task failed
+        self.time_slots = None
+        self.ready = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        # subscribe before reading the masks so that no change is missed
+        subscriber = broker.subscribe(self.doctor_id)
+        _, changes = subscriber
+        try:
+            self.time_slots = await free_time_slots(self.doctor_id, self.dates)
+            self.ready.set()
+            while True:
+                try:
+                    await asyncio.wait_for(changes.get(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                # several changes are read together
+                while not changes.empty():
+                    changes.get_nowait()
+                time_slots = await free_time_slots(self.doctor_id, self.dates)
+                body = b''.join(
+                    slots_event(date, slots, self.time_slots[date])
+                    for date, slots in time_slots.items() if slots != self.time_slots[date])
+                self.time_slots = time_slots
+                if body:
+                    for queue in self.listeners:
+                        queue.put_nowait(body)
+        except Exception:
+            self.time_slots = None
+            for queue in self.listeners:
+                queue.put_nowait(None)
+            raise
+        finally:
+            self.ready.set()
+            broker.unsubscribe(self.doctor_id, subscriber)
+
+
+class SlotsWatches:
+    '''
+    The SlotsWatch of each doctor and dates followed by streams of this
+    process, created by the first stream and stopped with the last one
+    '''
+    def __init__(self):
+        # (event loop, doctor id, dates) -> SlotsWatch
+        self.watches = {}
+
+    def join(self, doctor_id, dates):
+        '''
+        Returns the key and the watch of the doctor and dates, and the queue
+        of the events of the stream
+        '''
+        key = (asyncio.get_running_loop(), doctor_id, tuple(dates))
+        watch = self.watches.get(key)
+        if watch is None or watch.task.done():
+            watch = self.watches[key] = SlotsWatch(doctor_id, dates)
+        queue = asyncio.Queue()
+        watch.listeners.add(queue)
+        return key, watch, queue
+
+    async def leave(self, key, watch, queue):
+        watch.listeners.discard(queue)
+        if watch.listeners:
+            return
+        if self.watches.get(key) is watch:
+            del self.watches[key]
+        watch.task.cancel()
+        try:
+            await watch.task
+        except BaseException:
+            # cancelled, or failed and reported to the streams
+            pass
+
+watches = SlotsWatches()
+
+
+async def authenticated_user(scope):
+    '''
+    The user logged in with the session cookie of the request, or None.
+    The stream is not a Django view, so only the session and authentication
+    middleware run for it, not the rest of settings.MIDDLEWARE
+    '''
+    request = ASGIRequest(scope, io.BytesIO())
+    # process_request only sets request.session and the lazy request.user
+    for middleware in (SessionMiddleware, AuthenticationMiddleware):
+        middleware(no_response).process_request(request)
+
+    def user():
+        # reads the session and the user from the database
+        return request.user if request.user.is_authenticated else None
+    return await sync_to_async(user)()
+
+
+def no_response(request):
+    # get_response of the middleware used outside of Django
+    return None
+
+
+async def send_status(send, status):
+    await send({'type': 'http.response.start', 'status': status, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def stream_slots(scope, receive, send):
+    '''
+    Server-sent events with the free time slots of a doctor on the given
+    dates: first the slots of every date, then the slots of a date with the
+    slots taken and freed whenever appointments are booked or cancelled.
+    The stream lasts until the browser closes it, so it is not a Django view:
+    Django 4.1 iterates streaming responses synchronously, which would block
+    the event loop
+    '''
+    if scope['method'] != 'GET':
+        return await send_status(send, 405) # method not allowed
+    try:
+        doctor_id, dates = parse_query(scope['query_string'])
+    except (KeyError, ValueError):
+        return await send_status(send, 400) # bad request
+    if await authenticated_user(scope) is None:
+        return await send_status(send, 403) # forbidden
+    if not await User.objects.filter(pk=doctor_id, is_doctor=True).aexists():
+        return await send_status(send, 404) # not found
+
+    key, watch, queue = watches.join(doctor_id, dates)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'Content-Type', b'text/event-stream'),
+                (b'Cache-Control', b'no-cache'),
+                # e.g. nginx would buffer the events
+                (b'X-Accel-Buffering', b'no'),
+            ],
+        })
+        await watch.ready.wait()
+        if watch.time_slots is None:
+            # the browser reconnects
+            return await send({'type': 'http.response.body', 'body': b''})
+        body = f'retry: {RETRY_MILLISECONDS}\n\n'.encode()
+        body += b''.join(slots_event(date, slots, None) for date, slots in watch.time_slots.items())
+        while not disconnect.done():
+            if body is None:
+                # the watch failed
+                return await send({'type': 'http.response.body', 'body': b''})
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            change = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {change, disconnect}, timeout=KEEPALIVE_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                change.cancel()
+                break
+            # events of several changes are sent together
+            body = change.result() if change in done else b': keep-alive\n\n'
+            change.cancel()
+            while body is not None and not queue.empty():
+                more = queue.get_nowait()
+                body = None if more is None else body + more
+    finally:
+        disconnect.cancel()
+        await watches.leave(key, watch, queue)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class LiveSlotsRouter:
+    '''
+    ASGI application serving the streams of time slots at STREAM_PATH and 
+    passing the other requests to Django
+    '''
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+            return await stream_slots(scope, receive, send)
+        return await self.application(scope, receive, send)
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import datetime
+import random
+import time
+
+from doctors.archive import archive_batch, finish
+from doctors.db import run_atomic
+from doctors.models import User, Appointment, AppointmentArchive
+
+BATCH_SIZE = 1000
+# seconds between two batches, for the bookings waiting for the write lock
+PAUSE = 0.05
+# users whose hot queries are timed
+SAMPLE_SIZE = 20
+
+
+def hot_queries_time(users, doctors):
+    '''
+    Seconds taken by the queries of the appointments page and of the booking
+    page for the sample users and doctors
+    '''
+    start = time.perf_counter()
+    for user in users:
+        list(user.upcoming_appointments(limit=11))
+    for doctor in doctors:
+        doctor.available_time_slots_by_date(doctor.working_days(datetime.date.today(), 10))
+    return time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = ('Move the past appointments to the archive in small transactions, and report the '
+            'time of the hot queries before and after. Can be stopped and run again at any time')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before', help='Archive the appointments before this date, YYYY-MM-DD, today by default')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=PAUSE, help='Seconds to wait between two batches')
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+        try:
+            before = datetime.date.fromisoformat(options['before']) if options['before'] else today
+        except ValueError:
+            raise CommandError('--before must be a date, YYYY-MM-DD.')
+        # bookings are in the future, archiving them would drop their busy slots
+        if before > today:
+            raise CommandError('Only past appointments can be archived.')
+        user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+        doctor_ids = list(User.objects.filter(is_doctor=True).order_by('id').values_list('id', flat=True))
+        rng = random.Random(0)
+        users = list(User.objects.filter(id__in=rng.sample(user_ids, min(SAMPLE_SIZE, len(user_ids)))))
+        doctors = list(User.objects.filter(
+            id__in=rng.sample(doctor_ids, min(SAMPLE_SIZE, len(doctor_ids)))))
+        # twice, the first run warms up the caches
+        hot_queries_time(users, doctors)
+        time_before = hot_queries_time(users, doctors)
+
+        moved = 0
+        started = time.perf_counter()
+        while True:
+            # a short transaction per batch, retried when a booking holds the lock
+            count = run_atomic(archive_batch, before, options['batch_size'])
+            if not count:
+                break
+            moved += count
+            self.stdout.write(f"Archived {moved} appointments.", ending='\r')
+            time.sleep(options['pause'])
+        finish(before)
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {moved} appointments before {before} in {time.perf_counter() - started:.1f}s: "
+            f"{Appointment.objects.count()} current, {AppointmentArchive.objects.count()} archived."))
+
+        time_after = hot_queries_time(users, doctors)
+        self.stdout.write(
+            f"Hot queries of {len(users)} users and {len(doctors)} doctors: "
+            f"{time_before * 1000:.1f}ms before, {time_after * 1000:.1f}ms after "
+            f"({time_before / max(time_after, 1e-9):.2f}x).")
@@ -0,0 +1,164 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+
+import datetime
+import json
+import logging
+import random
+import subprocess
+import time
+
+from doctors.models import User, Appointment
+from doctors.helpers import next_weekdays
+from doctors.schedules import DEFAULT_TIME_SLOTS
+
+# prefixes typed in the search box
+SEARCH_TERMS = ['a', 'an', 'and', 'der', 'derm', 'mar', 'maria', 'smith', 'card', 'gen', 'o', 'pe']
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(sorted_values, fraction):
+    # nearest-rank percentile
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Drive the views through the Django test client and report the p50/p95/p99 '
+            'latency and the number of queries of each scenario as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        # allow the test client host, and keep emails in memory
+        try:
+            setup_test_environment()
+        except RuntimeError:
+            # already set up, e.g. by the test runner
+            pass
+        # do not log the expected 4xx responses, e.g. booking conflicts
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+        self.rng = random.Random(options['seed'])
+        doctor_ids = list(User.objects.filter(is_doctor=True).order_by('id').values_list('id', flat=True))
+        patient_ids = list(User.objects.filter(is_doctor=False).order_by('id').values_list('id', flat=True))
+        if not doctor_ids or not patient_ids:
+            raise CommandError('No data, run the load_data script or the generate_data command.')
+        # a fixed sample of users keeps the runs comparable
+        self.doctors = self.rng.sample(doctor_ids, min(50, len(doctor_ids)))
+        self.patients = [
+            User.objects.get(pk=pk) for pk in self.rng.sample(patient_ids, min(20, len(patient_ids)))]
+        self.dates = next_weekdays(datetime.date.today(), 10)
+
+        scenarios = {
+            'search': self.search,
+            'time_availabilities': self.time_availabilities,
+            'time_availabilities_batch': self.time_availabilities_batch,
+            'appointment_book': self.appointment_book,
+            'appointments': self.appointments,
+        }
+        results = {}
+        # bookings are rolled back so that runs do not change the data
+        try:
+            with transaction.atomic():
+                for name, scenario in scenarios.items():
+                    results[name] = self.run_scenario(scenario, options['requests'])
+                raise Rollback
+        except Rollback:
+            pass
+
+        report = {
+            'commit': git_commit(),
+            'database': connection.vendor,
+            'data': {
+                'doctors': len(doctor_ids),
+                'patients': len(patient_ids),
+                'appointments': Appointment.objects.count(),
+            },
+            'requests': options['requests'],
+            'seed': options['seed'],
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_scenario(self, scenario, num_requests):
+        latencies = []
+        queries = []
+        errors = 0
+        # server errors are counted instead of raised
+        client = Client(raise_request_exception=False)
+        for i in range(num_requests):
+            client.force_login(self.patients[i % len(self.patients)])
+            method, path, data = scenario()
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                response = getattr(client, method)(path, data)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(counter.count)
+            # booking conflicts are expected
+            if response.status_code >= 400 and response.status_code != 409:
+                errors += 1
+        latencies.sort()
+        return {
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_queries': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+            'errors': errors,
+        }
+
+    # each scenario returns the (method, path, data) of a request
+    def search(self):
+        return 'get', reverse('doctors:search'), {'search_term': self.rng.choice(SEARCH_TERMS)}
+
+    def time_availabilities(self):
+        return 'get', reverse('doctors:time-slots'), {
+            'doctor_id': self.rng.choice(self.doctors),
+            'date': self.rng.choice(self.dates).strftime('%Y%m%d')}
+
+    def time_availabilities_batch(self):
+        return 'get', reverse('doctors:time-slots-batch'), {'doctor_id': self.rng.choice(self.doctors)}
+
+    def appointment_book(self):
+        return 'post', reverse('doctors:book-confirm'), {
+            'doctor_id': self.rng.choice(self.doctors),
+            'date': self.rng.choice(self.dates).strftime('%Y%m%d'),
+            'time': self.rng.choice(DEFAULT_TIME_SLOTS).strftime('%H:%M')}
+
+    def appointments(self):
+        return 'get', reverse('doctors:appointments'), {}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
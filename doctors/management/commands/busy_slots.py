@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from doctors.models import Appointment, BusySlots
+from doctors.schedules import slot_bits
+
+BATCH_SIZE = 1000
+# digits of the masks printed
+WIDTH = len(Appointment.TIME_SLOTS)
+
+
+def masks_by_date():
+    '''
+    Yields (date, {user_id: mask}) computed from the appointments, one date at
+    a time so that memory does not grow with the number of appointments
+    '''
+    appointments = Appointment.objects.order_by('date').values_list(
+        'date', 'doctor_id', 'patient_id', 'time', 'duration')
+    current_date, masks = None, {}
+    for date, doctor_id, patient_id, time, duration in appointments.iterator(chunk_size=BATCH_SIZE):
+        if date != current_date:
+            if masks:
+                yield current_date, masks
+            current_date, masks = date, {}
+        bits = slot_bits(time, duration)
+        for user_id in (doctor_id, patient_id):
+            masks[user_id] = masks.get(user_id, 0) | bits
+    if masks:
+        yield current_date, masks
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the BusySlots table from the appointments, or verify it with --verify'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Only report the rows that do not match the appointments')
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        rows = 0
+        with transaction.atomic():
+            BusySlots.objects.all().delete()
+            batch = []
+            for date, masks in masks_by_date():
+                batch.extend(
+                    BusySlots(user_id=user_id, date=date, mask=mask) for user_id, mask in masks.items())
+                if len(batch) >= BATCH_SIZE:
+                    BusySlots.objects.bulk_create(batch)
+                    rows += len(batch)
+                    batch = []
+            BusySlots.objects.bulk_create(batch)
+            rows += len(batch)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} busy slots rows."))
+
+    def verify(self):
+        mismatches = 0
+        for date, masks in masks_by_date():
+            stored = dict(BusySlots.objects.filter(date=date).values_list('user_id', 'mask'))
+            for user_id in masks.keys() | stored.keys():
+                expected, actual = masks.get(user_id, 0), stored.get(user_id, 0)
+                if expected != actual:
+                    mismatches += 1
+                    self.stdout.write(
+                        f"User {user_id} on {date}: expected {expected:0{WIDTH}b}, found {actual:0{WIDTH}b}")
+        # rows of dates without any appointment must have all slots free
+        stale = BusySlots.objects.exclude(mask=0).exclude(
+            date__in=Appointment.objects.values('date'))
+        for user_id, date, mask in stale.values_list('user_id', 'date', 'mask').iterator():
+            mismatches += 1
+            self.stdout.write(f"User {user_id} on {date}: expected {0:0{WIDTH}b}, found {mask:0{WIDTH}b}")
+        if mismatches:
+            raise CommandError(f"{mismatches} busy slots rows do not match the appointments.")
+        self.stdout.write(self.style.SUCCESS("Busy slots match the appointments."))
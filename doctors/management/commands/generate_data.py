@@ -0,0 +1,136 @@
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+import datetime
+import random
+import time
+
+from doctors.models import Specialty, User, Appointment
+from doctors.helpers import next_weekdays
+from doctors.schedules import DEFAULT_TIME_SLOTS
+from doctors.search import rebuild_index
+
+# generated users are named gen_doctor_<n> and gen_patient_<n>
+USERNAME_PREFIX = 'gen_'
+PASSWORD = 'w'
+
+SPECIALTIES = [
+    'Allergology', 'Anaesthesiology', 'Cardiology',
+    'Dentist', 'Dermatology', 'Endocrinology',
+    'General Practitioner', 'Nephrology', 'Neurology',
+    'Ophthalmologist', 'Pediatrics', 'Psychiatry',
+]
+FIRST_NAMES = [
+    'Alice', 'Bruno', 'Carla', 'Daniel', 'Elena', 'Fred', 'Gina', 'Hugo', 'Ines', 'Jaime',
+    'Karen', 'Louis', 'Maria', 'Nadia', 'Olivia', 'Peter', 'Quentin', 'Rosa', 'Susan', 'Tom',
+]
+LAST_NAMES = [
+    'Adams', 'Alvarez', 'Anderson', 'Brown', 'Coco', 'Davis', 'Diaz', 'Garcia', 'Harris',
+    'Jones', 'Martin', 'Moreau', 'Rossi', 'Sanjuan', 'Smith', 'Strong', 'Trabal', 'Vinci',
+]
+
+
+class Command(BaseCommand):
+    help = ('Generate a deterministic synthetic dataset of doctors, patients and appointments, '
+            'e.g. --doctors 50000 --patients 1000000 --appointments 10000000')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doctors', type=int, default=1000)
+        parser.add_argument('--patients', type=int, default=10000)
+        parser.add_argument('--appointments', type=int, default=50000)
+        parser.add_argument(
+            '--days', type=int, default=60, help='Number of weekdays the appointments are spread over')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--clear', action='store_true', help='Only delete previously generated data')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.clear()
+        if options['clear']:
+            return
+        dates = next_weekdays(datetime.date.today(), options['days'])
+        # generated doctors work the default schedule
+        num_slots = len(dates) * len(DEFAULT_TIME_SLOTS)
+        # appointments of each (date, time) slot are spread over distinct
+        #   doctors and patients so that no doctor or patient has two at once
+        per_slot = -(-options['appointments'] // num_slots)
+        if per_slot > min(options['doctors'], options['patients']):
+            raise CommandError('Too many appointments for the number of users, increase --days.')
+
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        specialties = self.create_specialties()
+        doctor_ids = self.create_users(rng, options['doctors'], 'doctor', specialties)
+        patient_ids = self.create_users(rng, options['patients'], 'patient', specialties)
+        self.create_appointments(rng, options['appointments'], dates, doctor_ids, patient_ids, per_slot)
+        self.rebuild_indexes()
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(doctor_ids)} doctors, {len(patient_ids)} patients and "
+            f"{options['appointments']} appointments in {time.perf_counter() - start:.1f}s."))
+
+    def clear(self):
+        # UserQuerySet.delete frees the slots of the users kept, booked with
+        #   generated users, in one query instead of one per user
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        # users deleted outside of this process may still be in the index
+        rebuild_index()
+
+    def create_specialties(self):
+        for name in SPECIALTIES:
+            Specialty.objects.get_or_create(name=name)
+        return list(Specialty.objects.order_by('id').values_list('id', flat=True))
+
+    def create_users(self, rng, count, kind, specialties):
+        # hashing the password once, instead of once per user, saves hours
+        password = make_password(PASSWORD)
+        is_doctor = kind == 'doctor'
+        for first in range(0, count, self.batch_size):
+            users = []
+            for i in range(first, min(first + self.batch_size, count)):
+                users.append(User(
+                    username=f'{USERNAME_PREFIX}{kind}_{i}',
+                    email=f'{USERNAME_PREFIX}{kind}_{i}@doctors.test',
+                    password=password,
+                    first_name=rng.choice(FIRST_NAMES),
+                    last_name=rng.choice(LAST_NAMES),
+                    is_doctor=is_doctor,
+                    specialty_id=rng.choice(specialties) if is_doctor else None,
+                    description='Generated doctor.' if is_doctor else '',
+                ))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+        return list(User.objects.filter(
+            username__startswith=f'{USERNAME_PREFIX}{kind}_').order_by('id').values_list('id', flat=True))
+
+    def create_appointments(self, rng, count, dates, doctor_ids, patient_ids, per_slot):
+        batch = []
+        created = 0
+        for date in dates:
+            for slot_time in DEFAULT_TIME_SLOTS:
+                num = min(per_slot, count - created)
+                if num <= 0:
+                    break
+                for doctor_id, patient_id in zip(
+                        rng.sample(doctor_ids, num), rng.sample(patient_ids, num)):
+                    batch.append(Appointment(
+                        doctor_id=doctor_id, patient_id=patient_id, date=date, time=slot_time))
+                created += num
+                if len(batch) >= self.batch_size:
+                    self.insert_appointments(batch)
+                    batch = []
+        self.insert_appointments(batch)
+
+    def insert_appointments(self, batch):
+        # bulk_create does not call Appointment.save, busy slots are
+        #   rebuilt at the end
+        with transaction.atomic():
+            Appointment.objects.bulk_create(batch)
+
+    def rebuild_indexes(self):
+        # bulk_create does not call User.save, which updates the search index
+        rebuild_index()
+        call_command('busy_slots', stdout=self.stdout)
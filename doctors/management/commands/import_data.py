@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+import csv
+import json
+import pathlib
+import resource
+import time
+
+from doctors.importer import Importer, PASSWORD_MODES, PREHASHED
+
+# files are imported in this order so that foreign keys can be resolved
+KINDS = ('specialties', 'doctors', 'patients', 'appointments')
+
+
+def read_rows(path):
+    '''
+    Yields the rows of a CSV file (with a header line) or a JSONL file
+    (one JSON object per line) as dictionaries, one at a time
+    '''
+    with open(path, newline='', encoding='utf-8') as f:
+        if pathlib.Path(path).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+class Command(BaseCommand):
+    help = ('Import specialties, doctors, patients and appointments from CSV or JSONL files '
+            'with bulk inserts. Columns: specialties: name; doctors: username, email, '
+            'first_name, last_name, specialty, description, picture, password; patients: '
+            'username, email, first_name, last_name, picture, password; appointments: '
+            'patient, doctor (usernames), date (YYYY-MM-DD), time (HH:MM)')
+
+    def add_arguments(self, parser):
+        for kind in KINDS:
+            parser.add_argument(f'--{kind}', metavar='FILE', help=f'CSV or JSONL file of {kind}')
+        parser.add_argument(
+            '--passwords', choices=PASSWORD_MODES, default=PREHASHED,
+            help='prehashed: the password column holds Django password hashes; '
+                 'hash: plain text passwords, hashed on import (slow); '
+                 'unusable: users set their password later with a password reset')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--batches-per-transaction', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if not any(options[kind] for kind in KINDS):
+            raise CommandError('Give at least one file to import.')
+        importer = Importer(
+            batch_size=options['batch_size'],
+            batches_per_transaction=options['batches_per_transaction'],
+            passwords=options['passwords'])
+        for kind in KINDS:
+            if not options[kind]:
+                continue
+            start = time.perf_counter()
+            try:
+                count = getattr(importer, kind)(read_rows(options[kind]))
+            except (KeyError, ValueError, IntegrityError) as e:
+                raise CommandError(f"Error importing {kind}: {e!r}")
+            elapsed = time.perf_counter() - start
+            # peak memory of the process, in MB (ru_maxrss is in KB on Linux)
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            self.stdout.write(
+                f"Imported {count} {kind} in {elapsed:.1f}s "
+                f"({count / elapsed if elapsed else 0:.0f} rows/s, peak memory {memory:.0f} MB).")
+        if importer.skipped:
+            self.stdout.write(
+                f"Skipped {importer.skipped} appointments whose doctor or patient was already busy.")
+        if importer.off_schedule:
+            self.stdout.write(
+                f"Skipped {importer.off_schedule} appointments at times their doctor does not work.")
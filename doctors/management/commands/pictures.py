@@ -0,0 +1,74 @@
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import datetime
+import pathlib
+
+from doctors.models import User
+from doctors.storage import FOLDER, content_name, is_content_addressed
+from doctors.thumbnails import FOLDER as THUMBNAILS_FOLDER
+
+# files this recent may belong to an upload in progress, they are never collected
+MIN_AGE = datetime.timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = ('Store the pictures named <username>.<ext> under content-addressed names '
+            '(the original files are kept), then delete the pictures and renditions '
+            'that no user has anymore')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Only report what would be done')
+
+    def handle(self, *args, **options):
+        self.storage = User._meta.get_field('picture').storage
+        self.dry_run = options['dry_run']
+        self.content_address()
+        self.collect()
+
+    def content_address(self):
+        stored = missing = 0
+        users = User.objects.exclude(picture='').exclude(picture=None).values_list('id', 'picture')
+        for user_id, name in users.iterator():
+            if is_content_addressed(name):
+                continue
+            if not self.storage.exists(name):
+                self.stderr.write(f"Missing picture {name}.")
+                missing += 1
+                continue
+            if not self.dry_run:
+                with self.storage.open(name, 'rb') as f:
+                    new_name = self.storage.save(content_name(File(f), name), File(f))
+                # update() does not call User.save, nothing else changes
+                User.objects.filter(id=user_id).update(picture=new_name)
+            stored += 1
+        self.stdout.write(f"Content-addressed {stored} pictures, {missing} missing.")
+
+    def collect(self):
+        pictures = set(User.objects.filter(picture__startswith=f"{FOLDER}/").values_list('picture', flat=True))
+        hashes = {pathlib.Path(name).stem for name in pictures}
+        deleted = 0
+        for name in self.files(FOLDER):
+            if name not in pictures and self.collectable(name):
+                deleted += self.delete(name)
+        for name in self.files(THUMBNAILS_FOLDER):
+            # renditions are named <picture stem>-<width>.<extension>
+            stem = pathlib.Path(name).stem.rsplit('-', 1)[0]
+            if stem not in hashes and self.collectable(name):
+                deleted += self.delete(name)
+        self.stdout.write(f"{'Would delete' if self.dry_run else 'Deleted'} {deleted} unused files.")
+
+    def files(self, folder):
+        if not self.storage.exists(folder):
+            return []
+        return [f"{folder}/{filename}" for filename in self.storage.listdir(folder)[1]]
+
+    def collectable(self, name):
+        return timezone.now() - self.storage.get_modified_time(name) > MIN_AGE
+
+    def delete(self, name):
+        if not self.dry_run:
+            self.storage.delete(name)
+        return 1
@@ -0,0 +1,113 @@
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import datetime
+import secrets
+import time
+
+from doctors.models import OutboxEmail
+
+# after a failed attempt an email is retried after
+#   RETRY_DELAY * 2 ** (attempts - 1) seconds, at most MAX_RETRY_DELAY
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 60 * 60
+# emails that failed MAX_ATTEMPTS times are dead-lettered
+MAX_ATTEMPTS = 5
+# seconds a worker has to send the emails it claimed, after which they are
+#   due again, e.g. when the worker was stopped
+CLAIM_TIMEOUT = 10 * 60
+
+
+def retry_delay(attempts):
+    return datetime.timedelta(seconds=min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+
+def record_failure(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= MAX_ATTEMPTS:
+        email.status = OutboxEmail.DEAD
+    else:
+        email.next_attempt = timezone.now() + retry_delay(email.attempts)
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+
+def claim_batch(batch_size):
+    '''
+    Claims up to batch_size due emails and returns them. The claim is a 
+    conditional update pushing back their next attempt, so the emails 
+    claimed by a worker are not due anymore for the others, which claim 
+    other emails or none
+    '''
+    now = timezone.now()
+    ids = list(OutboxEmail.objects.filter(
+        status=OutboxEmail.PENDING, next_attempt__lte=now).values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    token = secrets.token_hex(16)
+    OutboxEmail.objects.filter(id__in=ids, status=OutboxEmail.PENDING, next_attempt__lte=now).update(
+        claimed_by=token, next_attempt=now + datetime.timedelta(seconds=CLAIM_TIMEOUT))
+    return list(OutboxEmail.objects.filter(id__in=ids, claimed_by=token))
+
+
+def send_batch(batch_size, connection=None):
+    '''
+    Send up to batch_size due emails from the outbox over a single connection
+    to the email server. Returns the number of (sent, failed) emails
+    '''
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+    sent = failed = 0
+    connection = connection or get_connection()
+    try:
+        # open the connection once for the whole batch
+        connection.open()
+    except Exception as e:
+        # e.g. the email server is down, retry all the emails later
+        for email in emails:
+            record_failure(email, e)
+        return 0, len(emails)
+    try:
+        for email in emails:
+            message = EmailMessage(
+                subject=email.subject, body=email.message,
+                from_email=email.from_email, to=[email.to_email], connection=connection)
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                failed += 1
+                record_failure(email, e)
+            else:
+                sent += 1
+                email.attempts += 1
+                email.status = OutboxEmail.SENT
+                email.sent = timezone.now()
+                email.save(update_fields=['attempts', 'status', 'sent'])
+    finally:
+        connection.close()
+    return sent, failed
+
+
+class Command(BaseCommand):
+    help = 'Send the emails of the outbox, in batches over a single connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100, help='Maximum number of emails per connection')
+        parser.add_argument(
+            '--once', action='store_true', help='Send the due emails and exit instead of polling')
+        parser.add_argument(
+            '--interval', type=float, default=5, help='Seconds to wait when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} emails, {failed} failed.")
+            # a full batch means more emails may be waiting
+            if sent + failed < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from doctors.models import User
+from doctors.thumbnails import has_renditions, make_renditions
+
+
+class Command(BaseCommand):
+    help = ('Make the resized renditions of the user pictures uploaded before they '
+            'were made on upload, or of all the pictures with --force')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true', help='Remake the renditions that already exist')
+
+    def handle(self, *args, **options):
+        made = skipped = missing = 0
+        names = User.objects.exclude(picture='').exclude(picture=None).values_list('picture', flat=True)
+        for name in names.iterator():
+            if not default_storage.exists(name):
+                self.stderr.write(f"Missing picture {name}.")
+                missing += 1
+            elif not options['force'] and has_renditions(name):
+                skipped += 1
+            else:
+                make_renditions(name)
+                made += 1
+        self.stdout.write(
+            f"Made the renditions of {made} pictures, skipped {skipped} already done, "
+            f"{missing} missing.")
@@ -0,0 +1,66 @@
+import functools
+import hashlib
+import pathlib
+import re
+
+from .storage import is_content_addressed
+
+# content-addressed files never change, browsers may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# other files are revalidated with their ETag on each use
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+@functools.lru_cache(maxsize=4096)
+def file_hash(path, mtime_ns, size):
+    # the modification time and the size are part of the key so that a
+    #   modified file is hashed again
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def etag(name, path, stat):
+    '''
+    Strong ETag of the media file stored as name: the hash in the name of
+    content-addressed pictures and renditions, otherwise the hash of the content
+    '''
+    if is_content_addressed(name):
+        return f'"{pathlib.Path(name).stem}"'
+    return f'"{file_hash(path, stat.st_mtime_ns, stat.st_size)}"'
+
+
+def cache_control(name):
+    return IMMUTABLE_CACHE_CONTROL if is_content_addressed(name) else REVALIDATE_CACHE_CONTROL
+
+
+def parse_range(header, size):
+    '''
+    Returns the (first, last) byte positions of a Range header with a single
+    byte range, e.g.: 'bytes=0-499', 'bytes=500-' or 'bytes=-500', or None
+    when the header is missing or cannot be served as a single range, in
+    which case the whole file is sent.
+    Raises ValueError when the range is not satisfiable
+    '''
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # suffix range, the last bytes of the file
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('Empty suffix range.')
+        return max(0, size - length), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        # invalid ranges are ignored
+        return None
+    if first >= size:
+        raise ValueError('Range starts after the end of the file.')
+    last = min(int(last), size - 1) if last else size - 1
+    return first, last
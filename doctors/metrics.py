@@ -0,0 +1,89 @@
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    '''
+    Cumulative histogram in the Prometheus sense: counts[i] is the number of
+    observations less than or equal to buckets[i]
+    '''
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one more slot for observations above the last bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    '''
+    In-process histograms of the requests, labelled by URL name.
+    Each process (e.g. each gunicorn worker) has its own registry
+    '''
+    # name, help text and buckets of each metric
+    METRICS = (
+        ('http_request_duration_seconds', 'Total request latency.', DURATION_BUCKETS),
+        ('db_query_duration_seconds', 'Total SQL time per request.', DURATION_BUCKETS),
+        ('db_queries', 'Number of SQL queries per request.', QUERIES_BUCKETS),
+        ('template_render_duration_seconds', 'Template render time per request.', DURATION_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (metric name, url name) -> Histogram
+        self.histograms = {}
+
+    def observe(self, url_name, values):
+        '''
+        values maps metric names to the values measured for one request
+        '''
+        with self.lock:
+            for name, help_text, buckets in self.METRICS:
+                histogram = self.histograms.get((name, url_name))
+                if histogram is None:
+                    histogram = self.histograms[(name, url_name)] = Histogram(buckets)
+                histogram.observe(values[name])
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+    def render(self):
+        '''
+        Returns the histograms in the Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            for name, help_text, buckets in self.METRICS:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, url_name), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    label = f'view="{escape_label(url_name)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# registry shared by all the requests handled by this process
+registry = Registry()
@@ -0,0 +1,140 @@
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+import asyncio
+import contextvars
+import time
+
+from .metrics import registry
+
+
+class RequestTimings:
+    __slots__ = ('queries', 'sql_time', 'render_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0
+        self.render_time = 0
+
+# timings of the request being handled, if any
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+def add_query_timer(sender=None, connection=None, **kwargs):
+    '''
+    Installs time_query on a connection, once. Receiver of connection_created:
+    with async views queries run in threads of their own, whose connections
+    are not those of the thread handling the request
+    '''
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def time_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.sql_time += time.perf_counter() - start
+        timings.queries += 1
+
+
+class TimedTemplate(Template):
+    '''
+    Template of TimedDjangoTemplates, adds its render time to the timings of
+    the request
+    '''
+    def render(self, context=None, request=None):
+        timings = current_timings.get()
+        if timings is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.render_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    '''
+    Django template backend whose templates are timed by MetricsMiddleware.
+    Views render templates through the backend, the templates they include
+    are rendered by the engine and are not counted twice
+    '''
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class MetricsMiddleware:
+    '''
+    Measures the number of SQL queries, the SQL time, the template render 
+    time and the total latency of each request. Sends them to the client in
+    the Server-Timing header and aggregates them by URL name in the histograms
+    served by the metrics view.
+    Should be the first middleware so that the latency covers the others.
+    Supports both WSGI and ASGI, so that async views stay on the event loop
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django to call this middleware from the event loop
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        # templates are timed by the TimedDjangoTemplates backend
+        # queries are timed on every connection, they are only measured
+        #   while a request sets current_timings
+        connection_created.connect(add_query_timer)
+        for connection in connections.all(initialized_only=True):
+            add_query_timer(connection=connection)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.observe(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        # the context, and so the timings, is copied to the threads running
+        #   the synchronous code, e.g. the queries
+        token = current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.observe(request, response, timings, time.perf_counter() - start)
+
+    def observe(self, request, response, timings, total_time):
+        match = request.resolver_match
+        url_name = match.view_name if match else '<unresolved>'
+        registry.observe(url_name, {
+            'http_request_duration_seconds': total_time,
+            'db_query_duration_seconds': timings.sql_time,
+            'db_queries': timings.queries,
+            'template_render_duration_seconds': timings.render_time,
+        })
+        response['Server-Timing'] = (
+            f'db;dur={timings.sql_time * 1000:.2f};desc="{timings.queries} queries", '
+            f'tpl;dur={timings.render_time * 1000:.2f}, '
+            f'total;dur={total_time * 1000:.2f}')
+        return response
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# the index as it was at this migration, see doctors/search.py
+FTS_TABLE = 'doctors_doctor_search'
+
+
+def create_search_index(apps, schema_editor):
+    # the full-text index is only available on SQLite (FTS5)
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "first_name, last_name, specialty, description, "
+        "tokenize = 'unicode61 remove_diacritics 2')")
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, first_name, last_name, specialty, description) "
+        "SELECT u.id, u.first_name, u.last_name, COALESCE(s.name, ''), u.description "
+        "FROM doctors_user u LEFT JOIN doctors_specialty s ON s.id = u.specialty_id "
+        "WHERE u.is_doctor")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0002_appointment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.1.4 on 2026-10-18 06:31
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_busy_slots(apps, schema_editor):
+    Appointment = apps.get_model('doctors', 'Appointment')
+    BusySlots = apps.get_model('doctors', 'BusySlots')
+    time_slots = sorted(set(
+        datetime.time(hour, minutes) for hour, minutes in [
+            (10, 00), (10, 30), (11, 00), (11, 30), (12, 00), (14, 00), 
+            (14, 30), (15, 00), (15, 30), (16, 00), (16, 30), (17, 00)]))
+    bits = {time: 1 << index for index, time in enumerate(time_slots)}
+    masks = {}
+    appointments = Appointment.objects.values_list('doctor_id', 'patient_id', 'date', 'time')
+    for doctor_id, patient_id, date, time in appointments.iterator():
+        for user_id in (doctor_id, patient_id):
+            masks[(user_id, date)] = masks.get((user_id, date), 0) | bits[time]
+    BusySlots.objects.bulk_create(
+        [BusySlots(user_id=user_id, date=date, mask=mask) for (user_id, date), mask in masks.items()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0003_doctor_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appointment',
+            name='time',
+            field=models.TimeField(choices=[(datetime.time(10, 0), '10:00'), (datetime.time(10, 30), '10:30'), (datetime.time(11, 0), '11:00'), (datetime.time(11, 30), '11:30'), (datetime.time(12, 0), '12:00'), (datetime.time(14, 0), '14:00'), (datetime.time(14, 30), '14:30'), (datetime.time(15, 0), '15:00'), (datetime.time(15, 30), '15:30'), (datetime.time(16, 0), '16:00'), (datetime.time(16, 30), '16:30'), (datetime.time(17, 0), '17:00')]),
+        ),
+        migrations.CreateModel(
+            name='BusySlots',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('mask', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='busy_slots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'date')},
+            },
+        ),
+        migrations.RunPython(populate_busy_slots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 06:33
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0004_busy_slots'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='appointment',
+            unique_together={('patient', 'date', 'time'), ('doctor', 'date', 'time')},
+        ),
+    ]
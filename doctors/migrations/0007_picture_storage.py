@@ -0,0 +1,20 @@
+# Generated by Django 4.1.4 on 2026-10-18 06:44
+
+from django.db import migrations, models
+import doctors.models
+import doctors.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0006_outbox_email'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='picture',
+            field=models.ImageField(blank=True, null=True, storage=doctors.storage.PictureStorage(), upload_to=doctors.models.user_picture_path, validators=[doctors.models.validate_size]),
+        ),
+    ]
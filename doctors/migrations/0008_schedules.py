@@ -0,0 +1,104 @@
+# Generated by Django 4.1.4 on 2026-10-18 07:04
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import doctors.models
+
+
+# time slots of the masks before schedules, and after: every 30 minutes
+#   from 8:00 to 19:30
+OLD_TIME_SLOTS = [
+    datetime.time(hour, minutes) for hour, minutes in [
+        (10, 00), (10, 30), (11, 00), (11, 30), (12, 00), (14, 00), 
+        (14, 30), (15, 00), (15, 30), (16, 00), (16, 30), (17, 00)]]
+NEW_TIME_SLOTS = [datetime.time(8 + index // 2, index % 2 * 30) for index in range(24)]
+
+
+def remap(mask, from_slots, to_slots):
+    bits = {time: 1 << index for index, time in enumerate(to_slots)}
+    # going back, the slots missing from the old ones are dropped
+    return sum(
+        bits[time] for index, time in enumerate(from_slots) 
+        if mask & 1 << index and time in bits)
+
+def remap_busy_slots(apps, schema_editor, from_slots, to_slots):
+    BusySlots = apps.get_model('doctors', 'BusySlots')
+    rows = BusySlots.objects.exclude(mask=0).values_list('id', 'mask')
+    for mask in set(mask for _, mask in rows.iterator()):
+        BusySlots.objects.filter(mask=mask).update(mask=-remap(mask, from_slots, to_slots))
+    # negative while remapping, so that rows are not remapped twice
+    BusySlots.objects.filter(mask__lt=0).update(mask=-models.F('mask'))
+
+def forwards(apps, schema_editor):
+    remap_busy_slots(apps, schema_editor, OLD_TIME_SLOTS, NEW_TIME_SLOTS)
+
+def backwards(apps, schema_editor):
+    remap_busy_slots(apps, schema_editor, NEW_TIME_SLOTS, OLD_TIME_SLOTS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0007_picture_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('name', models.CharField(max_length=64)),
+            ],
+            options={
+                'ordering': ('date',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot_minutes', models.PositiveSmallIntegerField(choices=[(30, '30 minutes'), (60, '1 hour'), (90, '1 hour 30 minutes')], default=30)),
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='schedule', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='duration',
+            field=models.PositiveSmallIntegerField(default=30),
+        ),
+        migrations.AlterField(
+            model_name='appointment',
+            name='time',
+            field=models.TimeField(choices=[(datetime.time(8, 0), '08:00'), (datetime.time(8, 30), '08:30'), (datetime.time(9, 0), '09:00'), (datetime.time(9, 30), '09:30'), (datetime.time(10, 0), '10:00'), (datetime.time(10, 30), '10:30'), (datetime.time(11, 0), '11:00'), (datetime.time(11, 30), '11:30'), (datetime.time(12, 0), '12:00'), (datetime.time(12, 30), '12:30'), (datetime.time(13, 0), '13:00'), (datetime.time(13, 30), '13:30'), (datetime.time(14, 0), '14:00'), (datetime.time(14, 30), '14:30'), (datetime.time(15, 0), '15:00'), (datetime.time(15, 30), '15:30'), (datetime.time(16, 0), '16:00'), (datetime.time(16, 30), '16:30'), (datetime.time(17, 0), '17:00'), (datetime.time(17, 30), '17:30'), (datetime.time(18, 0), '18:00'), (datetime.time(18, 30), '18:30'), (datetime.time(19, 0), '19:00'), (datetime.time(19, 30), '19:30')]),
+        ),
+        migrations.CreateModel(
+            name='WorkingHours',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('start', models.TimeField(validators=[doctors.models.validate_on_grid])),
+                ('end', models.TimeField(validators=[doctors.models.validate_on_grid])),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hours', to='doctors.schedule')),
+            ],
+            options={
+                'ordering': ('weekday', 'start'),
+            },
+        ),
+        migrations.CreateModel(
+            name='ScheduleException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('start', models.TimeField(blank=True, null=True, validators=[doctors.models.validate_on_grid])),
+                ('end', models.TimeField(blank=True, null=True, validators=[doctors.models.validate_on_grid])),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='doctors.schedule')),
+            ],
+            options={
+                'ordering': ('date', 'start'),
+            },
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
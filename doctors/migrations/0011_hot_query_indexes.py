@@ -0,0 +1,90 @@
+# Generated by Django 4.1.4 on 2026-10-18 07:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# (table, column, name) of the single column indexes dropped: the foreign 
+#   keys of the appointments and busy slots are the first columns of 
+#   composite indexes, and an index of is_doctor does not serve 
+#   "WHERE is_doctor". The names are those Django gave them when the 
+#   fields were created
+REDUNDANT_INDEXES = [
+    ('doctors_appointment', 'doctor_id', 'doctors_appointment_doctor_id_02baa6c3'),
+    ('doctors_appointment', 'patient_id', 'doctors_appointment_patient_id_2f38b073'),
+    ('doctors_appointmentarchive', 'doctor_id', 'doctors_appointmentarchive_doctor_id_c009ebf4'),
+    ('doctors_appointmentarchive', 'patient_id', 'doctors_appointmentarchive_patient_id_764f4f04'),
+    ('doctors_busyslots', 'user_id', 'doctors_busyslots_user_id_2cdeeb79'),
+    ('doctors_user', 'is_doctor', 'doctors_user_is_doctor_e8c9f7fb'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0010_appointment_archive'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='appointment',
+                    name='doctor',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='doctor_appointments', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='appointment',
+                    name='patient',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='patient_appointments', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='appointmentarchive',
+                    name='doctor',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_doctor_appointments', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='appointmentarchive',
+                    name='patient',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_patient_appointments', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='busyslots',
+                    name='user',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='busy_slots', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='user',
+                    name='is_doctor',
+                    field=models.BooleanField(default=False),
+                ),
+            ],
+            # dropped by name, altering the fields would copy the tables on SQLite
+            database_operations=[
+                migrations.RunSQL(
+                    f'DROP INDEX IF EXISTS "{name}"',
+                    reverse_sql=f'CREATE INDEX "{name}" ON "{table}" ("{column}")')
+                for table, column, name in REDUNDANT_INDEXES
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='appointmentarchive',
+            index=models.Index(fields=['doctor', 'date', 'time'], name='archive_doctor_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentarchive',
+            index=models.Index(fields=['patient', 'date', 'time'], name='archive_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='busyslots',
+            index=models.Index(fields=['date'], name='busyslots_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_doctor', True)), fields=['specialty'], name='user_doctor_specialty_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_doctor', True)), fields=['last_name', 'first_name'], name='user_doctor_name_idx'),
+        ),
+    ]
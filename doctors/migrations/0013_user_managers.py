@@ -0,0 +1,20 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:14
+
+from django.db import migrations
+import doctors.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0012_outbox_email_claim'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', doctors.models.UserManager()),
+            ],
+        ),
+    ]
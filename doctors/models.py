@@ -1,14 +1,23 @@
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
 from django.db.utils import IntegrityError
 from django.conf import settings
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as AuthUserManager
 from django.core.validators import MinLengthValidator
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from asgiref.sync import sync_to_async
 
-import pathlib # to extract the extension of user uploaded files
+import collections
 import datetime
+import secrets
 
-from .helpers import next_weekday
+from .search import INDEXED_FIELDS, index_doctor, index_specialty
+from . import thumbnails
+from .storage import PictureStorage, content_name
+from .db import retry_when_locked
+from . import cache
+from . import schedules
 
 MAX_SIZE = 1024 * 1024 # maximum size of pictures uploaded by users
 
@@ -19,9 +28,43 @@ def validate_size(picture):
 
 # helper function to set the filename of pictures 
 def user_picture_path(instance, filename):
-# return filenames of the form username.extension, e.g.: alice.jpg
-    extension = pathlib.Path(filename).suffix
-    return f'{instance.username}{extension}'
+# return filenames of the form pictures/<hash of the content>.extension, 
+#   e.g.: pictures/9f86d0...0f00a08.jpg, so that a new picture gets a new URL
+    return content_name(instance.picture, filename)
+
+
+class SlotTaken(ValueError):
+    '''
+    Raised when booking a time slot already taken by the doctor or the patient
+    '''
+    def __init__(self, user_id, date, time):
+        self.user_id = user_id
+        super().__init__(f"User {user_id} already has an appointment on {date} at {time}.")
+
+
+# outcomes of the slots of a series of appointments (see User.book_series)
+BOOKED = 'booked'
+# free, but not booked since other slots of the series are not
+FREE = 'free'
+PAST = 'past'
+# the doctor does not work at that time
+UNAVAILABLE = 'unavailable'
+# the doctor has another appointment at that time
+TAKEN = 'taken'
+# the patient has another appointment at that time
+BUSY = 'busy'
+# overlaps an earlier slot of the series
+OVERLAP = 'overlap'
+
+
+class SeriesNotBooked(ValueError):
+    '''
+    Raised when a series of appointments is not booked, with the outcome of
+    each of its slots
+    '''
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        super().__init__(f"The series was not booked: {', '.join(outcomes)}.")
 
 
 class Specialty(models.Model):
@@ -34,35 +77,70 @@ class Specialty(models.Model):
         # capitalize the first letter of specialties
         self.name = self.name.title()
         super().save(*args, **kwargs)
+        # keep the doctor search index in sync
+        index_specialty(self)
 
     def __str__(self):
         return self.name
 
 
+class AppointmentQuerySet(models.QuerySet):
+    def delete(self, free_slots=True):
+        '''
+        Deletes the appointments and, with free_slots, frees their busy slots
+        in the same transaction, e.g. for the "delete selected" action of the
+        admin. A post_delete receiver would do it too, but Django would then
+        load and delete the appointments one at a time
+        '''
+        if not free_slots:
+            return super().delete()
+        with transaction.atomic(using=self.db):
+            freed = collections.defaultdict(int)
+            appointments = self.order_by().values_list('doctor_id', 'patient_id', 'date', 'time', 'duration')
+            for doctor_id, patient_id, date, time, duration in appointments.iterator():
+                bits = schedules.slot_bits(time, duration)
+                freed[doctor_id, date] |= bits
+                freed[patient_id, date] |= bits
+            result = super().delete()
+            BusySlots.release(freed)
+        return result
+
+
 class Appointment(models.Model):
+    # no index of their own, the unique (doctor, date, time) and (patient, 
+    #   date, time) indexes start with them
     patient = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="patient_appointments")
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="patient_appointments",
+        db_index=False)
     doctor = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="doctor_appointments")
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="doctor_appointments",
+        db_index=False)
     date = models.DateField(db_index=True)
 
-    TIME_SLOTS_SET = set(
-        datetime.time(hour, minutes) for hour, minutes in [
-            (10, 00), (10, 30), (11, 00), (11, 30), (12, 00), (14, 00), 
-            (14, 30), (15, 00), (15, 30), (16, 00), (16, 30), (17, 00)])
+    # times appointments can start at, each doctor offers those of his or her
+    #   schedule (see schedules.py)
+    TIME_SLOTS = schedules.TIME_SLOTS
+    TIME_SLOTS_SET = set(TIME_SLOTS)
+    # bit of each time slot in the BusySlots mask
+    TIME_SLOT_BITS = schedules.TIME_SLOT_BITS
     
-    TIME_CHOICES = [(time, str(time)[:-3]) for time in TIME_SLOTS_SET]
+    TIME_CHOICES = [(time, str(time)[:-3]) for time in TIME_SLOTS]
     
     time = models.TimeField(choices=TIME_CHOICES)
+    # in minutes, the slot length of the doctor when the appointment was booked
+    duration = models.PositiveSmallIntegerField(default=schedules.DEFAULT_SLOT_MINUTES)
+
+    objects = AppointmentQuerySet.as_manager()
 
     class Meta:
-        unique_together = ('patient', 'doctor', 'date', 'time')
+        # neither a doctor nor a patient can have two appointments at the same time
+        unique_together = [('doctor', 'date', 'time'), ('patient', 'date', 'time')]
         ordering = ('date', 'time')
 
     def save(self, *args, **kwargs):
-        # make sure date is a future week day
-        if self.date < next_weekday(datetime.date.today()):
-            raise ValueError(f"{self.date} is not a future week day.")
+        # make sure date is in the future
+        if self.date <= datetime.date.today():
+            raise ValueError(f"{self.date} is not a future date.")
         # check doctors are doctors
         if not self.doctor.is_doctor:
             raise ValueError(f"{self.doctor.username} is not a doctor.")
@@ -70,18 +148,226 @@ class Appointment(models.Model):
         elif self.patient == self.doctor:
             raise ValueError(f"{self.patient.username} cannot book an appointment with himself/herself.")
 
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            if self.pk is None:
+                # make sure the doctor works at that time, as the schedule
+                #   is now, not as cached by this process
+                schedule = compiled_schedule(self.doctor_id, cached=False)
+                if not schedule.offers(self.date, self.time):
+                    raise ValueError(f"{self.doctor.username} does not work on {self.date} at {self.time}.")
+                self.duration = schedule.slot_minutes
+                # check and take the slots of both the doctor and the patient,
+                #   the unique constraints are a last line of defence
+                BusySlots.take(
+                    [self.doctor_id, self.patient_id], self.date, self.time, schedule.slot_bits(self.time))
+                try:
+                    super().save(*args, **kwargs)
+                except IntegrityError:
+                    raise SlotTaken(self.doctor_id, self.date, self.time)
+            else:
+                # the doctor, patient, date or time of the appointment may have changed
+                previous = Appointment.objects.filter(pk=self.pk).values(
+                    'doctor_id', 'patient_id', 'date').first()
+                super().save(*args, **kwargs)
+                if previous:
+                    BusySlots.refresh([previous['doctor_id'], previous['patient_id']], previous['date'])
+                BusySlots.refresh([self.doctor_id, self.patient_id], self.date)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            # another appointment may still take the slot, so recompute
+            BusySlots.refresh([self.doctor_id, self.patient_id], self.date)
+        return result
 
     def __str__(self):
         return f"Patient {self.patient.username}, Doctor {self.doctor.username}: {self.date}{self.time}"
 
 
+class AppointmentArchive(models.Model):
+    '''
+    Past appointment moved out of Appointment, with the id it had, by the
+    archive_appointments command, so that the appointment table only holds 
+    the appointments that can still change. Read with the current ones 
+    through archive.py
+    '''
+    id = models.BigIntegerField(primary_key=True)
+    patient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archived_patient_appointments",
+        db_index=False)
+    doctor = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="archived_doctor_appointments",
+        db_index=False)
+    date = models.DateField(db_index=True)
+    time = models.TimeField(choices=Appointment.TIME_CHOICES)
+    duration = models.PositiveSmallIntegerField(default=schedules.DEFAULT_SLOT_MINUTES)
+    archived = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('date', 'time')
+        # the appointments of a user in order, e.g. for the calendar feed
+        indexes = [
+            models.Index(fields=['doctor', 'date', 'time'], name='archive_doctor_date_idx'),
+            models.Index(fields=['patient', 'date', 'time'], name='archive_patient_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"Patient {self.patient.username}, Doctor {self.doctor.username}: {self.date}{self.time}"
+
+
+# sent with the user_ids and the date of the busy slots that may have changed
+busy_slots_changed = Signal()
+# users whose busy slots are freed with a single update
+RELEASE_BATCH_SIZE = 500
+
+
+class BusySlots(models.Model):
+    '''
+    Time slots taken by a user on a date, either as doctor or as patient.
+    Denormalized from Appointment and kept up to date when appointments are
+    saved or deleted, so that availabilities are read from a single row.
+    Bit i of mask is set when the slot Appointment.TIME_SLOTS[i] is taken,
+    appointments longer than a slot take several bits
+    '''
+    # no index of its own, the unique (user, date) index starts with it
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="busy_slots", db_index=False)
+    date = models.DateField()
+    mask = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'date')
+        # e.g. the doctors free at a time, and the deletion of past rows
+        indexes = [models.Index(fields=['date'], name='busyslots_date_idx')]
+
+    @classmethod
+    def take(cls, user_ids, date, time, bits=None):
+        '''
+        Mark the time slot, or the slots of bits, as taken for each of the 
+        given users, raising SlotTaken if one of them has already taken one.
+        Checking and setting the bits is a single conditional update, so two
+        concurrent bookings of the same slot cannot both succeed. Call within 
+        a transaction
+        '''
+        bit = bits or Appointment.TIME_SLOT_BITS[time]
+        for user_id in user_ids:
+            if cls._set_bit_if_free(user_id, date, bit):
+                continue
+            if cls.objects.filter(user_id=user_id, date=date).exists():
+                raise SlotTaken(user_id, date, time)
+            try:
+                with transaction.atomic():
+                    cls.objects.create(user_id=user_id, date=date, mask=bit)
+            except IntegrityError:
+                # the row was created concurrently
+                if not cls._set_bit_if_free(user_id, date, bit):
+                    raise SlotTaken(user_id, date, time)
+        busy_slots_changed.send(sender=cls, user_ids=user_ids, date=date)
+
+    @classmethod
+    def take_series(cls, user_ids, bits_by_date, existing):
+        '''
+        take on several dates at once, bits_by_date maps each date to the bits
+        of the slots taken on it. existing are the (user_id, date) of the rows
+        already there, each set with a conditional update, while the missing 
+        rows are inserted together. Raises SlotTaken, or IntegrityError when a
+        missing row was created concurrently. Call within a transaction
+        '''
+        for user_id in user_ids:
+            for date, bits in bits_by_date.items():
+                if (user_id, date) in existing and not cls._set_bit_if_free(user_id, date, bits):
+                    raise SlotTaken(user_id, date, None)
+        cls.objects.bulk_create([
+            cls(user_id=user_id, date=date, mask=bits)
+            for user_id in user_ids for date, bits in bits_by_date.items()
+            if (user_id, date) not in existing])
+        for date in bits_by_date:
+            busy_slots_changed.send(sender=cls, user_ids=user_ids, date=date)
+
+    @classmethod
+    def release(cls, freed):
+        '''
+        Frees the slots of deleted appointments, freed maps (user_id, date) to
+        the bits of the slots freed. The users with the same bits freed on a
+        date are updated together. Call within a transaction
+        '''
+        users = collections.defaultdict(list)
+        for (user_id, date), bits in freed.items():
+            users[date, bits].append(user_id)
+        for (date, bits), user_ids in users.items():
+            # within the limit of variables of SQLite
+            for start in range(0, len(user_ids), RELEASE_BATCH_SIZE):
+                cls.objects.filter(user_id__in=user_ids[start:start + RELEASE_BATCH_SIZE], date=date).update(
+                    mask=models.F('mask').bitand(~bits))
+        user_ids_by_date = collections.defaultdict(list)
+        for user_id, date in freed:
+            user_ids_by_date[date].append(user_id)
+        for date, user_ids in user_ids_by_date.items():
+            busy_slots_changed.send(sender=cls, user_ids=user_ids, date=date)
+
+    @classmethod
+    def _set_bit_if_free(cls, user_id, date, bit):
+        return cls.objects.filter(user_id=user_id, date=date).annotate(
+            taken=models.F('mask').bitand(bit)).filter(taken=0).update(
+                mask=models.F('mask').bitor(bit))
+
+    @classmethod
+    def refresh(cls, user_ids, date):
+        '''
+        Recompute the masks of the given users on date from their appointments
+        '''
+        for user_id in user_ids:
+            # a union rather than an OR, which SQLite serves with the index 
+            #   of the date, reading every appointment of the day
+            slots = Appointment.objects.filter(doctor_id=user_id, date=date).order_by().values_list(
+                'time', 'duration').union(Appointment.objects.filter(
+                    patient_id=user_id, date=date).order_by().values_list('time', 'duration'), all=True)
+            cls.objects.update_or_create(
+                user_id=user_id, date=date, defaults={'mask': cls.slots_to_mask(slots)})
+        busy_slots_changed.send(sender=cls, user_ids=user_ids, date=date)
+
+    @staticmethod
+    def slots_to_mask(slots):
+        '''
+        Mask of appointments given as (time, duration in minutes)
+        '''
+        mask = 0
+        for time, duration in slots:
+            mask |= schedules.slot_bits(time, duration)
+        return mask
+
+    def __str__(self):
+        return f"{self.user_id} {self.date}: {self.mask:0{len(Appointment.TIME_SLOTS)}b}"
+
+
+class UserQuerySet(models.QuerySet):
+    def delete(self):
+        '''
+        Deletes the users and frees the busy slots of the other users of 
+        their appointments, with a single query of those appointments
+        whatever the number of users, e.g. for generate_data --clear. The
+        appointments between two deleted users go with the cascade, the
+        busy slots of both are deleted anyway
+        '''
+        with transaction.atomic(using=self.db):
+            ids = self.order_by().values('pk')
+            doctor, patient = models.Q(doctor_id__in=ids), models.Q(patient_id__in=ids)
+            Appointment.objects.filter((doctor & ~patient) | (patient & ~doctor)).delete()
+            return super().delete()
+
+
+class UserManager(AuthUserManager.from_queryset(UserQuerySet)):
+    pass
+
+
 class User(AbstractUser):
     '''
     Both doctors and patients are users but for doctors the built-in user field 
     is_doctor is true
     '''
-    is_doctor = models.BooleanField(default=False, db_index=True)
+    # filter(is_doctor=True) is "WHERE is_doctor", which an index on is_doctor
+    #   does not serve, the partial indexes of Meta do
+    is_doctor = models.BooleanField(default=False)
     
     # Only doctors have a specialty, for patients this field is null
     specialty = models.ForeignKey('Specialty', on_delete=models.SET_NULL, null=True, blank=True)
@@ -90,7 +376,8 @@ class User(AbstractUser):
 
     # Picture of the patient or doctor
     picture = models.ImageField(
-        upload_to=user_picture_path, null=True, blank=True, validators=[validate_size])
+        upload_to=user_picture_path, storage=PictureStorage(), null=True, blank=True, 
+        validators=[validate_size])
 
     # Both patients and doctors must provide their names
     first_name = models.CharField(
@@ -101,16 +388,115 @@ class User(AbstractUser):
     # Emails must be unique
     email = models.EmailField(unique=True, max_length=150)
 
+    objects = UserManager()
+
     # Two additional fields from the related_name of the Appointment model
     #   patient_appointments
     #   doctor_appointments
+    # and busy_slots from the BusySlots model
 
+    class Meta(AbstractUser.Meta):
+        # indexes of the doctors only, patients are most of the users
+        indexes = [
+            # the doctors of a specialty, e.g. for the earliest view
+            models.Index(
+                fields=['specialty'], condition=models.Q(is_doctor=True), name='user_doctor_specialty_idx'),
+            # the doctors by name, e.g. for the search without full-text index
+            models.Index(
+                fields=['last_name', 'first_name'], condition=models.Q(is_doctor=True),
+                name='user_doctor_name_idx'),
+        ]
+
+    # resized renditions of the picture for the srcset attribute of <img>
+    #   and <source> tags, made when the picture is uploaded
+    @property
+    def picture_srcset(self):
+        return thumbnails.srcset(self.picture.name, 'jpg')
+
+    @property
+    def picture_srcset_webp(self):
+        return thumbnails.srcset(self.picture.name, 'webp')
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            # the cascade would delete the appointments without 
+            #   AppointmentQuerySet.delete, leaving the slots of the other 
+            #   users taken. UserQuerySet.delete does it for many users
+            Appointment.objects.filter(models.Q(doctor_id=self.id) | models.Q(patient_id=self.id)).delete()
+            return super().delete(*args, **kwargs)
+
+    @retry_when_locked
     def book(self, patient, date, time):
+        '''
+        Returns the new appointment, or raises SlotTaken when the doctor or 
+        the patient already has an appointment at that time
+        '''
+        return Appointment.objects.create(patient=patient, doctor=self, date=date, time=time)
+
+    @retry_when_locked
+    def book_series(self, patient, slots):
+        '''
+        Books appointments with the patient at each of the (date, time) slots,
+        all of them or none. Conflicts with the appointments of the doctor and
+        of the patient are found with a single query of their busy slots, and
+        the appointments are inserted together. Returns the new appointments,
+        or raises SeriesNotBooked with the outcome of each slot
+        '''
+        if not self.is_doctor:
+            raise ValueError(f"{self.username} is not a doctor.")
+        if patient == self:
+            raise ValueError(f"{patient.username} cannot book an appointment with himself/herself.")
+        schedule = compiled_schedule(self.id, cached=False)
+        outcomes, bits_by_date, existing = self.series_outcomes(patient, slots, schedule)
+        if any(outcome != FREE for outcome in outcomes):
+            raise SeriesNotBooked(outcomes)
+        appointments = [
+            Appointment(
+                patient=patient, doctor=self, date=date, time=time, duration=schedule.slot_minutes)
+            for date, time in slots]
         try:
-            Appointment.objects.create(patient=patient, doctor=self, date=date, time=time)
-        except IntegrityError:
-            pass
+            with transaction.atomic():
+                BusySlots.take_series([self.id, patient.id], bits_by_date, existing)
+                # the unique constraints are a last line of defence
+                Appointment.objects.bulk_create(appointments)
+        except (SlotTaken, IntegrityError):
+            # booked concurrently, since the slots were checked
+            raise SeriesNotBooked(self.series_outcomes(patient, slots, schedule)[0])
+        return appointments
 
+    def series_outcomes(self, patient, slots, schedule):
+        '''
+        Returns the outcome of each of the (date, time) slots of a series of
+        appointments with the patient, FREE when it can be booked, the bits
+        of the free slots by date, and the (user_id, date) of the existing
+        busy slots of the doctor and the patient on the dates of the series
+        '''
+        today = datetime.date.today()
+        masks = {
+            (user_id, date): mask for user_id, date, mask in BusySlots.objects.filter(
+                user_id__in=[self.id, patient.id], date__in={date for date, time in slots},
+            ).values_list('user_id', 'date', 'mask')}
+        outcomes = []
+        bits_by_date = collections.defaultdict(int)
+        for date, time in slots:
+            bits = schedule.slot_bits(time) if schedule.offers(date, time) else 0
+            if date <= today:
+                outcome = PAST
+            elif not bits:
+                outcome = UNAVAILABLE
+            elif masks.get((self.id, date), 0) & bits:
+                outcome = TAKEN
+            elif masks.get((patient.id, date), 0) & bits:
+                outcome = BUSY
+            elif bits_by_date[date] & bits:
+                outcome = OVERLAP
+            else:
+                outcome = FREE
+                bits_by_date[date] |= bits
+            outcomes.append(outcome)
+        return outcomes, dict(bits_by_date), set(masks)
+
+    @retry_when_locked
     def unbook(self, patient, date, time):
         appointment = Appointment.objects.filter(patient=patient, doctor=self, date=date, time=time).first()
         if appointment:
@@ -124,30 +510,91 @@ class User(AbstractUser):
         # only doctors can suggest dates
         if not self.is_doctor:
             raise ValueError(f"{self.doctor.username} is not a doctor")
-        # include appointments where the doctor has acted as patient and booked another doctor
-        query = models.Q(date=date)
-        query_patient_doctor = models.Q(doctor=self)
-        query_patient_doctor.add(models.Q(patient=self), models.Q.OR)
-        query.add(query_patient_doctor, models.Q.AND)
+        schedule = compiled_schedule(self.id)
+        # no query on days off
+        if not schedule.starts(date):
+            return []
+        # busy slots include appointments where the doctor has acted as 
+        #   patient and booked another doctor
+        mask = self.busy_slots.filter(date=date).values_list('mask', flat=True).first()
+        return schedule.free_times(date, mask or 0)
 
-        appointments = Appointment.objects.filter(query).values()
-        appointments_times_set = set(appointment['time'] for appointment in appointments)
-        return sorted(Appointment.TIME_SLOTS_SET - appointments_times_set)
+    async def aavailable_time_slots(self, date):
+        '''
+        Async version of available_time_slots, for async views
+        '''
+        if not self.is_doctor:
+            raise ValueError(f"{self.username} is not a doctor")
+        schedule = await acompiled_schedule(self.id)
+        if not schedule.starts(date):
+            return []
+        mask = await self.busy_slots.filter(date=date).values_list('mask', flat=True).afirst()
+        return schedule.free_times(date, mask or 0)
+
+    def available_time_slots_by_date(self, dates):
+        '''
+        Returns a dictionary mapping each of the given dates to the list of 
+        Python time objects of the available slots the doctor has on that date,
+        sorted in ascending order. Makes a single query for all the dates
+        '''
+        if not self.is_doctor:
+            raise ValueError(f"{self.username} is not a doctor")
+        if not dates:
+            return {}
+        schedule = compiled_schedule(self.id)
+        masks = dict(self.busy_slots.filter(
+            date__range=(min(dates), max(dates))).values_list('date', 'mask'))
+        return {date: schedule.free_times(date, masks.get(date, 0)) for date in dates}
 
-    def upcoming_appointments(self):
+    def working_days(self, date, count):
+        '''
+        The next count days the doctor works after date
+        '''
+        return compiled_schedule(self.id).days_after(date, count)
+
+    def upcoming_appointments(self, after=None, limit=None):
+        '''
+        Returns the appointments of the user from tomorrow on, 
+        ordered by date, time and id, with their doctor, doctor specialty and
+        patient. Doctors may also have appointments as patients.
+        For keyset pagination, after is the (date, time, id) of the last 
+        appointment of the previous page
+        '''
+        query = models.Q(patient=self)
         if self.is_doctor:
-            appointments = self.doctor_appointments
-        else: 
-            appointments = self.patient_appointments
-        next_day = next_weekday(datetime.date.today())
-        return appointments.filter(date__gte=next_day).values()
+            query.add(models.Q(doctor=self), models.Q.OR)
+        # doctors may work on weekends
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        appointments = Appointment.objects.filter(query, date__gte=tomorrow)
+        if after:
+            date, time, id = after
+            query_after = models.Q(date__gt=date)
+            query_after.add(models.Q(date=date, time__gt=time), models.Q.OR)
+            query_after.add(models.Q(date=date, time=time, id__gt=id), models.Q.OR)
+            appointments = appointments.filter(query_after)
+        appointments = appointments.select_related(
+            'doctor__specialty', 'patient').order_by('date', 'time', 'id')
+        if limit:
+            appointments = appointments[:limit]
+        return appointments
 
     def slot_is_taken(self, date, time):
         '''
         Used to avoid that a patient takes two 
         appointments at the same time
         '''
-        return Appointment.objects.filter(patient=self, date=date, time=time)
+        mask = self.busy_slots.filter(date=date).values_list('mask', flat=True).first()
+        return bool((mask or 0) & Appointment.TIME_SLOT_BITS[time])
+
+    @staticmethod
+    def doctors_available_at(date, time):
+        '''
+        Returns the doctors with the given time slot free on date
+        '''
+        busy = BusySlots.objects.annotate(
+            taken=models.F('mask').bitand(Appointment.TIME_SLOT_BITS[time])).filter(
+                date=date, taken__gt=0).values('user_id')
+        return User.objects.filter(is_doctor=True).exclude(id__in=busy)
 
     def __str__(self):
         title = 'Doctor' if self.is_doctor else 'Patient'
@@ -161,4 +608,213 @@ class User(AbstractUser):
         if not self.is_doctor:
             self.specialty = None
             self.description = ''
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+        # keep the doctor search index in sync, e.g. logging in only 
+        #   updates last_login which is not indexed
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or INDEXED_FIELDS.intersection(update_fields):
+            index_doctor(self)
+
+
+class Schedule(models.Model):
+    '''
+    Weekly working hours of a doctor and length of his or her appointments.
+    Doctors without a schedule work the DEFAULT_HOURS of schedules.py.
+    Compiled, with the exceptions and the holidays, by compiled_schedules
+    '''
+    doctor = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="schedule")
+    slot_minutes = models.PositiveSmallIntegerField(
+        choices=schedules.SLOT_MINUTES_CHOICES, default=schedules.DEFAULT_SLOT_MINUTES)
+
+    def __str__(self):
+        return f"Schedule of {self.doctor.username}"
+
+
+def validate_on_grid(time):
+    if not schedules.is_on_grid(time):
+        raise ValidationError(
+            f"Choose a time between {schedules.FIRST_HOUR}:00 and {schedules.LAST_HOUR}:00 "
+            f"on a multiple of {schedules.GRID_MINUTES} minutes.")
+
+class WorkingHours(models.Model):
+    '''
+    Range of working hours of a doctor on a weekday, a day can have several
+    '''
+    WEEKDAYS = [
+        (0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), 
+        (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')]
+
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name="hours")
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAYS)
+    start = models.TimeField(validators=[validate_on_grid])
+    end = models.TimeField(validators=[validate_on_grid])
+
+    class Meta:
+        ordering = ('weekday', 'start')
+
+    def clean(self):
+        if self.start and self.end and self.start >= self.end:
+            raise ValidationError("The end must be after the start.")
+
+    def __str__(self):
+        return f"{self.get_weekday_display()} {self.start:%H:%M}-{self.end:%H:%M}"
+
+
+class ScheduleException(models.Model):
+    '''
+    Range of working hours of a doctor on a date, replacing those of the 
+    weekday and holidays. Without start and end, the doctor does not work
+    '''
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name="exceptions")
+    date = models.DateField()
+    start = models.TimeField(null=True, blank=True, validators=[validate_on_grid])
+    end = models.TimeField(null=True, blank=True, validators=[validate_on_grid])
+
+    class Meta:
+        ordering = ('date', 'start')
+
+    def clean(self):
+        if (self.start is None) != (self.end is None):
+            raise ValidationError("Set both the start and the end, or neither for a day off.")
+        if self.start and self.start >= self.end:
+            raise ValidationError("The end must be after the start.")
+
+    def __str__(self):
+        if self.start is None:
+            return f"{self.date}: day off"
+        return f"{self.date}: {self.start:%H:%M}-{self.end:%H:%M}"
+
+
+class Holiday(models.Model):
+    '''
+    Day the clinic is closed, no doctor works unless he or she has an 
+    exception on that date
+    '''
+    date = models.DateField(unique=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        ordering = ('date',)
+
+    def __str__(self):
+        return f"{self.date}: {self.name}"
+
+
+def compiled_schedules(doctor_ids, cached=True):
+    '''
+    Returns a dictionary mapping each of the doctor ids to the CompiledSchedule
+    of the doctor. Schedules are cached: the schedules, working hours, 
+    exceptions and holidays are read with four queries for all the doctors
+    missing from the cache, and the cache is invalidated when they change
+    (see signals.py). With the default in-process cache, only the process
+    making a change invalidates its entries, those of other processes
+    expire after their TTL. Bookings are validated against schedules read 
+    with cached=False, which skips the cache and refreshes it
+    '''
+    compiled = {}
+    missing = []
+    for doctor_id in doctor_ids:
+        schedule = cache.schedules.get(doctor_id) if cached else None
+        if schedule is None:
+            missing.append(doctor_id)
+        else:
+            compiled[doctor_id] = schedule
+    if not missing:
+        return compiled
+    today = datetime.date.today()
+    holidays = list(Holiday.objects.filter(date__gt=today).values_list('date', flat=True))
+    rows = Schedule.objects.filter(doctor_id__in=missing).values_list('id', 'doctor_id', 'slot_minutes')
+    slot_minutes = {schedule_id: (doctor_id, minutes) for schedule_id, doctor_id, minutes in rows}
+    hours = collections.defaultdict(list)
+    exceptions = collections.defaultdict(list)
+    if slot_minutes:
+        for schedule_id, weekday, start, end in WorkingHours.objects.filter(
+                schedule_id__in=slot_minutes).values_list('schedule_id', 'weekday', 'start', 'end'):
+            hours[schedule_id].append((weekday, start, end))
+        for schedule_id, date, start, end in ScheduleException.objects.filter(
+                schedule_id__in=slot_minutes, date__gt=today).values_list('schedule_id', 'date', 'start', 'end'):
+            exceptions[schedule_id].append((date, start, end))
+    default = schedules.compile_schedule(
+        schedules.DEFAULT_SLOT_MINUTES, schedules.DEFAULT_HOURS, [], holidays)
+    for doctor_id in missing:
+        compiled[doctor_id] = default
+    for schedule_id, (doctor_id, minutes) in slot_minutes.items():
+        compiled[doctor_id] = schedules.compile_schedule(
+            minutes, hours[schedule_id], exceptions[schedule_id], holidays)
+    for doctor_id in missing:
+        cache.schedules.set(doctor_id, compiled[doctor_id], [('doctor', doctor_id)])
+    return compiled
+
+def compiled_schedule(doctor_id, cached=True):
+    return compiled_schedules([doctor_id], cached)[doctor_id]
+
+async def acompiled_schedule(doctor_id):
+    '''
+    Async version of compiled_schedule, only leaving the event loop to compile
+    or to read a shared cache
+    '''
+    schedule = await cache.schedules.aget(doctor_id)
+    if schedule is None:
+        schedule = await sync_to_async(compiled_schedule)(doctor_id)
+    return schedule
+
+
+def new_feed_token():
+    return secrets.token_urlsafe(32)
+
+class CalendarFeed(models.Model):
+    '''
+    iCalendar feed of the appointments of a user, read by calendar clients 
+    with the secret token of its URL instead of a session. changed is set 
+    whenever the busy slots of the user change, i.e. when one of his or her
+    appointments is booked, moved or cancelled (see signals.py), and is the
+    version of the feed for conditional requests
+    '''
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="calendar_feed")
+    token = models.CharField(max_length=64, unique=True, default=new_feed_token)
+    changed = models.DateTimeField(default=timezone.now)
+
+    def reset_token(self):
+        '''
+        Gives the feed a new URL, e.g. when the previous one was shared
+        '''
+        self.token = new_feed_token()
+        self.save(update_fields=['token'])
+
+    def __str__(self):
+        return f"Calendar feed of {self.user.username}"
+
+
+class OutboxEmail(models.Model):
+    '''
+    Email waiting to be sent by the send_emails management command. 
+    Written in the same transaction as the appointment change it notifies
+    '''
+    PENDING = 'pending'
+    SENT = 'sent'
+    # failed too many times, kept for inspection in the admin
+    DEAD = 'dead'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (DEAD, 'Dead')]
+
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to_email = models.EmailField(max_length=150)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    created = models.DateTimeField(auto_now_add=True)
+    # the email is not sent before this time, pushed back after each failure
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    sent = models.DateTimeField(null=True, blank=True)
+    # token of the send_emails worker sending the email (see claim_batch)
+    claimed_by = models.CharField(max_length=32, blank=True, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+        ordering = ('next_attempt', 'id')
+
+    def __str__(self):
+        return f"{self.subject} to {self.to_email} ({self.status})"
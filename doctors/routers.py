@@ -0,0 +1,105 @@
+from django.conf import settings
+
+import asyncio
+import contextvars
+import functools
+import random
+
+# apps whose models are always read from the primary database
+PRIMARY_APPS = frozenset(('admin', 'auth', 'contenttypes', 'sessions'))
+# set on the responses of the views decorated with pin_to_primary
+PIN_COOKIE = 'read_primary'
+
+# replica read by the models of the current request, None to read from the
+#   primary. A context variable so that each thread, or each task of an
+#   asynchronous server, has its own
+replica = contextvars.ContextVar('replica', default=None)
+
+
+class ReplicaRouter:
+    '''
+    Database router sending the reads of the views decorated with
+    read_from_replica to one of the DATABASE_REPLICAS, and everything else,
+    writes, migrations, admin and authentication, to the primary
+    '''
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_APPS:
+            return 'default'
+        return replica.get() or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas are copies of the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are migrated by copying the primary
+        return db not in settings.DATABASE_REPLICAS
+
+
+def is_pinned(request):
+    '''
+    True when the user made a change a replica may not have yet
+    '''
+    return PIN_COOKIE in request.COOKIES
+
+
+def read_from_replica(view):
+    '''
+    Decorator of read only views, whose queries go to a replica picked at
+    random, unless the user is pinned to the primary. Put it below
+    login_required, so that the user is authenticated on the primary.
+    Also decorates async views: the replica is copied with the context to
+    the threads running their queries
+    '''
+    def use_replica(request):
+        return bool(settings.DATABASE_REPLICAS) and not is_pinned(request)
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if not use_replica(request):
+                return await view(request, *args, **kwargs)
+            token = replica.set(random.choice(settings.DATABASE_REPLICAS))
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                replica.reset(token)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not use_replica(request):
+            return view(request, *args, **kwargs)
+        token = replica.set(random.choice(settings.DATABASE_REPLICAS))
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            replica.reset(token)
+    return wrapper
+
+
+def pin_to_primary(view):
+    '''
+    Decorator of views that write, pinning the user to the primary for
+    REPLICA_PIN_SECONDS after a successful response, longer than the
+    replicas take to catch up, so that users read their own writes
+    '''
+    def pin(response):
+        if settings.DATABASE_REPLICAS and response.status_code < 400:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            return pin(await view(request, *args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return pin(view(request, *args, **kwargs))
+    return wrapper
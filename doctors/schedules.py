@@ -0,0 +1,182 @@
+import bisect
+import datetime
+
+# Appointments start on a grid of GRID_MINUTES minutes, from FIRST_HOUR to
+#   LAST_HOUR. Bit i of the BusySlots masks is the grid slot TIME_SLOTS[i]
+GRID_MINUTES = 30
+FIRST_HOUR = 8
+LAST_HOUR = 20
+TIME_SLOTS = [
+    datetime.time(minutes // 60, minutes % 60)
+    for minutes in range(FIRST_HOUR * 60, LAST_HOUR * 60, GRID_MINUTES)]
+TIME_SLOT_BITS = {time: 1 << index for index, time in enumerate(TIME_SLOTS)}
+
+# lengths of the appointments doctors can choose, multiples of GRID_MINUTES
+SLOT_MINUTES_CHOICES = [(30, '30 minutes'), (60, '1 hour'), (90, '1 hour 30 minutes')]
+
+# working hours of the doctors without a schedule, Monday to Friday,
+#   (weekday, start, end) with Monday as 0
+DEFAULT_SLOT_MINUTES = 30
+DEFAULT_HOURS = [
+    (weekday, start, end) for weekday in range(5) for start, end in [
+        (datetime.time(10, 00), datetime.time(12, 30)),
+        (datetime.time(14, 00), datetime.time(17, 30))]]
+
+# days looked ahead for the next working day of a doctor
+HORIZON_DAYS = 366
+
+
+def grid_index(time, round_up=False):
+    '''
+    Index of the grid slot starting at time, rounded down, or up with
+    round_up, when time is not on the grid, e.g. 10:10 is 10:00 or 10:30
+    '''
+    minutes = time.hour * 60 + time.minute - FIRST_HOUR * 60
+    if round_up:
+        minutes += GRID_MINUTES - 1
+    return min(max(minutes // GRID_MINUTES, 0), len(TIME_SLOTS))
+
+def is_on_grid(time):
+    return time in TIME_SLOT_BITS or time == datetime.time(LAST_HOUR)
+
+def slot_bits(time, minutes):
+    '''
+    Mask of the grid slots covered by an appointment of the given length
+    starting at time
+    '''
+    units = max(minutes // GRID_MINUTES, 1)
+    return ((1 << units) - 1) * TIME_SLOT_BITS[time]
+
+def starts_mask(ranges, slot_minutes):
+    '''
+    Mask of the grid slots at which appointments of slot_minutes start, one
+    after the other from the start of each (start, end) range of working hours
+    '''
+    units = slot_minutes // GRID_MINUTES
+    mask = 0
+    for start, end in ranges:
+        first, last = grid_index(start, round_up=True), grid_index(end)
+        for index in range(first, last - units + 1, units):
+            mask |= 1 << index
+    return mask
+
+# time slots of the doctors without a schedule, on the days they work
+DEFAULT_TIME_SLOTS = [
+    time for time in TIME_SLOTS if TIME_SLOT_BITS[time] & starts_mask(
+        [(start, end) for weekday, start, end in DEFAULT_HOURS if weekday == 0], DEFAULT_SLOT_MINUTES)]
+
+
+class CompiledSchedule:
+    '''
+    Schedule of a doctor compiled into the mask of the grid slots at which
+    appointments start, for each weekday and for each exception date, so
+    that availabilities are computed with bit operations on the BusySlots
+    masks. Built by compile_schedule, cached by models.compiled_schedules
+    '''
+    def __init__(self, slot_minutes, weekday_masks, exceptions, holidays):
+        self.slot_minutes = slot_minutes
+        self.units = slot_minutes // GRID_MINUTES
+        # Monday first
+        self.weekday_masks = tuple(weekday_masks)
+        # date -> mask, 0 when the doctor does not work that day
+        self.exceptions = dict(exceptions)
+        # days off, whatever the weekday
+        self.closed = frozenset(
+            [date for date in holidays if date not in self.exceptions] +
+            [date for date, mask in self.exceptions.items() if not mask])
+        # days worked, whatever the weekday
+        self.extra_days = sorted(date for date, mask in self.exceptions.items() if mask)
+        # days from each weekday to the next weekday worked, None if none
+        self.skips = tuple(
+            next((days for days in range(1, 8) if self.weekday_masks[(weekday + days) % 7]), None)
+            for weekday in range(7))
+        # starts mask -> ((time, bits of the grid slots covered), ...), with
+        #   the 0 mask of the closed days, e.g. holidays of doctors working
+        #   every day of the week
+        self.slots = {
+            mask: tuple(
+                (time, slot_bits(time, slot_minutes)) for time in TIME_SLOTS
+                if mask & TIME_SLOT_BITS[time])
+            for mask in {0, *self.weekday_masks, *self.exceptions.values()}}
+
+    def starts(self, date):
+        '''
+        Mask of the grid slots at which appointments start on date
+        '''
+        mask = self.exceptions.get(date)
+        if mask is not None:
+            return mask
+        if date in self.closed:
+            return 0
+        return self.weekday_masks[date.weekday()]
+
+    def offers(self, date, time):
+        return bool(self.starts(date) & TIME_SLOT_BITS.get(time, 0))
+
+    def slot_bits(self, time):
+        return slot_bits(time, self.slot_minutes)
+
+    def free_times(self, date, busy_mask):
+        '''
+        Sorted times of the appointments that can be booked on date, given the
+        mask of the grid slots already taken
+        '''
+        return [time for time, bits in self.slots[self.starts(date)] if not busy_mask & bits]
+
+    def next_day(self, date):
+        '''
+        The first day worked after date, None if there is none
+        '''
+        day = None
+        skip = self.skips[date.weekday()]
+        if skip is not None:
+            day = date + datetime.timedelta(days=skip)
+            while day in self.closed:
+                day += datetime.timedelta(days=self.skips[day.weekday()])
+        index = bisect.bisect_right(self.extra_days, date)
+        if index < len(self.extra_days) and (day is None or self.extra_days[index] < day):
+            day = self.extra_days[index]
+        return day
+
+    def days_after(self, date, count):
+        '''
+        The next count days worked after date, fewer if there are none within
+        HORIZON_DAYS
+        '''
+        end = date + datetime.timedelta(days=HORIZON_DAYS)
+        days = []
+        day = self.next_day(date)
+        while day is not None and day <= end and len(days) < count:
+            days.append(day)
+            day = self.next_day(day)
+        return days
+
+    def days_between(self, start, end):
+        '''
+        The days worked from start to end, both included
+        '''
+        days = []
+        day = self.next_day(start - datetime.timedelta(days=1))
+        while day is not None and day <= end:
+            days.append(day)
+            day = self.next_day(day)
+        return days
+
+
+def compile_schedule(slot_minutes, hours, exceptions, holidays):
+    '''
+    Returns the CompiledSchedule of working hours given as (weekday, start,
+    end), exceptions as (date, start, end) with start and end None on days
+    off, and holidays as dates
+    '''
+    weekday_masks = [
+        starts_mask([(start, end) for day, start, end in hours if day == weekday], slot_minutes)
+        for weekday in range(7)]
+    exception_ranges = {}
+    for date, start, end in exceptions:
+        ranges = exception_ranges.setdefault(date, [])
+        if start is not None and end is not None:
+            ranges.append((start, end))
+    exception_masks = {
+        date: starts_mask(ranges, slot_minutes) for date, ranges in exception_ranges.items()}
+    return CompiledSchedule(slot_minutes, weekday_masks, exception_masks, holidays)
@@ -0,0 +1,169 @@
+from django.db import connection, connections, router, transaction
+from django.db.models import Q
+from django.contrib.auth import get_user_model
+
+import re
+
+from .suggest import normalize
+
+# Full-text index of doctors used by the search view.
+# On SQLite it is an FTS5 virtual table whose rowid is the id of the doctor,
+# other database backends fall back to a case insensitive LIKE query.
+FTS_TABLE = 'doctors_doctor_search'
+
+# maximum number of doctors returned by a search
+MAX_RESULTS = 50
+
+# user fields that require updating the index when saved
+INDEXED_FIELDS = frozenset(
+    ('first_name', 'last_name', 'specialty', 'description', 'is_doctor'))
+
+# column weights used to rank results with bm25:
+#   first_name, last_name, specialty, description
+RANK_WEIGHTS = (10.0, 10.0, 5.0, 1.0)
+
+
+def fts_available():
+    return connection.vendor == 'sqlite'
+
+
+def populate_index_sql():
+    # the index is created by migration 0003
+    return (f"INSERT INTO {FTS_TABLE} (rowid, first_name, last_name, specialty, description) "
+            "SELECT u.id, u.first_name, u.last_name, COALESCE(s.name, ''), u.description "
+            "FROM doctors_user u LEFT JOIN doctors_specialty s ON s.id = u.specialty_id "
+            "WHERE u.is_doctor")
+
+
+def index_doctor(user):
+    '''
+    Add, update or remove the index entry of the given user.
+    Only doctors are indexed
+    '''
+    if not fts_available():
+        return
+    specialty = user.specialty.name if user.specialty else ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [user.id])
+        if user.is_doctor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, first_name, last_name, specialty, description) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [user.id, user.first_name, user.last_name, specialty, user.description])
+
+
+def unindex_doctor(user_id):
+    '''
+    Remove the index entry of a deleted user
+    '''
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [user_id])
+
+
+def index_new_doctors(rows):
+    '''
+    Bulk version of index_doctor for doctors created without calling 
+    User.save, e.g. with bulk_create. rows are tuples of
+    (id, first_name, last_name, specialty name, description)
+    '''
+    if not fts_available() or not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, first_name, last_name, specialty, description) "
+            "VALUES (%s, %s, %s, %s, %s)", rows)
+
+
+def index_specialty(specialty):
+    '''
+    Update the specialty name of all the doctors of the given specialty
+    '''
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {FTS_TABLE} SET specialty = %s WHERE rowid IN "
+            "(SELECT id FROM doctors_user WHERE is_doctor AND specialty_id = %s)",
+            [specialty.name, specialty.id])
+
+
+def unindex_specialty():
+    '''
+    Clear the specialty name of the doctors without a specialty, e.g. once
+    their specialty is deleted
+    '''
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {FTS_TABLE} SET specialty = '' WHERE specialty != '' AND rowid IN "
+            "(SELECT id FROM doctors_user WHERE is_doctor AND specialty_id IS NULL)")
+
+
+def rebuild_index():
+    '''
+    Rebuild the whole index from the users, e.g. after users are created or
+    deleted in bulk without User.save or the delete signals
+    '''
+    if not fts_available():
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(populate_index_sql())
+
+
+def match_expression(search_term):
+    '''
+    Convert a search term into an FTS5 query where every word is
+    prefix matched, e.g.: 'mar derm' -> '"mar"* "derm"*'
+    '''
+    words = re.findall(r'\w+', search_term.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_key(search_term):
+    '''
+    Normalized form of a search term, the same for the terms that return 
+    the same doctors, e.g.: 'Inés  Mar' and 'ines mar'. Used as cache key
+    '''
+    if fts_available():
+        return match_expression(normalize(search_term))
+    return search_term.lower()
+
+def search_words(search_term):
+    '''
+    Words of a search term, lowercased and without diacritics.
+    A doctor can only match the term when each word is a substring of the 
+    normalized text of the doctor
+    '''
+    return re.findall(r'\w+', normalize(search_term))
+
+def search_doctor_ids(search_term, limit=MAX_RESULTS):
+    '''
+    Returns the ids of the doctors that match the search term,
+    most relevant first
+    '''
+    if fts_available():
+        expression = match_expression(search_term)
+        if not expression:
+            return []
+        weights = ', '.join(str(weight) for weight in RANK_WEIGHTS)
+        # the database the users are read from, e.g. a replica
+        using = router.db_for_read(get_user_model())
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s",
+                [expression, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    # fallback for database backends without FTS5
+    query = Q(first_name__icontains=search_term)
+    query.add(Q(last_name__icontains=search_term), Q.OR)
+    query.add(Q(specialty__name__icontains=search_term), Q.OR)
+    query.add(Q(description__icontains=search_term), Q.OR)
+    doctors = get_user_model().objects.filter(query, is_doctor=True).order_by(
+        'last_name', 'first_name').values_list('id', flat=True)
+    return list(doctors[:limit])
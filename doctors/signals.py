@@ -0,0 +1,132 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import (
+    User, Specialty, Appointment, BusySlots, Schedule, WorkingHours, ScheduleException, Holiday, CalendarFeed,
+    busy_slots_changed)
+from .search import INDEXED_FIELDS, unindex_doctor, unindex_specialty
+from .suggest import normalize
+from . import cache
+from . import live
+from . import suggest
+
+# user fields shown in the search results
+SEARCH_RESULT_FIELDS = INDEXED_FIELDS | {'picture'}
+
+#
+# Keep the search index and the typeahead suggestions trie in sync with the
+#   database, User.save and Specialty.save index the changes
+#
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # e.g. logging in only updates last_login
+    if update_fields is None or INDEXED_FIELDS.intersection(update_fields):
+        suggest.set_doctor(instance)
+    if update_fields is None or SEARCH_RESULT_FIELDS.intersection(update_fields):
+        text = doctor_text(instance) if instance.is_doctor else None
+        # the cached results are dropped once the change is visible to 
+        #   other connections, or not at all if it is rolled back
+        transaction.on_commit(lambda: invalidate_doctor(instance.id, text))
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    unindex_doctor(instance.id)
+    suggest.suggestions.remove((suggest.DOCTOR, instance.id))
+    transaction.on_commit(lambda: invalidate_doctor(instance.id, None))
+
+@receiver(post_save, sender=Specialty)
+def specialty_saved(sender, instance, **kwargs):
+    suggest.set_specialty(instance)
+    name = normalize(instance.name)
+    transaction.on_commit(lambda: invalidate_specialty(instance.id, name))
+
+@receiver(post_delete, sender=Specialty)
+def specialty_deleted(sender, instance, **kwargs):
+    # the doctors of the specialty have none anymore (SET_NULL)
+    unindex_specialty()
+    suggest.suggestions.remove((suggest.SPECIALTY, instance.id))
+    transaction.on_commit(lambda: invalidate_specialty(instance.id, None))
+
+#
+# Drop the cached results of the search and time_availabilities views
+#   affected by a change
+#
+@receiver(busy_slots_changed, sender=BusySlots)
+def slots_changed(sender, user_ids, date, **kwargs):
+    # appointments were booked, moved or cancelled. Patients may be doctors
+    #   who booked another doctor, so their availabilities change too
+    keys = [cache.slots_key(user_id, date) for user_id in user_ids]
+    transaction.on_commit(lambda: [cache.time_slots.delete(key) for key in keys])
+
+#
+# Push the changes of the time slots to the open booking pages
+#
+@receiver(busy_slots_changed, sender=BusySlots)
+def push_slots(sender, user_ids, date, **kwargs):
+    # wake up the streams of the booking pages of the doctor (see live.py)
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: live.broker.publish(user_ids, date))
+
+#
+# Bump the version of the calendar feeds of the users whose appointments
+#   changed, in the same transaction as the change
+#
+@receiver(busy_slots_changed, sender=BusySlots)
+def touch_calendar_feeds(sender, user_ids, date, **kwargs):
+    CalendarFeed.objects.filter(user_id__in=list(user_ids)).update(changed=timezone.now())
+
+#
+# Recompile the schedules of the doctors when they change
+#
+@receiver([post_save, post_delete], sender=Schedule)
+def schedule_changed(sender, instance, **kwargs):
+    doctor_id = instance.doctor_id
+    transaction.on_commit(lambda: invalidate_schedule(doctor_id))
+
+@receiver([post_save, post_delete], sender=WorkingHours)
+@receiver([post_save, post_delete], sender=ScheduleException)
+def schedule_part_changed(sender, instance, **kwargs):
+    doctor_id = Schedule.objects.filter(pk=instance.schedule_id).values_list('doctor_id', flat=True).first()
+    if doctor_id is not None:
+        transaction.on_commit(lambda: invalidate_schedule(doctor_id))
+
+@receiver([post_save, post_delete], sender=Holiday)
+def holiday_changed(sender, instance, **kwargs):
+    # every doctor is affected
+    transaction.on_commit(lambda: [cache.schedules.clear(), cache.time_slots.clear()])
+
+def invalidate_schedule(doctor_id):
+    cache.schedules.delete(doctor_id)
+    cache.time_slots.delete_tag(('doctor', doctor_id))
+    # the open booking pages of the doctor show other time slots
+    live.broker.publish([doctor_id], None)
+
+def doctor_text(doctor):
+    specialty = doctor.specialty.name if doctor.specialty else ''
+    return normalize(' '.join((doctor.first_name, doctor.last_name, specialty, doctor.description)))
+
+def invalidate_doctor(doctor_id, text):
+    '''
+    Drops the cached searches that returned the doctor, and when text, the 
+    normalized text of the doctor, is given, the searches that may return 
+    the doctor now. Also drops the cached time slots of the doctor, e.g. 
+    when the user is not a doctor anymore
+    '''
+    cache.search_results.delete_tag(('doctor', doctor_id))
+    if text is not None:
+        cache.search_results.delete_where(
+            lambda key, entry: all(word in text for word in entry[2]))
+    cache.time_slots.delete_tag(('doctor', doctor_id))
+
+def invalidate_specialty(specialty_id, name):
+    '''
+    Drops the cached searches that returned doctors of the specialty, and 
+    when name, the normalized name of the specialty, is given, the searches
+    that may return doctors of the specialty now
+    '''
+    cache.search_results.delete_tag(('specialty', specialty_id))
+    if name is not None:
+        cache.search_results.delete_where(
+            lambda key, entry: any(word in name for word in entry[2]))
@@ -118,13 +118,62 @@ function searchDoctors(event) {
         });
 }
 
+// Typeahead: show the suggestions for the text typed in the search box, and 
+// only run the full search (searchDoctors) when the user commits to a 
+// suggestion or presses enter
+let current_suggestions = [];
+function suggestDoctors(event) {
+    const datalist = document.querySelector('#suggestions');
+    const prefix = event.target.value.trim();
+    if (prefix === '') {
+        // clear any previous suggestions and results
+        datalist.innerHTML = "";
+        current_suggestions = [];
+        searchDoctors(event);
+        return;
+    }
+    // the user picked one of the suggestions
+    if (event.inputType === 'insertReplacementText' || current_suggestions.includes(prefix)) {
+        searchDoctors(event);
+        return;
+    }
+    const ENDPOINT = "/search/suggest";
+    const api_path = `${ENDPOINT}?prefix=${encodeURIComponent(prefix)}`;
+    fetch(api_path)
+        .then(response => {
+            if (response.status !== 200) {
+                throw new Error(`Got response status code ${response.status}`);
+            } else {
+                return response.json();
+            }
+        })
+        .then(({suggestions}) => {
+            datalist.innerHTML = "";
+            current_suggestions = [];
+            suggestions.forEach(({text}) => {
+                const option = document.createElement('option');
+                // text is escaped by the server
+                option.innerHTML = text;
+                current_suggestions.push(option.value);
+                datalist.append(option);
+            });
+        })
+        .catch((error) => {
+            console.log(`GET request to ${ENDPOINT} error:\n${error}`);
+        });
+}
+
 // used to display each of the search results
-function buildDoctorCard({doctor_id, doctor_name, doctor_specialty, doctor_img}) {
+function buildDoctorCard({doctor_id, doctor_name, doctor_specialty, doctor_img, doctor_srcset, doctor_srcset_webp}) {
     const doctor_card = document.createElement('div');
     doctor_card.className = "card card-doctor-results mb-3";
     doctor_card.innerHTML = `<div class="row g-0" onclick="location.href='/book/${doctor_id}';">
         <div class="col-sm-3">
-            <img src="/images/${doctor_img}" class="img-fluid rounded-start">
+            <picture>
+                <source type="image/webp" srcset="${doctor_srcset_webp}" sizes="(min-width: 576px) 135px, 240px">
+                <img src="/images/${doctor_img}" srcset="${doctor_srcset}" sizes="(min-width: 576px) 135px, 240px"
+                     class="img-fluid rounded-start">
+            </picture>
         </div>
         <div class="col-sm-9">
             <div class="card-body">
@@ -169,6 +218,13 @@ function getAvailabilities(event, doctor_id, date) {
         card.querySelector(".bi-chevron-down").classList.remove('hidden');
         card.querySelector('.time-slots').innerHTML = '';
     }
+    // time slots already fetched, kept up to date by watchAvailabilities
+    //   while its stream is open, otherwise only for a short while
+    const cached = availabilities_cache.get(date);
+    if (cached && (availabilities_live || Date.now() - cached.fetched < AVAILABILITIES_MAX_AGE)) {
+        showTimeSlots(card, cached.time_slots);
+        return;
+    }
     // fetch time slots for the given date
     const ENDPOINT = "/book/slots";
     const api_path = `${ENDPOINT}?doctor_id=${encodeURIComponent(doctor_id)}&date=${encodeURIComponent(date)}`;
@@ -181,28 +237,147 @@ function getAvailabilities(event, doctor_id, date) {
             }
         })
         .then(({time_slots}) => {
-            // mark the text that matched the searh terms
-            const container = card.querySelector('.time-slots');
-            container.innerHTML = '';
-            time_slots.forEach(time_slot => {
-                const time_box = document.createElement('div');
-                time_box.setAttribute("data-bs-toggle", "modal");
-                time_box.setAttribute("data-bs-target", "#ConfirmBookingModal");
-                time_box.className = 'time-box';
-                time_box.textContent = time_slot;
-                time_box.onclick = initializeConfirmBookingModal;
-                container.append(time_box);
-            });
+            availabilities_cache.set(date, {time_slots, fetched: Date.now()});
+            showTimeSlots(card, time_slots);
+        })
+        .catch((error) => {
+            console.log(`GET request to ${ENDPOINT} error:\n${error}`);
+        });
+}
+
+// Cache filled by loadAvailabilities with the time slots of all the dates
+// displayed on the booking page and when they were fetched, e.g.: 
+// '20240125' -> {time_slots: ['10:00', '10:30'], fetched: 1706170000000}
+const availabilities_cache = new Map();
+// milliseconds the cached time slots are used for when they are not kept
+// up to date by the stream of watchAvailabilities, e.g. under WSGI
+const AVAILABILITIES_MAX_AGE = 30000;
+// whether the stream of watchAvailabilities is open
+let availabilities_live = false;
+function loadAvailabilities(doctor_id) {
+    const ENDPOINT = "/book/availabilities";
+    const api_path = `${ENDPOINT}?doctor_id=${encodeURIComponent(doctor_id)}`;
+    fetch(api_path)
+        .then(response => {
+            if (response.status !== 200) {
+                throw new Error(`Got response status code ${response.status}`);
+            } else {
+                return response.json();
+            }
+        })
+        .then(({availabilities}) => {
+            const fetched = Date.now();
+            for (const [date, time_slots] of Object.entries(availabilities)) {
+                availabilities_cache.set(date, {time_slots, fetched});
+            }
         })
         .catch((error) => {
             console.log(`GET request to ${ENDPOINT} error:\n${error}`);
         });
 }
 
+// Server-sent events with the time slots of the dates of the booking page,
+// sent when they are booked or cancelled by other users: the cache and the
+// open cards are updated in place. Only served when the project runs under 
+// ASGI, without it the cached slots expire after AVAILABILITIES_MAX_AGE
+function watchAvailabilities(doctor_id) {
+    const cards = document.querySelectorAll('.booking');
+    const dates = Array.from(cards, card => card.dataset.date);
+    const ENDPOINT = "/book/slots/stream";
+    const api_path = `${ENDPOINT}?doctor_id=${encodeURIComponent(doctor_id)}&dates=${dates.join(',')}`;
+    const source = new EventSource(api_path);
+    let interrupted = false;
+    source.onopen = () => {
+        // the changes sent while the stream was down were missed
+        if (interrupted) {
+            loadAvailabilities(doctor_id);
+        }
+        availabilities_live = true;
+    };
+    source.addEventListener('slots', event => {
+        const {date, time_slots, taken} = JSON.parse(event.data);
+        availabilities_cache.set(date, {time_slots, fetched: Date.now()});
+        const card = document.querySelector(`.booking[data-date="${date}"]`);
+        if (card) {
+            patchTimeSlots(card, time_slots);
+        }
+        // the slot the user is about to confirm was just taken
+        if (taken && document.querySelector('#dateId').value === date
+                && taken.includes(document.querySelector('#timeId').value)) {
+            const button = document.querySelector('#confirm_booking');
+            button.disabled = true;
+            button.textContent = 'No longer available';
+        }
+    });
+    source.onerror = () => {
+        // the cache is no longer kept up to date, the browser reconnects by
+        //   itself unless the stream is not served
+        availabilities_live = false;
+        interrupted = true;
+        if (source.readyState === EventSource.CLOSED) {
+            console.log(`GET request to ${ENDPOINT} failed`);
+        }
+    };
+}
+
+// display the time slots of a date card of the booking page
+function showTimeSlots(card, time_slots) {
+    const container = card.querySelector('.time-slots');
+    container.innerHTML = '';
+    if (card.classList.contains('closed')) {
+        return;
+    }
+    time_slots.forEach(time_slot => {
+        container.append(buildTimeBox(time_slot));
+    });
+}
+
+// update the time slots displayed by a date card: remove the boxes of the
+// slots taken and insert those of the slots freed, leaving the others alone
+function patchTimeSlots(card, time_slots) {
+    if (card.classList.contains('closed')) {
+        return;
+    }
+    const container = card.querySelector('.time-slots');
+    const boxes = new Map(Array.from(container.children, box => [box.textContent, box]));
+    boxes.forEach((box, time_slot) => {
+        if (!time_slots.includes(time_slot)) {
+            box.remove();
+        }
+    });
+    // time slots are sorted
+    let previous = null;
+    time_slots.forEach(time_slot => {
+        let box = boxes.get(time_slot);
+        if (!box) {
+            box = buildTimeBox(time_slot);
+            if (previous) {
+                previous.after(box);
+            } else {
+                container.prepend(box);
+            }
+        }
+        previous = box;
+    });
+}
+
+function buildTimeBox(time_slot) {
+    const time_box = document.createElement('div');
+    time_box.setAttribute("data-bs-toggle", "modal");
+    time_box.setAttribute("data-bs-target", "#ConfirmBookingModal");
+    time_box.className = 'time-box';
+    time_box.textContent = time_slot;
+    time_box.onclick = initializeConfirmBookingModal;
+    return time_box;
+}
+
 function initializeConfirmBookingModal(event) {
     const chosenTime = event.target.textContent;
     document.querySelector('#time').textContent = chosenTime;
     document.querySelector('#timeId').value = chosenTime;
+    const button = document.querySelector('#confirm_booking');
+    button.disabled = false;
+    button.textContent = 'Yes, book it';
 }
 
 function confirmBooking(event) {
@@ -236,6 +411,32 @@ function initializeConfirmCancellationModal(event) {
     document.querySelector('#appointmentId').value = event.target.dataset.appointmentId;
 }
 
+// keyset pagination: append the next page of appointments
+function loadMoreAppointments(event) {
+    const button = event.currentTarget;
+    const ENDPOINT = "/appointments/more";
+    const api_path = `${ENDPOINT}?after=${encodeURIComponent(button.dataset.cursor)}`;
+    fetch(api_path)
+        .then(response => {
+            if (response.status !== 200) {
+                throw new Error(`Got response status code ${response.status}`);
+            } else {
+                return response.json();
+            }
+        })
+        .then(({html, next_cursor}) => {
+            document.querySelector('#appointments-container').insertAdjacentHTML('beforeend', html);
+            if (next_cursor) {
+                button.dataset.cursor = next_cursor;
+            } else {
+                button.classList.add('hidden');
+            }
+        })
+        .catch((error) => {
+            console.log(`GET request to ${ENDPOINT} error:\n${error}`);
+        });
+}
+
 function confirmCancellation() {
     const form = document.querySelector('#appointment-cancel-form');
     ENDPOINT = "/appointments/cancel"; 
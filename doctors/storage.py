@@ -0,0 +1,93 @@
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils.deconstruct import deconstructible
+
+import hashlib
+import os
+import pathlib
+import re
+import tempfile
+
+from .thumbnails import FOLDER as THUMBNAILS_FOLDER, delete_renditions
+
+# pictures are stored in this folder of the media root, named by the
+#   SHA-256 of their content, e.g.: pictures/9f86d0...0f00a08.jpg
+FOLDER = 'pictures'
+# names of the pictures stored by hash and of their renditions, named
+#   <hash>-<width>. Renditions of the pictures stored before content 
+#   addressing, e.g. thumbnails/alice-64.jpg, are rewritten in place
+CONTENT_ADDRESSED_RE = re.compile(
+    rf'^(?:{FOLDER}/[0-9a-f]{{64}}|{THUMBNAILS_FOLDER}/[0-9a-f]{{64}}-\d+)\.\w+$')
+
+
+def content_name(file, filename):
+    '''
+    Storage name of an uploaded file, from the hash of its content and the
+    extension of its filename. A file with another content has another name,
+    so its URL can be cached forever
+    '''
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    extension = pathlib.Path(filename).suffix.lower()
+    return f"{FOLDER}/{digest.hexdigest()}{extension}"
+
+
+def is_content_addressed(name):
+    '''
+    True when the content of the file stored as name never changes:
+    pictures named by their hash, and their renditions
+    '''
+    return CONTENT_ADDRESSED_RE.match(name) is not None
+
+
+@deconstructible
+class PictureStorage(FileSystemStorage):
+    '''
+    Media storage of content-addressed files: two files with the same name
+    have the same content, so a file that already exists is not written
+    again, and users uploading the same picture share a single file
+    '''
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file and rename it, so that the file is
+        #   never seen half written, and concurrent uploads of the same
+        #   picture replace it with the same content
+        fd, temporary_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.chmod(temporary_path, self.file_permissions_mode or 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        return name
+
+
+def delete_unused_picture(name, storage=default_storage):
+    '''
+    Deletes the picture stored as name, and its renditions, when no user
+    has it anymore
+    '''
+    from .models import User
+
+    if not name or not is_content_addressed(name):
+        # pictures stored before content addressing may be shared with the
+        #   load_data script, they are left alone
+        return False
+    if User.objects.filter(picture=name).exists():
+        return False
+    storage.delete(name)
+    # renditions are named by the hash only, the same picture may have been
+    #   uploaded with another extension
+    if not User.objects.filter(picture__startswith=f"{FOLDER}/{pathlib.Path(name).stem}.").exists():
+        delete_renditions(name, storage)
+    return True
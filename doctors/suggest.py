@@ -0,0 +1,191 @@
+import threading
+import time
+import unicodedata
+
+# maximum number of suggestions returned by the suggest view
+MAX_SUGGESTIONS = 8
+# seconds after which the trie is rebuilt from the database. The signal 
+#   receivers only update the trie of their own process, so this bounds how
+#   long changes made by other processes or by bulk imports go unseen
+MAX_AGE = 300
+
+# kinds of suggestions
+DOCTOR = 'doctor'
+SPECIALTY = 'specialty'
+
+
+def normalize(text):
+    '''
+    Lowercase text and strip diacritics, e.g.: 'Inés' -> 'ines'
+    '''
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+class TrieNode:
+    __slots__ = ('children', 'phrases')
+
+    def __init__(self):
+        self.children = {}
+        # phrases completed at this node: (text, kind) -> reference count,
+        #   several doctors may share the same name
+        self.phrases = {}
+
+
+class PrefixTrie:
+    '''
+    In-memory prefix tree of doctor names and specialties used to answer
+    typeahead queries without hitting the database.
+    Phrases are added and removed by owner key, e.g.: ('doctor', 12), so
+    that an owner can be updated without knowing its previous phrases.
+    Every word of a phrase is indexed, so both 'mar' and 'str' complete
+    'Maria Strong'
+    '''
+    def __init__(self):
+        self.root = TrieNode()
+        self.owners = {}
+        self.lock = threading.Lock()
+        # time.monotonic() of the last load from the database, None before
+        self.loaded_at = None
+
+    def _keys(self, text):
+        # the normalized phrase and each of its trailing word sequences
+        words = normalize(text).split()
+        return [' '.join(words[i:]) for i in range(len(words))]
+
+    def _insert(self, key, phrase):
+        node = self.root
+        for char in key:
+            node = node.children.setdefault(char, TrieNode())
+        node.phrases[phrase] = node.phrases.get(phrase, 0) + 1
+
+    def _delete(self, key, phrase):
+        # walk down keeping the path to prune nodes left empty
+        path = [self.root]
+        for char in key:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        node = path[-1]
+        count = node.phrases.get(phrase, 0) - 1
+        if count > 0:
+            node.phrases[phrase] = count
+        else:
+            node.phrases.pop(phrase, None)
+        for char, parent, child in zip(reversed(key), reversed(path[:-1]), reversed(path[1:])):
+            if child.children or child.phrases:
+                break
+            del parent.children[char]
+
+    def _remove(self, owner):
+        for phrase in self.owners.pop(owner, []):
+            for key in self._keys(phrase[0]):
+                self._delete(key, phrase)
+
+    def set(self, owner, phrases):
+        '''
+        Replace the phrases of the given owner
+        '''
+        with self.lock:
+            self._remove(owner)
+            phrases = [phrase for phrase in phrases if phrase[0].strip()]
+            if phrases:
+                self.owners[owner] = phrases
+                for phrase in phrases:
+                    for key in self._keys(phrase[0]):
+                        self._insert(key, phrase)
+
+    def remove(self, owner):
+        with self.lock:
+            self._remove(owner)
+
+    def clear(self):
+        with self.lock:
+            self.root = TrieNode()
+            self.owners = {}
+
+    def replace(self, trie):
+        '''
+        Take the phrases of another trie, e.g. one loaded from the database
+        '''
+        with self.lock:
+            self.root = trie.root
+            self.owners = trie.owners
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > MAX_AGE
+
+    def complete(self, prefix, limit=MAX_SUGGESTIONS):
+        '''
+        Returns up to limit (text, kind) phrases with a word starting
+        with the given prefix, in alphabetical order of the matched key
+        '''
+        prefix = ' '.join(normalize(prefix).split())
+        if not prefix:
+            return []
+        results = []
+        with self.lock:
+            node = self.root
+            for char in prefix:
+                node = node.children.get(char)
+                if node is None:
+                    return []
+            # depth first traversal in alphabetical order
+            stack = [node]
+            while stack and len(results) < limit:
+                node = stack.pop()
+                for phrase in sorted(node.phrases):
+                    if phrase not in results:
+                        results.append(phrase)
+                stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return results[:limit]
+
+
+# trie shared by all the requests handled by this process
+suggestions = PrefixTrie()
+
+
+def set_doctor(user):
+    if user.is_doctor:
+        suggestions.set((DOCTOR, user.id), [(f"{user.first_name} {user.last_name}", DOCTOR)])
+    else:
+        suggestions.remove((DOCTOR, user.id))
+
+
+def set_specialty(specialty):
+    suggestions.set((SPECIALTY, specialty.id), [(specialty.name, SPECIALTY)])
+
+
+# held by the request loading the trie
+load_lock = threading.Lock()
+
+
+def load():
+    '''
+    Build the trie from the database. The phrases are read into a new trie,
+    so the current one keeps answering until they are all loaded
+    '''
+    from .models import User, Specialty
+    trie = PrefixTrie()
+    loaded_at = time.monotonic()
+    doctors = User.objects.filter(is_doctor=True).values_list('id', 'first_name', 'last_name')
+    for doctor_id, first_name, last_name in doctors.iterator():
+        trie.set((DOCTOR, doctor_id), [(f"{first_name} {last_name}", DOCTOR)])
+    for specialty_id, name in Specialty.objects.values_list('id', 'name'):
+        trie.set((SPECIALTY, specialty_id), [(name, SPECIALTY)])
+    suggestions.replace(trie)
+    suggestions.loaded_at = loaded_at
+
+
+def complete(prefix, limit=MAX_SUGGESTIONS):
+    if suggestions.is_stale():
+        # a single request loads the trie. Before the first load the other
+        #   requests wait for it, afterwards they use the stale trie meanwhile
+        if load_lock.acquire(blocking=suggestions.loaded_at is None):
+            try:
+                if suggestions.is_stale():
+                    load()
+            finally:
+                load_lock.release()
+    return suggestions.complete(prefix, limit)
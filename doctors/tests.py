@@ -1,3 +1,1674 @@
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.core.files.storage import default_storage
+from django.db import connection, connections, router, transaction, OperationalError
+from django.db.models import QuerySet
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.sessions.models import Session
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.http import Http404, HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import urlencode
+from asgiref.sync import async_to_sync, sync_to_async
+from unittest import mock
+from PIL import Image
 
-# Create your tests here.
+import asyncio
+import datetime
+import inspect
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from .models import acompiled_schedule, compiled_schedule
+from .models import (
+    Specialty, User, Appointment, BusySlots, SlotTaken, SeriesNotBooked, Schedule, WorkingHours, ScheduleException, 
+    Holiday, OutboxEmail, CalendarFeed, AppointmentArchive, BOOKED, FREE, PAST, UNAVAILABLE, TAKEN, BUSY, OVERLAP)
+from .archive import appointments as archived_and_current, archive_batch, finish as finish_archive
+from .availability import earliest_available
+from .export import filter_appointments, rows as export_rows
+from .ical import feed
+from .importer import Importer
+from .metrics import registry
+from .helpers import StreamingASGIHandler, streaming_response
+from .helpers import appointment_cursor, next_weekday, next_weekdays, parse_appointment_cursor, queue_email
+from .management.commands.send_emails import MAX_ATTEMPTS, claim_batch, send_batch
+from .schedules import DEFAULT_TIME_SLOTS
+from .admin import EstimatedCountPaginator
+from .routers import PIN_COOKIE, pin_to_primary, read_from_replica
+from .storage import FOLDER as PICTURES_FOLDER, PictureStorage, content_name, delete_unused_picture
+from .search import FTS_TABLE, rebuild_index, search_doctor_ids
+from .views import APPOINTMENTS_PAGE_SIZE, search_entry, upcoming_appointments_page
+from . import views
+from . import cache
+from . import export
+from . import live
+from . import suggest
+from . import thumbnails
+
+
+class SQLiteProfileTests(TransactionTestCase):
+    def test_pragmas(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        # the production profile is off by default, when on the pragmas
+        #   are set on each new connection
+        with override_settings(SQLITE_PRAGMAS=settings.SQLITE_PRODUCTION_PRAGMAS):
+            new_connection = connections.create_connection('default')
+            self.addCleanup(new_connection.close)
+            new_connection.ensure_connection()
+        with new_connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1) # NORMAL
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.cardiology = Specialty.objects.create(name='cardiology')
+        self.ann = User.objects.create_user(
+            username='ann', email='ann@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=self.cardiology)
+        self.ines = User.objects.create_user(
+            username='ines', email='ines@doctors.test', first_name='Inés', last_name='Martín',
+            is_doctor=True, specialty=self.cardiology, description='Heart surgery')
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Annie', last_name='Ray')
+
+    def test_search(self):
+        # prefixes of every word, without diacritics, doctors only
+        self.assertEqual(search_doctor_ids('ann'), [self.ann.id])
+        self.assertEqual(search_doctor_ids('ines mar'), [self.ines.id])
+        self.assertEqual(sorted(search_doctor_ids('cardio')), [self.ann.id, self.ines.id])
+        # names rank before descriptions
+        self.ann.description = 'Ines is a colleague'
+        self.ann.save()
+        self.assertEqual(search_doctor_ids('ines'), [self.ines.id, self.ann.id])
+        response = self.client.get('/search/', {'search_term': 'lee'})
+        self.assertEqual([doctor['doctor_id'] for doctor in response.json()['results']], [self.ann.id])
+
+    def test_deletes(self):
+        self.ines.delete()
+        self.assertEqual(search_doctor_ids('cardio'), [self.ann.id])
+        self.cardiology.delete()
+        self.assertEqual(search_doctor_ids('cardio'), [])
+        self.assertEqual(search_doctor_ids('ann'), [self.ann.id])
+
+    def test_rebuild_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        # e.g. a user deleted by another process without the delete signals
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, first_name, last_name, specialty, description) "
+                "VALUES (%s, 'Ann', 'Gone', '', '')", [self.patient.id + 1000])
+        self.assertEqual(len(search_doctor_ids('ann')), 2)
+        rebuild_index()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {FTS_TABLE} ORDER BY rowid")
+            self.assertEqual([row[0] for row in cursor.fetchall()], [self.ann.id, self.ines.id])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_results'},
+})
+class CacheTests(TestCase):
+    '''
+    Result caches: LRU eviction, expiry, invalidation by tag, ETags, and the
+    shared cache used from async code
+    '''
+    def setUp(self):
+        cache.search_results.clear()
+        self.specialty = Specialty.objects.create(name='cardiology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=self.specialty)
+
+    def test_lru(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        # b is the least recently used
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual((lru.get('a'), lru.get('c'), len(lru)), (1, 3, 2))
+
+    def test_ttl(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        now = time.monotonic()
+        with mock.patch('time.monotonic', return_value=now):
+            lru.set('a', 1)
+        with mock.patch('time.monotonic', return_value=now + 59):
+            self.assertEqual(lru.get('a'), 1)
+        with mock.patch('time.monotonic', return_value=now + 61):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(len(lru), 0)
+
+    def test_tags(self):
+        lru = cache.LRUCache(maxsize=10, ttl=60)
+        lru.set('ann', 1, [('doctor', 1), ('specialty', 1)])
+        lru.set('bob', 2, [('doctor', 2), ('specialty', 1)])
+        lru.set('eve', 3, [('doctor', 3)])
+        lru.delete_tag(('doctor', 1))
+        self.assertEqual((lru.get('ann'), lru.get('bob')), (None, 2))
+        lru.delete_tag(('specialty', 1))
+        self.assertIsNone(lru.get('bob'))
+        self.assertEqual(set(lru.tags), {('doctor', 3)})
+        lru.delete_where(lambda key, value: value == 3)
+        self.assertEqual((len(lru), dict(lru.tags)), (0, {}))
+
+    def test_search_invalidation(self):
+        response = self.client.get('/search/', {'search_term': 'lee'})
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/search/', {'search_term': 'lee'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(len(cache.search_results), 1)
+        # the doctor is renamed, the cached results with the doctor are deleted
+        self.doctor.last_name = 'Leeds'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.save()
+        self.assertEqual(len(cache.search_results), 0)
+        response = self.client.get('/search/', {'search_term': 'lee'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['results'][0]['doctor_name'], 'Ann Leeds')
+
+    def test_shared_cache_async(self):
+        call_command('createcachetable', 'test_results')
+        self.addCleanup(caches['shared'].clear)
+        shared = cache.SharedCache('shared', 'test', 60)
+        # DatabaseCache raises SynchronousOnlyOperation on the event loop
+        async_to_sync(shared.aset)('key', 'value')
+        self.assertEqual(async_to_sync(shared.aget)('key'), 'value')
+        shared.delete_tag(('doctor', 1))
+        self.assertIsNone(shared.get('key'))
+        with mock.patch.object(cache, 'schedules', shared):
+            schedule = async_to_sync(acompiled_schedule)(self.doctor.id)
+            self.assertEqual(shared.get(self.doctor.id).slots, schedule.slots)
+            self.assertEqual(async_to_sync(acompiled_schedule)(self.doctor.id).slots, schedule.slots)
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        # the trie of the process outlives the test transactions
+        suggest.suggestions.loaded_at = None
+        self.addCleanup(setattr, suggest.suggestions, 'loaded_at', None)
+        self.specialty = Specialty.objects.create(name='dermatology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='María', last_name='Strong',
+            is_doctor=True, specialty=self.specialty)
+
+    def test_complete(self):
+        self.assertEqual(suggest.complete('str'), [('María Strong', suggest.DOCTOR)])
+        self.assertEqual(suggest.complete('mari'), [('María Strong', suggest.DOCTOR)])
+        self.assertEqual(suggest.complete('Derm'), [('Dermatology', suggest.SPECIALTY)])
+        # kept in sync by the signal receivers
+        self.doctor.delete()
+        self.assertEqual(suggest.complete('str'), [])
+
+    def test_reload(self):
+        suggest.complete('str')
+        # created without the signals, e.g. by a bulk import or by another process
+        User.objects.bulk_create([User(
+            username='bulk', email='bulk@doctors.test', first_name='Quentin', last_name='Bulk',
+            is_doctor=True)])
+        self.assertEqual(suggest.complete('quen'), [])
+        suggest.suggestions.loaded_at -= suggest.MAX_AGE + 1
+        self.assertEqual(suggest.complete('quen'), [('Quentin Bulk', suggest.DOCTOR)])
+
+    def test_single_load(self):
+        loads = []
+
+        def load():
+            loads.append(threading.get_ident())
+            time.sleep(0.05)
+            suggest.suggestions.loaded_at = time.monotonic()
+
+        with mock.patch.object(suggest, 'load', load):
+            threads = [threading.Thread(target=suggest.complete, args=('str',)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(loads), 1)
+
+
+class ImporterTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.importer = Importer(batch_size=2)
+        self.importer.specialties([{'name': 'cardiology'}])
+        self.importer.doctors([{
+            'username': 'ann', 'email': 'ann@doctors.test', 'first_name': 'ann', 'last_name': 'lee',
+            'specialty': 'Cardiology', 'password': make_password('secret')}])
+        self.importer.patients([
+            {'username': f'patient{i}', 'email': f'patient{i}@doctors.test', 'first_name': 'bob',
+             'last_name': f'patient{i}'} for i in range(3)])
+        self.date = next_weekday(datetime.date.today())
+
+    def appointment(self, patient, time, **fields):
+        return dict(
+            patient=patient, doctor='ann', date=self.date.isoformat(), time=time, **fields)
+
+    def test_passwords(self):
+        self.assertTrue(User.objects.get(username='ann').check_password('secret'))
+        with self.assertRaises(ValueError):
+            self.importer.doctors([{
+                'username': 'cy', 'email': 'cy@doctors.test', 'first_name': 'cy', 'last_name': 'ode',
+                'specialty': 'Cardiology', 'password': 'plain text'}])
+
+    def test_appointments(self):
+        count = self.importer.appointments([
+            self.appointment('patient0', '10:00', duration='60'),
+            # the doctor is busy from 10:00 to 11:00
+            self.appointment('patient1', '10:30'),
+            self.appointment('patient1', '11:00'),
+            self.appointment('patient2', '11:30'),
+        ])
+        self.assertEqual((count, self.importer.skipped), (3, 1))
+        self.assertEqual(Appointment.objects.count(), 3)
+        bits = Appointment.TIME_SLOT_BITS
+        self.assertEqual(
+            BusySlots.objects.get(user__username='ann', date=self.date).mask,
+            bits[datetime.time(10)] | bits[datetime.time(10, 30)] | bits[datetime.time(11)] |
+            bits[datetime.time(11, 30)])
+        self.assertEqual(
+            BusySlots.objects.get(user__username='patient1', date=self.date).mask, bits[datetime.time(11)])
+        # already booked
+        self.assertEqual(self.importer.appointments([self.appointment('patient2', '11:30')]), 0)
+
+    def test_off_schedule_appointments(self):
+        saturday = self.date + datetime.timedelta(days=5 - self.date.weekday())
+        count = self.importer.appointments([
+            # the doctor starts at 10:00, and does not work on weekends
+            self.appointment('patient0', '08:00'),
+            dict(self.appointment('patient1', '10:00'), date=saturday.isoformat()),
+            self.appointment('patient2', '10:00'),
+        ])
+        self.assertEqual((count, self.importer.off_schedule, self.importer.skipped), (1, 2, 0))
+        self.assertEqual(list(Appointment.objects.values_list('patient__username', flat=True)), ['patient2'])
+
+    def test_invalid_appointments(self):
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+        for row in [
+                dict(self.appointment('patient0', '10:00'), date=yesterday),
+                dict(self.appointment('patient0', '10:00'), doctor='patient1'),
+                self.appointment('patient0', '19:30', duration='90')]:
+            with self.assertRaises(ValueError):
+                self.importer.appointments([row])
+        self.assertFalse(Appointment.objects.exists())
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    '''
+    Bookers run in threads, each with its own database connection, the way
+    requests run in the threads of a server
+    '''
+    NUM_BOOKERS = 8
+
+    def setUp(self):
+        # ids are reused from one test to the next
+        cache.schedules.clear()
+        specialty = Specialty.objects.create(name='cardiology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=specialty)
+        self.patients = [
+            User.objects.create_user(
+                username=f'patient{i}', email=f'patient{i}@doctors.test',
+                first_name='Bob', last_name=f'Patient{i}')
+            for i in range(self.NUM_BOOKERS)]
+        self.date = next_weekday(datetime.date.today())
+
+    def test_parallel_bookers(self):
+        # every booker tries to book every slot of the doctor, in its own order
+        start = threading.Barrier(self.NUM_BOOKERS)
+        booked = []
+        conflicts = []
+        errors = []
+
+        def book(patient, seed):
+            try:
+                times = list(DEFAULT_TIME_SLOTS)
+                random.Random(seed).shuffle(times)
+                doctor = User.objects.get(pk=self.doctor.pk)
+                start.wait()
+                for time in times:
+                    try:
+                        doctor.book(patient, self.date, time)
+                        booked.append(time)
+                    except SlotTaken:
+                        conflicts.append(time)
+            except OperationalError as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=book, args=(patient, seed))
+            for seed, patient in enumerate(self.patients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        # each slot was booked exactly once
+        self.assertEqual(sorted(booked), DEFAULT_TIME_SLOTS)
+        self.assertEqual(len(conflicts), len(DEFAULT_TIME_SLOTS) * (self.NUM_BOOKERS - 1))
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), len(DEFAULT_TIME_SLOTS))
+        mask = BusySlots.objects.get(user=self.doctor, date=self.date).mask
+        self.assertEqual(mask, sum(Appointment.TIME_SLOT_BITS[time] for time in DEFAULT_TIME_SLOTS))
+
+    def test_parallel_unbookers(self):
+        bookings = list(zip(self.patients, DEFAULT_TIME_SLOTS))
+        for patient, time in bookings:
+            self.doctor.book(patient, self.date, time)
+        start = threading.Barrier(len(bookings))
+        errors = []
+
+        def unbook(patient, time):
+            try:
+                doctor = User.objects.get(pk=self.doctor.pk)
+                start.wait()
+                doctor.unbook(patient, self.date, time)
+            except OperationalError as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=unbook, args=booking) for booking in bookings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertFalse(Appointment.objects.filter(doctor=self.doctor).exists())
+        self.assertEqual(BusySlots.objects.get(user=self.doctor, date=self.date).mask, 0)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    def test_request_timings(self):
+        Specialty.objects.create(name='cardiology')
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        timings = dict(re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing']))
+        self.assertGreater(float(timings['tpl']), 0)
+        self.assertGreaterEqual(float(timings['total']), float(timings['tpl']))
+        histogram = registry.histograms[('http_request_duration_seconds', 'doctors:index')]
+        self.assertEqual(histogram.count, 1)
+        self.assertGreater(registry.histograms[('template_render_duration_seconds', 'doctors:index')].sum, 0)
+
+    def test_metrics_access(self):
+        self.client.get('/')
+        # no address is allowed by default, not even the loopback of a proxy
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.5']):
+            response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'http_request_duration_seconds_bucket{view="doctors:index",le="+Inf"} 1', response.content)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 403)
+        staff = User.objects.create_user(
+            username='staff', email='staff@doctors.test', first_name='Sam', last_name='Taff', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+
+
+class BusySlotsTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.other = User.objects.create_user(
+            username='other', email='other@doctors.test', first_name='Cy', last_name='Ode')
+        self.date = next_weekday(datetime.date.today())
+        self.doctor.book(self.patient, self.date, DEFAULT_TIME_SLOTS[0])
+        self.doctor.book(self.other, self.date, DEFAULT_TIME_SLOTS[1])
+
+    def mask(self, user):
+        return BusySlots.objects.get(user=user, date=self.date).mask
+
+    def test_queryset_delete(self):
+        Appointment.objects.filter(patient=self.patient).delete()
+        self.assertEqual(self.mask(self.patient), 0)
+        self.assertEqual(self.mask(self.doctor), Appointment.TIME_SLOT_BITS[DEFAULT_TIME_SLOTS[1]])
+        self.assertEqual(self.doctor.available_time_slots(self.date), [
+            time for time in DEFAULT_TIME_SLOTS if time != DEFAULT_TIME_SLOTS[1]])
+
+    def test_cascade_delete(self):
+        # the appointments of the patient are deleted with the patient
+        self.patient.delete()
+        self.assertEqual(self.mask(self.doctor), Appointment.TIME_SLOT_BITS[DEFAULT_TIME_SLOTS[1]])
+        self.other.delete()
+        self.assertEqual(self.mask(self.doctor), 0)
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_bulk_delete(self):
+        third = User.objects.create_user(
+            username='third', email='third@doctors.test', first_name='Di', last_name='Fox')
+        self.doctor.book(third, self.date, DEFAULT_TIME_SLOTS[2])
+
+        def appointment_queries(users):
+            with CaptureQueriesContext(connection) as queries:
+                users.delete()
+            return len([query for query in queries if 'doctors_appointment' in query['sql']])
+
+        # the appointments with the users kept are freed in one pass, not per user
+        one = appointment_queries(User.objects.filter(username='patient'))
+        self.assertEqual(appointment_queries(User.objects.filter(username__in=['other', 'third'])), one)
+        self.assertEqual(self.mask(self.doctor), 0)
+        self.assertFalse(Appointment.objects.exists())
+        # between deleted users, the appointments go with the cascade
+        patient = User.objects.create_user(
+            username='fourth', email='fourth@doctors.test', first_name='Ed', last_name='Gil')
+        self.doctor.book(patient, self.date, DEFAULT_TIME_SLOTS[0])
+        User.objects.all().delete()
+        self.assertFalse(Appointment.objects.exists())
+        self.assertFalse(BusySlots.objects.exists())
+
+
+class OutboxTests(TestCase):
+    '''
+    Emails are sent with the in-memory backend of the tests, mail.outbox
+    '''
+    def setUp(self):
+        for i in range(3):
+            queue_email('Appointment confirmation', f'Message {i}', f'patient{i}@doctors.test')
+
+    def test_send_batch(self):
+        self.assertEqual(send_batch(2), (2, 0))
+        self.assertEqual(send_batch(2), (1, 0))
+        self.assertEqual(send_batch(2), (0, 0))
+        self.assertEqual([message.body for message in mail.outbox], ['Message 0', 'Message 1', 'Message 2'])
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+
+    def test_retry_and_dead_letter(self):
+        with mock.patch(
+                'django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.assertEqual(send_batch(10), (0, 3))
+            # retried later
+            self.assertEqual(send_batch(10), (0, 0))
+            email = OutboxEmail.objects.first()
+            self.assertEqual((email.status, email.attempts, email.last_error), (OutboxEmail.PENDING, 1, 'down'))
+            for attempt in range(2, MAX_ATTEMPTS + 1):
+                OutboxEmail.objects.update(next_attempt=email.created)
+                self.assertEqual(send_batch(10), (0, 3))
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.DEAD).count(), 3)
+        # dead emails are not sent anymore
+        OutboxEmail.objects.update(next_attempt=email.created)
+        self.assertEqual(send_batch(10), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_claim_once(self):
+        # e.g. two workers polling the outbox at the same time
+        first, second = claim_batch(2), claim_batch(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({email.id for email in first} & {email.id for email in second})
+        self.assertEqual(claim_batch(2), [])
+        self.assertEqual(send_batch(10), (0, 0))
+
+
+class ScheduleTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        # the Monday two weeks from now
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=14 - today.weekday())
+
+    def make_schedule(self):
+        # Monday 9:00 to 11:00 and Saturday 10:00 to 12:00, 1 hour appointments
+        schedule = Schedule.objects.create(doctor=self.doctor, slot_minutes=60)
+        WorkingHours.objects.create(
+            schedule=schedule, weekday=0, start=datetime.time(9), end=datetime.time(11))
+        WorkingHours.objects.create(
+            schedule=schedule, weekday=5, start=datetime.time(10), end=datetime.time(12))
+        return schedule
+
+    def test_default_schedule(self):
+        self.assertEqual(self.doctor.available_time_slots(self.monday), DEFAULT_TIME_SLOTS)
+        sunday = self.monday - datetime.timedelta(days=1)
+        self.assertEqual(self.doctor.available_time_slots(sunday), [])
+        days = self.doctor.working_days(sunday, 6)
+        self.assertEqual([day.weekday() for day in days], [0, 1, 2, 3, 4, 0])
+
+    def test_working_hours(self):
+        self.make_schedule()
+        self.assertEqual(
+            self.doctor.available_time_slots(self.monday), [datetime.time(9), datetime.time(10)])
+        days = self.doctor.working_days(self.monday - datetime.timedelta(days=1), 3)
+        self.assertEqual([day.weekday() for day in days], [0, 5, 0])
+        # hours outside the schedule cannot be booked
+        with self.assertRaises(ValueError):
+            self.doctor.book(self.patient, self.monday, datetime.time(14))
+
+    def test_long_appointments(self):
+        self.make_schedule()
+        self.doctor.book(self.patient, self.monday, datetime.time(9))
+        self.assertEqual(self.doctor.available_time_slots(self.monday), [datetime.time(10)])
+        # the hour long appointment takes the 9:00 and 9:30 slots of the patient
+        other = User.objects.create_user(
+            username='other', email='other@doctors.test', first_name='Cy', last_name='Ode',
+            is_doctor=True)
+        schedule = Schedule.objects.create(doctor=other, slot_minutes=30)
+        WorkingHours.objects.create(
+            schedule=schedule, weekday=0, start=datetime.time(9), end=datetime.time(10))
+        with self.assertRaises(SlotTaken):
+            other.book(self.patient, self.monday, datetime.time(9, 30))
+        self.doctor.unbook(self.patient, self.monday, datetime.time(9))
+        self.assertEqual(BusySlots.objects.get(user=self.patient, date=self.monday).mask, 0)
+
+    def test_exceptions_and_holidays(self):
+        schedule = self.make_schedule()
+        tuesday = self.monday + datetime.timedelta(days=1)
+        saturday = self.monday + datetime.timedelta(days=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            ScheduleException.objects.create(schedule=schedule, date=self.monday)
+            ScheduleException.objects.create(
+                schedule=schedule, date=tuesday, start=datetime.time(15), end=datetime.time(16))
+            Holiday.objects.create(date=saturday, name='Clinic closed')
+        self.assertEqual(self.doctor.available_time_slots(self.monday), [])
+        self.assertEqual(self.doctor.available_time_slots(tuesday), [datetime.time(15)])
+        self.assertEqual(self.doctor.available_time_slots(saturday), [])
+        days = self.doctor.working_days(self.monday - datetime.timedelta(days=1), 2)
+        self.assertEqual(days, [tuesday, self.monday + datetime.timedelta(days=7)])
+
+    def test_holiday_every_day_worked(self):
+        # no weekday mask is 0, the closed days still have no slots
+        schedule = Schedule.objects.create(doctor=self.doctor, slot_minutes=60)
+        for weekday in range(7):
+            WorkingHours.objects.create(
+                schedule=schedule, weekday=weekday, start=datetime.time(9), end=datetime.time(10))
+        sunday = self.monday + datetime.timedelta(days=6)
+        with self.captureOnCommitCallbacks(execute=True):
+            Holiday.objects.create(date=self.monday, name='Clinic closed')
+        dates = [self.monday, sunday]
+        self.assertEqual(self.doctor.available_time_slots_by_date(dates), {
+            self.monday: [], sunday: [datetime.time(9)]})
+        self.assertEqual(compiled_schedule(self.doctor.id).free_times(self.monday, 0), [])
+
+    def test_booking_validated_uncached(self):
+        self.make_schedule()
+        self.assertEqual(
+            self.doctor.available_time_slots(self.monday), [datetime.time(9), datetime.time(10)])
+        # changed by another process, whose signals do not reach this one
+        WorkingHours.objects.filter(schedule__doctor=self.doctor, weekday=0).update(end=datetime.time(10))
+        self.assertTrue(compiled_schedule(self.doctor.id).offers(self.monday, datetime.time(10)))
+        with self.assertRaises(ValueError):
+            self.doctor.book(self.patient, self.monday, datetime.time(10))
+        with self.assertRaises(SeriesNotBooked):
+            self.doctor.book_series(self.patient, [(self.monday, datetime.time(10))])
+        self.client.force_login(self.patient)
+        response = self.client.post('/book/confirm', {
+            'doctor_id': self.doctor.id, 'date': self.monday.strftime('%Y%m%d'), 'time': '10:00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Appointment.objects.exists())
+        # the cache was refreshed by the bookings
+        self.assertEqual(self.doctor.available_time_slots(self.monday), [datetime.time(9)])
+
+
+class BookSeriesTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray',
+            password='password')
+        self.client.force_login(self.patient)
+        # the Monday two weeks from now
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=14 - today.weekday())
+        self.time = DEFAULT_TIME_SLOTS[0]
+
+    def test_weekly_series(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/book/series', {
+                'doctor_id': self.doctor.id, 'date': self.monday.strftime('%Y%m%d'),
+                'time': self.time.strftime('%H:%M'), 'rule': 'FREQ=WEEKLY;COUNT=6'})
+        self.assertEqual(response.status_code, 201)
+        slots = response.json()['slots']
+        self.assertEqual([slot['outcome'] for slot in slots], [BOOKED] * 6)
+        dates = [self.monday + datetime.timedelta(weeks=week) for week in range(6)]
+        appointments = Appointment.objects.filter(patient=self.patient)
+        self.assertEqual([appointment.date for appointment in appointments], dates)
+        self.assertEqual(
+            [slot['appointment_id'] for slot in slots], [appointment.id for appointment in appointments])
+        for user in (self.doctor, self.patient):
+            masks = BusySlots.objects.filter(user=user).values_list('mask', flat=True)
+            self.assertEqual(list(masks), [Appointment.TIME_SLOT_BITS[self.time]] * 6)
+        # conflicts are found with a single query, whatever the number of slots
+        selects = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and 'FROM "doctors_busyslots"' in query['sql']]
+        self.assertEqual(len(selects), 1)
+
+    def test_all_or_nothing(self):
+        other = User.objects.create_user(
+            username='other', email='other@doctors.test', first_name='Cy', last_name='Ode')
+        second = User.objects.create_user(
+            username='second', email='second@doctors.test', first_name='Di', last_name='Ott',
+            is_doctor=True)
+        tuesday = self.monday + datetime.timedelta(days=1)
+        wednesday = self.monday + datetime.timedelta(days=2)
+        self.doctor.book(other, tuesday, self.time)
+        second.book(self.patient, wednesday, self.time)
+        series = [
+            (self.monday, self.time), (tuesday, self.time), (wednesday, self.time), 
+            (self.monday, self.time), (self.monday - datetime.timedelta(days=1), self.time),
+            (datetime.date.today(), self.time)]
+        response = self.client.post('/book/series', {
+            'doctor_id': self.doctor.id,
+            'slots': ','.join(f"{date:%Y%m%d}-{time:%H:%M}" for date, time in series)})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            [slot['outcome'] for slot in response.json()['slots']], 
+            [FREE, TAKEN, BUSY, OVERLAP, UNAVAILABLE, PAST])
+        # nothing was booked
+        self.assertFalse(Appointment.objects.filter(doctor=self.doctor, patient=self.patient).exists())
+        self.assertFalse(BusySlots.objects.filter(user=self.doctor, date=self.monday).exists())
+        # more slots than allowed
+        response = self.client.post('/book/series', {
+            'doctor_id': self.doctor.id, 'date': self.monday.strftime('%Y%m%d'),
+            'time': self.time.strftime('%H:%M'), 'rule': 'FREQ=WEEKLY;COUNT=100'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AdminTests(TestCase):
+    '''
+    The queries of the admin pages do not depend on the number of rows
+    '''
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            username='admin', email='admin@doctors.test', password='admin', first_name='Ad', 
+            last_name='Min')
+        self.client.force_login(self.admin)
+        self.date = next_weekday(datetime.date.today())
+        self.add_rows(0, 3)
+
+    def add_rows(self, first, count):
+        # appointments are created in bulk, without their busy slots
+        for i in range(first, first + count):
+            specialty = Specialty.objects.create(name=f'specialty{i}')
+            doctor = User.objects.create_user(
+                username=f'doctor{i}', email=f'doctor{i}@doctors.test', first_name='Ann',
+                last_name=f'Lee{i}', is_doctor=True, specialty=specialty)
+            patient = User.objects.create_user(
+                username=f'patient{i}', email=f'patient{i}@doctors.test', first_name='Bob',
+                last_name=f'Ray{i}')
+            Appointment.objects.bulk_create([
+                Appointment(doctor=doctor, patient=patient, date=self.date, time=time)
+                for time in DEFAULT_TIME_SLOTS])
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries]
+
+    def test_fixed_number_of_queries(self):
+        appointment = Appointment.objects.first()
+        urls = [
+            '/admin/doctors/user/',
+            '/admin/doctors/user/?q=lee',
+            '/admin/doctors/specialty/',
+            '/admin/doctors/appointment/',
+            f'/admin/doctors/appointment/?date__year={self.date.year}',
+            f'/admin/doctors/appointment/{appointment.id}/change/',
+            '/admin/autocomplete/?term=ann&app_label=doctors&model_name=appointment&field_name=doctor',
+        ]
+        before = [len(self.queries(url)) for url in urls]
+        self.add_rows(3, 20)
+        after = [len(self.queries(url)) for url in urls]
+        self.assertEqual(before, after)
+
+    def test_appointment_form_does_not_load_users(self):
+        appointment = Appointment.objects.first()
+        response = self.client.get(f'/admin/doctors/appointment/{appointment.id}/change/')
+        # only the selected doctor and patient are rendered in the widgets
+        self.assertContains(response, appointment.doctor.username)
+        self.assertNotContains(response, 'patient2')
+
+    def test_estimated_count(self):
+        with mock.patch.object(EstimatedCountPaginator, 'EXACT_COUNT_BELOW', 0):
+            queries = self.queries('/admin/doctors/appointment/')
+        self.assertFalse([sql for sql in queries if 'COUNT(' in sql])
+        # a filtered changelist is counted
+        with mock.patch.object(EstimatedCountPaginator, 'EXACT_COUNT_BELOW', 0):
+            queries = self.queries(f'/admin/doctors/appointment/?date__year={self.date.year}')
+        self.assertTrue([sql for sql in queries if 'COUNT(' in sql])
+
+
+class QueryPlanTests(TestCase):
+    '''
+    The queries of the hot paths are run and each one is explained: none may
+    read a whole table
+    '''
+    # e.g. "SCAN doctors_appointment", while an index scan is 
+    #   "SCAN doctors_user USING INDEX ..."
+    FULL_SCAN = re.compile(r'\bSCAN (\S+)$')
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        cache.schedules.clear()
+        self.specialty = Specialty.objects.create(name='cardiology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=self.specialty)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.date = next_weekday(datetime.date.today())
+        self.time = DEFAULT_TIME_SLOTS[0]
+
+    def assertNoFullScan(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+            # generators and querysets run their queries when iterated
+            if isinstance(result, QuerySet) or inspect.isgenerator(result):
+                list(result)
+        sqls = [
+            query['sql'] for query in context.captured_queries 
+            if query['sql'].startswith(('SELECT', 'UPDATE', 'DELETE'))]
+        self.assertTrue(sqls)
+        for sql in sqls:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = [row[-1] for row in cursor.fetchall()]
+            scans = [line for line in plan if self.FULL_SCAN.search(line)]
+            self.assertEqual(scans, [], f"{sql}\n" + "\n".join(plan))
+
+    def test_availabilities(self):
+        self.assertNoFullScan(self.doctor.available_time_slots, self.date)
+        self.assertNoFullScan(self.doctor.available_time_slots_by_date, [self.date])
+        self.assertNoFullScan(self.patient.slot_is_taken, self.date, self.time)
+        self.assertNoFullScan(User.doctors_available_at, self.date, self.time)
+        self.assertNoFullScan(earliest_available, self.specialty, [self.date], 5)
+
+    def test_booking(self):
+        self.assertNoFullScan(self.doctor.book, self.patient, self.date, self.time)
+        self.assertNoFullScan(self.doctor.unbook, self.patient, self.date, self.time)
+        series = [(self.date + datetime.timedelta(weeks=week), self.time) for week in range(1, 4)]
+        self.assertNoFullScan(self.doctor.book_series, self.patient, series)
+
+    def test_appointments(self):
+        self.doctor.book(self.patient, self.date, self.time)
+        self.assertNoFullScan(self.patient.upcoming_appointments, limit=10)
+        self.assertNoFullScan(self.doctor.upcoming_appointments, limit=10)
+        self.assertNoFullScan(
+            self.doctor.upcoming_appointments, after=(self.date, self.time, 1), limit=10)
+        self.assertNoFullScan(feed, self.doctor.id, datetime.datetime.now(datetime.timezone.utc), 'test')
+
+    def test_search(self):
+        self.assertNoFullScan(search_entry, '"ann"*', 'ann')
+
+    def test_exports_and_archive(self):
+        for filters in [{'doctor_id': self.doctor.id}, {'start': self.date, 'end': self.date}]:
+            self.assertNoFullScan(export_rows, [filter_appointments(Appointment.objects.all(), **filters)])
+        self.assertNoFullScan(archive_batch, datetime.date.today(), 100)
+
+
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.specialty = Specialty.objects.create(name='cardiology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=self.specialty)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.client.force_login(self.patient)
+        # the Monday two weeks from now
+        today = datetime.date.today()
+        self.monday = today + datetime.timedelta(days=14 - today.weekday())
+        self.time_slots = DEFAULT_TIME_SLOTS
+
+    def test_batch_availabilities(self):
+        self.doctor.book(self.patient, self.monday, self.time_slots[0])
+        sunday = self.monday + datetime.timedelta(days=6)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/book/availabilities', {
+                'doctor_id': self.doctor.id, 'start': self.monday.strftime('%Y%m%d'),
+                'end': sunday.strftime('%Y%m%d')})
+        self.assertEqual(response.status_code, 200)
+        availabilities = response.json()['availabilities']
+        # the weekdays of the range
+        self.assertEqual(list(availabilities), [
+            (self.monday + datetime.timedelta(days=days)).strftime('%Y%m%d') for days in range(5)])
+        times = [time.strftime('%H:%M') for time in self.time_slots]
+        self.assertEqual(availabilities[self.monday.strftime('%Y%m%d')], times[1:])
+        friday = self.monday + datetime.timedelta(days=4)
+        self.assertEqual(availabilities[friday.strftime('%Y%m%d')], times)
+        # the busy slots of every date are read with a single query
+        selects = [
+            query['sql'] for query in context.captured_queries
+            if 'FROM "doctors_busyslots"' in query['sql']]
+        self.assertEqual(len(selects), 1)
+
+    def test_earliest_available(self):
+        other = User.objects.create_user(
+            username='other', email='other@doctors.test', first_name='Cy', last_name='Ode',
+            is_doctor=True, specialty=self.specialty)
+        first, second, third = self.time_slots[:3]
+        self.doctor.book(self.patient, self.monday, first)
+        other.book(self.patient, self.monday, second)
+        # ordered by date, time and doctor
+        slots = earliest_available(self.specialty, [self.monday], 3)
+        self.assertEqual(slots, [
+            (other.id, self.monday, first),
+            (self.doctor.id, self.monday, second),
+            (self.doctor.id, self.monday, third)])
+        response = self.client.get('/book/earliest', {'specialty': 'Cardiology', 'count': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_batch_bad_requests(self):
+        url = '/book/availabilities'
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {
+            'doctor_id': self.doctor.id, 'start': self.monday.strftime('%Y%m%d')}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'doctor_id': self.patient.id}).status_code, 400)
+        far = self.monday + datetime.timedelta(days=3650)
+        self.assertEqual(self.client.get(url, {
+            'doctor_id': self.doctor.id, 'start': self.monday.strftime('%Y%m%d'),
+            'end': far.strftime('%Y%m%d')}).status_code, 400)
+
+
+class BookingViewTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, picture='doctor.jpg')
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.other = User.objects.create_user(
+            username='other', email='other@doctors.test', first_name='Cy', last_name='Ode')
+        self.date = next_weekday(datetime.date.today())
+        self.time = DEFAULT_TIME_SLOTS[0]
+        self.data = {
+            'doctor_id': self.doctor.id, 'date': self.date.strftime('%Y%m%d'),
+            'time': self.time.strftime('%H:%M')}
+
+    def book(self, user):
+        self.client.force_login(user)
+        return self.client.post('/book/confirm', self.data)
+
+    def test_taken_slot(self):
+        self.assertEqual(self.book(self.patient).status_code, 204)
+        response = self.book(self.other)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.content, b'')
+        # the reason is shown on the next page
+        response = self.client.get(f'/book/{self.doctor.id}')
+        self.assertContains(response, 'The time you chose is no longer available.')
+        self.assertEqual(
+            list(Appointment.objects.values_list('patient_id', flat=True)), [self.patient.id])
+
+    def test_patient_busy(self):
+        self.assertEqual(self.book(self.patient).status_code, 204)
+        other_doctor = User.objects.create_user(
+            username='other_doctor', email='other_doctor@doctors.test', first_name='Di', last_name='Eze',
+            is_doctor=True, picture='other_doctor.jpg')
+        self.data['doctor_id'] = other_doctor.id
+        response = self.book(self.patient)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.content, b'')
+        response = self.client.get(f'/book/{other_doctor.id}')
+        self.assertContains(response, 'You already have another appointment at the time you chose.')
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+class AppointmentPagesTests(TestCase):
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, picture='doctor.jpg')
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray',
+            picture='patient.jpg')
+        self.client.force_login(self.patient)
+        dates = next_weekdays(datetime.date.today(), 3)
+        slots = [(date, time) for date in dates for time in DEFAULT_TIME_SLOTS]
+        slots = slots[:APPOINTMENTS_PAGE_SIZE + 5]
+        # booked out of order, pages are ordered by date and time
+        appointments = [self.doctor.book(self.patient, date, time) for date, time in reversed(slots)]
+        self.appointments = appointments[::-1]
+
+    def test_cursor_round_trip(self):
+        appointment = self.appointments[0]
+        cursor = appointment_cursor(appointment)
+        self.assertEqual(
+            parse_appointment_cursor(cursor), (appointment.date, appointment.time, appointment.id))
+        for cursor in ['', '20240125-1030', '20240125-1030-x', '2024-01-25-1030-1']:
+            with self.assertRaises(ValueError):
+                parse_appointment_cursor(cursor)
+
+    def test_pages(self):
+        page, cursor = upcoming_appointments_page(self.patient)
+        self.assertEqual(page, self.appointments[:APPOINTMENTS_PAGE_SIZE])
+        self.assertEqual(cursor, appointment_cursor(self.appointments[APPOINTMENTS_PAGE_SIZE - 1]))
+        page, next_cursor = upcoming_appointments_page(self.patient, parse_appointment_cursor(cursor))
+        self.assertEqual(page, self.appointments[APPOINTMENTS_PAGE_SIZE:])
+        self.assertIsNone(next_cursor)
+        response = self.client.get('/appointments/more', {'after': cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['next_cursor'])
+        self.assertEqual(self.client.get('/appointments/more', {'after': 'x'}).status_code, 400)
+
+    def test_weekends(self):
+        # appointments from tomorrow on, whatever the weekday
+        doctor = User.objects.create_user(
+            username='weekend', email='weekend@doctors.test', is_doctor=True)
+        schedule = Schedule.objects.create(doctor=doctor, slot_minutes=60)
+        for weekday in range(7):
+            WorkingHours.objects.create(
+                schedule=schedule, weekday=weekday, start=datetime.time(9), end=datetime.time(10))
+        patient = User.objects.create_user(username='other', email='other@doctors.test')
+        today = datetime.date.today()
+        for days in range(1, 8):
+            doctor.book(patient, today + datetime.timedelta(days=days), datetime.time(9))
+        dates = [appointment.date for appointment in patient.upcoming_appointments()]
+        self.assertEqual(dates, [today + datetime.timedelta(days=days) for days in range(1, 8)])
+
+
+class GenerateDataTests(TestCase):
+    options = {'doctors': 4, 'patients': 6, 'appointments': 30, 'days': 2, 'seed': 3}
+
+    def generate(self, **options):
+        call_command('generate_data', **{**self.options, **options}, stdout=io.StringIO())
+        users = list(User.objects.filter(username__startswith='gen_').order_by('username').values_list(
+            'username', 'first_name', 'last_name', 'specialty__name'))
+        appointments = list(Appointment.objects.order_by('date', 'time', 'doctor__username').values_list(
+            'date', 'time', 'doctor__username', 'patient__username'))
+        return users, appointments
+
+    def test_seeded(self):
+        users, appointments = self.generate()
+        self.assertEqual(len(users), 10)
+        self.assertEqual(len(appointments), 30)
+        # the same seed generates the same data again
+        self.assertEqual(self.generate(), (users, appointments))
+        self.assertNotEqual(self.generate(seed=4), (users, appointments))
+        self.generate(clear=True)
+        self.assertFalse(User.objects.filter(username__startswith='gen_').exists())
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_benchmark(self):
+        self.generate()
+        out = io.StringIO()
+        call_command('benchmark', requests=3, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['data'], {'doctors': 4, 'patients': 6, 'appointments': 30})
+        self.assertEqual(set(report['results']), {
+            'search', 'time_availabilities', 'time_availabilities_batch', 'appointment_book',
+            'appointments'})
+        for result in report['results'].values():
+            self.assertEqual(result['errors'], 0)
+        # the bookings of the benchmark are rolled back
+        self.assertEqual(Appointment.objects.count(), 30)
+
+
+class MediaRootMixin:
+    '''
+    Stores the media files of each test in a temporary folder
+    '''
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        thumbnails.found_widths.clear()
+
+    def picture(self, name, width, color='red'):
+        content = io.BytesIO()
+        Image.new('RGB', (width, width), color).save(content, 'PNG')
+        return default_storage.save(name, ContentFile(content.getvalue()))
+
+
+class PictureTests(MediaRootMixin, TestCase):
+    '''
+    Pictures are stored once under the hash of their content, deleted when
+    no user has them anymore, and served with conditional and range requests
+    '''
+    def setUp(self):
+        super().setUp()
+        self.storage = PictureStorage()
+        self.content = ContentFile(b'picture content', name='alice.PNG')
+        self.name = content_name(self.content, 'alice.PNG')
+        self.alice = User.objects.create_user(username='alice', email='alice@doctors.test')
+        self.bob = User.objects.create_user(username='bob', email='bob@doctors.test')
+
+    def test_content_addressed(self):
+        self.assertRegex(self.name, rf'^{PICTURES_FOLDER}/[0-9a-f]{{64}}\.png$')
+        self.assertEqual(self.storage.save(self.name, self.content), self.name)
+        # the same content is stored once, under the same name
+        self.assertEqual(self.storage.save(self.name, ContentFile(b'picture content')), self.name)
+        self.assertEqual(self.storage.listdir(PICTURES_FOLDER)[1], [self.name.split('/')[1]])
+        other = content_name(ContentFile(b'other content'), 'alice.png')
+        self.assertNotEqual(other, self.name)
+
+    def test_delete_unused_picture(self):
+        self.storage.save(self.name, self.content)
+        thumbnail = self.storage.save(
+            thumbnails.rendition_name(self.name, 64, 'jpg'), ContentFile(b'rendition'))
+        User.objects.filter(id__in=(self.alice.id, self.bob.id)).update(picture=self.name)
+        self.assertFalse(delete_unused_picture(self.name, self.storage))
+        User.objects.filter(id=self.alice.id).update(picture='')
+        # bob still has the picture
+        self.assertFalse(delete_unused_picture(self.name, self.storage))
+        self.assertTrue(self.storage.exists(self.name))
+        User.objects.filter(id=self.bob.id).update(picture='')
+        self.assertTrue(delete_unused_picture(self.name, self.storage))
+        self.assertFalse(self.storage.exists(self.name))
+        self.assertFalse(self.storage.exists(thumbnail))
+        # pictures stored before content addressing are left alone
+        legacy = self.storage.save('carol.png', ContentFile(b'legacy'))
+        self.assertFalse(delete_unused_picture(legacy, self.storage))
+        self.assertTrue(self.storage.exists(legacy))
+
+    def test_pictures_command(self):
+        legacy = self.storage.save('alice.png', ContentFile(b'picture content'))
+        User.objects.filter(id=self.alice.id).update(picture=legacy)
+        unused = self.storage.save(
+            content_name(ContentFile(b'unused'), 'old.png'), ContentFile(b'unused'))
+        unused_thumbnail = self.storage.save(
+            thumbnails.rendition_name(unused, 64, 'jpg'), ContentFile(b'rendition'))
+        recent = self.storage.save(
+            content_name(ContentFile(b'recent'), 'new.png'), ContentFile(b'recent'))
+        old = time.time() - 2 * 3600
+        for name in (unused, unused_thumbnail):
+            os.utime(self.storage.path(name), (old, old))
+
+        call_command('pictures', '--dry-run', stdout=io.StringIO())
+        self.assertTrue(self.storage.exists(unused))
+        self.assertEqual(User.objects.get(id=self.alice.id).picture.name, legacy)
+
+        call_command('pictures', stdout=io.StringIO())
+        self.assertEqual(User.objects.get(id=self.alice.id).picture.name, self.name)
+        self.assertTrue(self.storage.exists(self.name))
+        self.assertTrue(self.storage.exists(legacy))
+        self.assertFalse(self.storage.exists(unused))
+        self.assertFalse(self.storage.exists(unused_thumbnail))
+        # files this recent may belong to an upload in progress
+        self.assertTrue(self.storage.exists(recent))
+
+    def test_media_view(self):
+        self.storage.save(self.name, self.content)
+        url = f"/images/{self.name}"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'picture content')
+        self.assertIn('immutable', response['Cache-Control'])
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{self.name.split("/")[1].split(".")[0]}"')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-6')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b'picture')
+        self.assertEqual(response['Content-Range'], 'bytes 0-6/15')
+        response = self.client.get(url, HTTP_RANGE='bytes=-7')
+        self.assertEqual(response.content, b'content')
+        response = self.client.get(url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */15')
+        # a range of another version of the file is not sent
+        response = self.client.get(url, HTTP_RANGE='bytes=0-6', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get('/images/pictures/missing.png').status_code, 404)
+        self.assertEqual(self.client.get('/images/../manage.py').status_code, 404)
+
+    def test_media_view_legacy_rendition(self):
+        # renditions of pictures stored before content addressing are
+        #   rewritten in place, they are revalidated with their content hash
+        name = self.storage.save(thumbnails.rendition_name('alice.jpg', 64, 'jpg'), ContentFile(b'old'))
+        url = f"/images/{name}"
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.storage.delete(name)
+        self.storage.save(name, ContentFile(b'new rendition'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        hashed = thumbnails.rendition_name(self.name, 64, 'jpg')
+        self.storage.save(hashed, ContentFile(b'rendition'))
+        self.assertIn('immutable', self.client.get(f"/images/{hashed}")['Cache-Control'])
+
+
+class AsyncViewTests(TestCase):
+    '''
+    The async versions of the API endpoints, served under ASGI, answer like
+    the synchronous ones
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        cache.search_results.clear()
+        cache.time_slots.clear()
+        self.factory = AsyncRequestFactory()
+        self.specialty = Specialty.objects.create(name='cardiology')
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True, specialty=self.specialty)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.date = next_weekday(datetime.date.today())
+        self.time = DEFAULT_TIME_SLOTS[0]
+
+    def call(self, view, method, data, user=None, **headers):
+        if method == 'post':
+            request = self.factory.post('/', urlencode(data), content_type='application/x-www-form-urlencoded')
+        else:
+            request = self.factory.get('/', data)
+        # the async request factory of Django 4.1 does not take headers
+        request.META.update(headers)
+        request.user = user or AnonymousUser()
+        request._messages = CookieStorage(request)
+        return async_to_sync(view)(request)
+
+    def test_search(self):
+        response = self.call(views.search_async, 'get', {'search_term': 'lee'})
+        self.assertEqual([doctor['doctor_id'] for doctor in json.loads(response.content)['results']], [self.doctor.id])
+        # answered from the cache
+        response = self.call(
+            views.search_async, 'get', {'search_term': 'lee'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.call(views.search_async, 'get', {}).status_code, 400)
+
+    def test_time_availabilities(self):
+        data = {'doctor_id': self.doctor.id, 'date': self.date.strftime('%Y%m%d')}
+        self.assertEqual(self.call(views.time_availabilities_async, 'get', data).status_code, 302)
+        self.doctor.book(self.patient, self.date, self.time)
+        response = self.call(views.time_availabilities_async, 'get', data, self.patient)
+        self.assertEqual(
+            json.loads(response.content)['time_slots'],
+            [time.strftime('%H:%M') for time in self.doctor.available_time_slots(self.date)])
+        self.assertNotIn(self.time.strftime('%H:%M'), json.loads(response.content)['time_slots'])
+        bad_requests = [
+            {'doctor_id': self.doctor.id}, {**data, 'date': 'monday'}, {**data, 'doctor_id': self.patient.id}]
+        for bad_request in bad_requests:
+            self.assertEqual(self.call(views.time_availabilities_async, 'get', bad_request, self.patient).status_code, 400)
+        with self.assertRaises(Http404):
+            self.call(views.time_availabilities_async, 'get', {**data, 'doctor_id': 0}, self.patient)
+
+    def test_book_and_cancel(self):
+        data = {
+            'doctor_id': self.doctor.id, 'date': self.date.strftime('%Y%m%d'),
+            'time': self.time.strftime('%H:%M')}
+        self.assertEqual(self.call(views.appointment_book_async, 'get', data, self.patient).status_code, 400)
+        self.assertEqual(self.call(views.appointment_book_async, 'post', data, self.patient).status_code, 204)
+        appointment = Appointment.objects.get(doctor=self.doctor, patient=self.patient)
+        self.assertEqual((appointment.date, appointment.time), (self.date, self.time))
+        self.assertEqual(self.call(views.appointment_book_async, 'post', data, self.patient).status_code, 409)
+        self.assertEqual(self.call(views.appointment_book_async, 'post', {**data, 'time': '03:00'}, self.patient).status_code, 400)
+
+        other = User.objects.create_user(username='other', email='other@doctors.test')
+        cancel = {'appointment_id': appointment.id}
+        self.assertEqual(self.call(views.appointment_cancel_async, 'post', cancel, other).status_code, 400)
+        self.assertEqual(self.call(views.appointment_cancel_async, 'post', cancel, self.patient).status_code, 204)
+        self.assertFalse(Appointment.objects.exists())
+        self.assertEqual(self.doctor.busy_slots.filter(date=self.date).values_list('mask', flat=True).first() or 0, 0)
+
+
+class LiveSlotsTests(TestCase):
+    '''
+    The stream of server-sent events of the booking page sends the free time
+    slots, then the slots taken and freed when appointments change
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', is_doctor=True)
+        self.patient = User.objects.create_user(username='patient', email='patient@doctors.test')
+        self.date = next_weekday(datetime.date.today())
+        self.time = DEFAULT_TIME_SLOTS[0]
+        self.client.force_login(self.patient)
+        self.cookie = f"{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    def scope(self, query, method='GET', cookie=True):
+        return {
+            'type': 'http', 'method': method, 'path': live.STREAM_PATH,
+            'query_string': query.encode(),
+            'headers': [(b'cookie', self.cookie.encode())] if cookie else [],
+        }
+
+    def query(self, doctor_id=None):
+        return f"doctor_id={doctor_id or self.doctor.id}&dates={self.date.strftime('%Y%m%d')}"
+
+    def status(self, scope):
+        sent = []
+        async def receive():
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        async_to_sync(live.stream_slots)(scope, receive, send)
+        return sent[0]['status']
+
+    def events(self, body):
+        return [
+            json.loads(line[len('data: '):])
+            for line in body.decode().splitlines() if line.startswith('data: ')]
+
+    def book(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.book(self.patient, self.date, self.time)
+
+    def test_stream(self):
+        async def stream():
+            disconnect = asyncio.Event()
+            bodies = asyncio.Queue()
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+            async def send(message):
+                await bodies.put(message)
+            task = asyncio.ensure_future(live.stream_slots(self.scope(self.query()), receive, send))
+            start = await asyncio.wait_for(bodies.get(), 5)
+            first = await asyncio.wait_for(bodies.get(), 5)
+            # booked in the thread of the test, which holds its transaction
+            await sync_to_async(self.book)()
+            change = await asyncio.wait_for(bodies.get(), 5)
+            disconnect.set()
+            await asyncio.wait_for(task, 5)
+            self.assertEqual(live.broker.subscribers, {})
+            self.assertEqual(live.watches.watches, {})
+            return start, first, change
+
+        start, first, change = async_to_sync(stream)()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), start['headers'])
+        slots = [time.strftime('%H:%M') for time in self.doctor.available_time_slots(self.date)]
+        taken = self.time.strftime('%H:%M')
+        self.assertEqual(self.events(first['body']), [
+            {'date': self.date.strftime('%Y%m%d'), 'time_slots': [taken] + slots}])
+        self.assertEqual(self.events(change['body']), [
+            {'date': self.date.strftime('%Y%m%d'), 'time_slots': slots, 'taken': [taken], 'freed': []}])
+
+    def test_shared_watch(self):
+        async def streams():
+            disconnect = asyncio.Event()
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+            bodies = [asyncio.Queue(), asyncio.Queue()]
+            tasks = [
+                asyncio.ensure_future(live.stream_slots(self.scope(self.query()), receive, queue.put))
+                for queue in bodies]
+            for queue in bodies:
+                # the start of the response and the first events
+                await asyncio.wait_for(queue.get(), 5)
+                await asyncio.wait_for(queue.get(), 5)
+            # a single watch, checking the busy slots for both streams
+            self.assertEqual(len(live.watches.watches), 1)
+            self.assertEqual(len(live.broker.subscribers[self.doctor.id]), 1)
+            await sync_to_async(self.book)()
+            changes = [await asyncio.wait_for(queue.get(), 5) for queue in bodies]
+            disconnect.set()
+            await asyncio.wait_for(asyncio.gather(*tasks), 5)
+            self.assertEqual(live.watches.watches, {})
+            self.assertEqual(live.broker.subscribers, {})
+            return changes
+
+        first, second = async_to_sync(streams)()
+        self.assertEqual(first['body'], second['body'])
+        self.assertEqual(self.events(first['body'])[0]['taken'], [self.time.strftime('%H:%M')])
+
+    def test_errors(self):
+        self.assertEqual(self.status(self.scope(self.query(), method='POST')), 405)
+        self.assertEqual(self.status(self.scope('doctor_id=x&dates=20240125')), 400)
+        self.assertEqual(self.status(self.scope(f"doctor_id={self.doctor.id}")), 400)
+        self.assertEqual(self.status(self.scope(self.query(), cookie=False)), 403)
+        self.assertEqual(self.status(self.scope(self.query(self.patient.id))), 404)
+
+
+class StreamingResponseTests(TransactionTestCase):
+    '''
+    Under ASGI, responses streamed from the database are sent as their
+    chunks are generated, each one in the thread of the view
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.date = next_weekday(datetime.date.today())
+        for time in DEFAULT_TIME_SLOTS[:3]:
+            self.doctor.book(self.patient, self.date, time)
+
+    def test_chunks_generated_as_sent(self):
+        log = []
+        def chunks():
+            for appointment in Appointment.objects.order_by('time'):
+                log.append('chunk')
+                yield appointment.time.strftime('%H:%M\n').encode()
+        messages = []
+        async def send(message):
+            log.append('send')
+            messages.append(message)
+        response = streaming_response(chunks(), 'text/plain')
+        async_to_sync(StreamingASGIHandler().send_response)(response, send)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(
+            b''.join(message.get('body', b'') for message in messages[1:]),
+            b''.join(time.strftime('%H:%M\n').encode() for time in DEFAULT_TIME_SLOTS[:3]))
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        # each chunk is sent before the next one is generated
+        self.assertEqual(log, ['send'] + ['chunk', 'send'] * 3 + ['send'])
+
+    def request(self, path, query_string=b'', cookie=None):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string,
+            'headers': [(b'host', b'testserver')] + ([(b'cookie', cookie.encode())] if cookie else []),
+        }
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+        async def send(message):
+            messages.append(message)
+        async_to_sync(StreamingASGIHandler())(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def test_calendar_feed(self):
+        feed = CalendarFeed.objects.create(user=self.patient)
+        status, body = self.request(f'/appointments/calendar/{feed.token}.ics')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.count(b'BEGIN:VEVENT'), 3)
+
+    def test_exports(self):
+        staff = User.objects.create_user(username='staff', email='staff@doctors.test', is_staff=True)
+        self.client.force_login(staff)
+        cookie = f"{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}"
+        status, body = self.request('/appointments/export', b'format=csv', cookie)
+        self.assertEqual(status, 200)
+        # the header and the appointments
+        self.assertEqual(len(body.splitlines()), 4)
+        status, body = self.request('/appointments/export', b'format=jsonl', cookie)
+        self.assertEqual(
+            [json.loads(line)['patient_id'] for line in body.splitlines()], [self.patient.id] * 3)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_PIN_SECONDS=10)
+class ReplicaRouterTests(TestCase):
+    '''
+    Reads of the read_from_replica views go to a replica unless the user is
+    pinned to the primary by a pin_to_primary view, everything else to the
+    primary
+    '''
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.databases_read = []
+
+    def read(self, request):
+        self.databases_read.append((
+            router.db_for_read(Appointment), router.db_for_read(Session), router.db_for_write(Appointment)))
+        return HttpResponse()
+
+    async def aread(self, request):
+        # the replica is copied to the threads running the queries
+        return await sync_to_async(self.read)(request)
+
+    def test_read_from_replica(self):
+        view = read_from_replica(self.read)
+        view(self.factory.get('/'))
+        # sessions are always read from the primary
+        self.assertEqual(self.databases_read, [('replica1', 'default', 'default')])
+        self.assertEqual(router.db_for_read(Appointment), 'default')
+        pinned = self.factory.get('/')
+        pinned.COOKIES[PIN_COOKIE] = '1'
+        view(pinned)
+        with override_settings(DATABASE_REPLICAS=[]):
+            view(self.factory.get('/'))
+        self.assertEqual(self.databases_read[1:], [('default', 'default', 'default')] * 2)
+
+    def test_read_from_replica_async(self):
+        view = read_from_replica(self.aread)
+        async_to_sync(view)(self.factory.get('/'))
+        self.assertEqual(self.databases_read, [('replica1', 'default', 'default')])
+        self.assertEqual(router.db_for_read(Appointment), 'default')
+
+    def test_pin_to_primary(self):
+        response = pin_to_primary(lambda request: HttpResponse())(self.factory.post('/'))
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 10)
+        response = pin_to_primary(lambda request: HttpResponse(status=400))(self.factory.post('/'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        async def view(request):
+            return HttpResponse(status=204)
+        response = async_to_sync(pin_to_primary(view))(self.factory.post('/'))
+        self.assertIn(PIN_COOKIE, response.cookies)
+        with override_settings(DATABASE_REPLICAS=[]):
+            response = pin_to_primary(lambda request: HttpResponse())(self.factory.post('/'))
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_migrations(self):
+        self.assertFalse(router.allow_migrate('replica1', 'doctors'))
+        self.assertTrue(router.allow_migrate('default', 'doctors'))
+
+
+class CalendarFeedTests(TestCase):
+    '''
+    The iCalendar feed is versioned by the last change of the appointments
+    of its user, and answers conditional requests with a 304
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.date = next_weekday(datetime.date.today())
+        self.feed = CalendarFeed.objects.create(user=self.patient)
+        self.url = f'/appointments/calendar/{self.feed.token}.ics'
+
+    def book(self, time):
+        self.doctor.book(self.patient, self.date, time)
+
+    def test_feed(self):
+        self.book(DEFAULT_TIME_SLOTS[0])
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        body = response.getvalue().decode()
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertEqual(body.count('BEGIN:VEVENT'), 1)
+        self.assertIn('SUMMARY:Appointment with Doctor Ann Lee\r\n', body)
+        self.assertEqual(self.client.get('/appointments/calendar/unknown.ics').status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+    def test_conditional_requests(self):
+        self.book(DEFAULT_TIME_SLOTS[0])
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        # a booking gives the feed a new version
+        self.book(DEFAULT_TIME_SLOTS[1])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.getvalue().decode().count('BEGIN:VEVENT'), 2)
+
+
+class ExportTests(TestCase):
+    '''
+    The staff export the appointments as CSV or JSON lines, filtered by
+    dates and doctor
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', first_name='=Ann', last_name='Lee',
+            is_doctor=True)
+        self.patient = User.objects.create_user(
+            username='patient', email='patient@doctors.test', first_name='Bob', last_name='Ray')
+        self.dates = next_weekdays(datetime.date.today(), 2)
+        for date in self.dates:
+            self.doctor.book(self.patient, date, DEFAULT_TIME_SLOTS[0])
+        self.staff = User.objects.create_user(username='staff', email='staff@doctors.test', is_staff=True)
+
+    def export(self, **data):
+        response = self.client.get('/appointments/export', data)
+        self.assertEqual(response.status_code, 200)
+        return response.getvalue().decode()
+
+    def test_exports(self):
+        self.assertEqual(self.client.get('/appointments/export').status_code, 302)
+        self.client.force_login(self.staff)
+        lines = self.export(format='csv').splitlines()
+        self.assertEqual(lines[0].split(','), export.HEADER)
+        self.assertEqual(len(lines), 3)
+        # names are not run as formulas by spreadsheets
+        self.assertIn(",'=Ann,", lines[1])
+        end = self.dates[0].strftime('%Y%m%d')
+        lines = self.export(format='jsonl', end=end).splitlines()
+        self.assertEqual([json.loads(line)['date'] for line in lines], [str(self.dates[0])])
+        self.assertEqual(self.export(format='jsonl', doctor_id=self.patient.id), '')
+        for data in [{'format': 'xml'}, {'start': 'monday'}, {'doctor_id': 'x'}]:
+            self.assertEqual(self.client.get('/appointments/export', data).status_code, 400)
+
+
+class ArchiveTests(TestCase):
+    '''
+    Appointments are moved to the archive in batches, which can be
+    interrupted and resumed, and their busy slots are freed then deleted
+    '''
+    def setUp(self):
+        cache.schedules.clear()
+        self.doctor = User.objects.create_user(
+            username='doctor', email='doctor@doctors.test', is_doctor=True)
+        self.patient = User.objects.create_user(username='patient', email='patient@doctors.test')
+        # appointments can only be booked in the future, they are archived
+        #   before a future date
+        self.dates = next_weekdays(datetime.date.today(), 3)
+        for date, count in zip(self.dates, (3, 2, 1)):
+            for time in DEFAULT_TIME_SLOTS[:count]:
+                self.doctor.book(self.patient, date, time)
+        self.before = self.dates[2]
+
+    def busy_dates(self):
+        return sorted(set(BusySlots.objects.values_list('date', flat=True)))
+
+    def test_batches(self):
+        ids = list(Appointment.objects.filter(date__lt=self.before).order_by('date', 'id').values_list('id', flat=True))
+        self.assertEqual(archive_batch(self.before, 2), 2)
+        # the first date is not fully archived yet, one slot is still taken
+        self.assertEqual(self.busy_dates(), self.dates)
+        self.assertEqual(
+            BusySlots.objects.get(user=self.doctor, date=self.dates[0]).mask,
+            compiled_schedule(self.doctor.id).slot_bits(DEFAULT_TIME_SLOTS[2]))
+        self.assertEqual(self.doctor.available_time_slots(self.dates[0]), DEFAULT_TIME_SLOTS[:2] + DEFAULT_TIME_SLOTS[3:])
+        counts = [archive_batch(self.before, 2) for _ in range(3)]
+        self.assertEqual(counts, [2, 1, 0])
+        self.assertEqual(list(AppointmentArchive.objects.order_by('date', 'id').values_list('id', flat=True)), ids)
+        self.assertEqual(list(Appointment.objects.values_list('date', flat=True)), [self.before])
+        # the busy slots of the fully archived dates are deleted, those of
+        #   the last date of the last batch by finish
+        self.assertEqual(self.busy_dates(), self.dates[1:])
+        finish_archive(self.before)
+        self.assertEqual(self.busy_dates(), [self.before])
+        self.assertEqual(self.doctor.available_time_slots(self.before), DEFAULT_TIME_SLOTS[1:])
+        # the views reading past appointments see both tables
+        self.assertEqual(sum(queryset.count() for queryset in archived_and_current(patient_id=self.patient.id)), 6)
+
+    def test_resume(self):
+        # a batch interrupted before its transaction commits leaves nothing half moved
+        with self.assertRaises(OperationalError):
+            with transaction.atomic():
+                archive_batch(self.before, 4)
+                raise OperationalError('database is locked')
+        self.assertEqual(AppointmentArchive.objects.count(), 0)
+        self.assertEqual(Appointment.objects.count(), 6)
+        while archive_batch(self.before, 4):
+            pass
+        self.assertEqual((AppointmentArchive.objects.count(), Appointment.objects.count()), (5, 1))
+
+    def test_command(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with self.assertRaises(CommandError):
+            call_command('archive_appointments', before=tomorrow.isoformat(), stdout=io.StringIO())
+        # nothing is in the past
+        call_command('archive_appointments', stdout=io.StringIO())
+        self.assertEqual(AppointmentArchive.objects.count(), 0)
+
+
+class ThumbnailTests(MediaRootMixin, TestCase):
+    '''
+    Renditions are made only of the widths a picture has, and srcset lists
+    only the renditions that exist
+    '''
+
+    def widths(self, srcset):
+        return [int(entry.rsplit(' ', 1)[1].rstrip('w')) for entry in srcset.split(', ') if entry]
+
+    def test_never_enlarges(self):
+        name = self.picture('small.png', 100)
+        thumbnails.make_renditions(name)
+        self.assertTrue(thumbnails.has_renditions(name))
+        for extension in ('jpg', 'webp'):
+            self.assertEqual(self.widths(thumbnails.srcset(name, extension)), [64])
+            self.assertFalse(default_storage.exists(thumbnails.rendition_name(name, 160, extension)))
+        with default_storage.open(thumbnails.rendition_name(name, 64, 'jpg')) as f:
+            self.assertEqual(Image.open(f).width, 64)
+
+    def test_large_picture(self):
+        name = self.picture('large.png', 400)
+        thumbnails.make_renditions(name)
+        self.assertEqual(self.widths(thumbnails.srcset(name, 'webp')), [64, 160, 320])
+
+    def test_missing_renditions(self):
+        name = self.picture('new.png', 400)
+        self.assertFalse(thumbnails.has_renditions(name))
+        self.assertEqual(thumbnails.srcset(name, 'jpg'), '')
+        # making or deleting the renditions forgets the widths found before
+        thumbnails.make_renditions(name)
+        self.assertEqual(self.widths(thumbnails.srcset(name, 'jpg')), [64, 160, 320])
+        thumbnails.delete_renditions(name)
+        self.assertEqual(thumbnails.srcset(name, 'jpg'), '')
@@ -0,0 +1,119 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .cache import LRUCache
+
+import io
+import pathlib
+
+# widths in pixels of the renditions made of each user picture
+WIDTHS = (64, 160, 320)
+# (Pillow format, file extension, save options) of the renditions
+FORMATS = (
+    ('JPEG', 'jpg', {'quality': 80, 'optimize': True, 'progressive': True}),
+    ('WEBP', 'webp', {'quality': 75, 'method': 6}),
+)
+# renditions are stored in this folder of the media root
+FOLDER = 'thumbnails'
+# (name, extension) -> widths of the renditions found in the storage.
+#   Other processes, e.g. the thumbnails command, may make renditions,
+#   so the widths are looked up again after a while
+found_widths = LRUCache(maxsize=10000, ttl=300)
+
+
+def rendition_name(name, width, extension):
+    '''
+    Storage name of a rendition of the picture stored as name,
+    e.g.: rendition_name('alice.png', 160, 'webp') is 'thumbnails/alice-160.webp'
+    '''
+    # usernames cannot contain '/', so renditions never clash with originals
+    return f"{FOLDER}/{pathlib.Path(name).stem}-{width}.{extension}"
+
+
+def rendition_names(name):
+    return [
+        rendition_name(name, width, extension)
+        for width in WIDTHS for _, extension, _ in FORMATS]
+
+
+def rendition_widths(name, extension, storage=default_storage):
+    '''
+    Widths of the renditions of the picture stored as name that exist in one format
+    '''
+    widths = found_widths.get((name, extension))
+    if widths is None:
+        widths = tuple(
+            width for width in WIDTHS
+            if storage.exists(rendition_name(name, width, extension)))
+        found_widths.set((name, extension), widths)
+    return widths
+
+
+def srcset(name, extension):
+    '''
+    srcset attribute listing the renditions of a picture in one format,
+    e.g.: '/images/thumbnails/alice-64.jpg 64w, /images/thumbnails/alice-160.jpg 160w, ...'
+    Only the renditions that exist are listed, none for pictures narrower than
+    the smallest width or whose renditions were never made
+    '''
+    if not name:
+        return ''
+    return ', '.join(
+        f"{default_storage.url(rendition_name(name, width, extension))} {width}w"
+        for width in rendition_widths(name, extension))
+
+
+def forget_widths(name):
+    for _, extension, _ in FORMATS:
+        found_widths.delete((name, extension))
+
+
+def make_renditions(name, storage=default_storage):
+    '''
+    Resizes and recompresses the picture stored as name into each
+    width and format, replacing the renditions previously made.
+    Pictures are never enlarged, so no rendition is made of the widths
+    larger than the picture
+    '''
+    with storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        # apply the camera orientation, which is lost when saving
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no transparency, use a white background
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+    for width in WIDTHS:
+        for image_format, extension, options in FORMATS:
+            target = rendition_name(name, width, extension)
+            storage.delete(target)
+            if width > image.width:
+                continue
+            rendition = image.copy()
+            # keeps the aspect ratio
+            rendition.thumbnail((width, width * 10), Image.LANCZOS)
+            content = io.BytesIO()
+            rendition.save(content, image_format, **options)
+            storage.save(target, ContentFile(content.getvalue()))
+    forget_widths(name)
+
+
+def has_renditions(name, storage=default_storage):
+    '''
+    Whether the renditions of the smallest width, made of all but the
+    narrowest pictures, exist
+    '''
+    return all(
+        storage.exists(rendition_name(name, WIDTHS[0], extension))
+        for _, extension, _ in FORMATS)
+
+
+def delete_renditions(name, storage=default_storage):
+    for target in rendition_names(name):
+        storage.delete(target)
+    forget_widths(name)
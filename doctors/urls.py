@@ -1,19 +1,41 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+# Under ASGI, the API endpoints that wait on the database are served by their
+#   async versions (see asgi.py)
+if settings.ASYNC_VIEWS:
+    search = views.search_async
+    time_availabilities = views.time_availabilities_async
+    appointment_book = views.appointment_book_async
+    appointment_cancel = views.appointment_cancel_async
+else:
+    search = views.search
+    time_availabilities = views.time_availabilities
+    appointment_book = views.appointment_book
+    appointment_cancel = views.appointment_cancel
+
 app_name = 'doctors'
 urlpatterns = [
     # Search for doctors
     path("", views.index, name="index"),
-    path("search/", views.search, name="search"), # API endpoint. Returns JSON.
+    path("search/", search, name="search"), # API endpoint. Returns JSON.
+    path("search/suggest", views.search_suggest, name="search-suggest"), # API endpoint. Returns JSON.
 
     # Book and manage appointments
     path("book/<int:doctor_id>", views.book, name="book"),
-    path("book/slots", views.time_availabilities, name="time-slots"), # API endpoint.
-    path("book/confirm", views.appointment_book, name="book-confirm"), # API endpoint.
+    path("book/slots", time_availabilities, name="time-slots"), # API endpoint.
+    path("book/availabilities", views.time_availabilities_batch, name="time-slots-batch"), # API endpoint.
+    path("book/earliest", views.earliest, name="earliest"), # API endpoint.
+    path("book/confirm", appointment_book, name="book-confirm"), # API endpoint.
+    path("book/series", views.appointment_book_series, name="book-series"), # API endpoint.
     path("appointments", views.appointments, name="appointments"),
-    path("appointments/cancel", views.appointment_cancel, name="appointments-cancel"), # API endpoint.
+    path("appointments/more", views.appointments_more, name="appointments-more"), # API endpoint.
+    path("appointments/cancel", appointment_cancel, name="appointments-cancel"), # API endpoint.
+    path("appointments/calendar/<str:token>.ics", views.calendar_feed, name="calendar-feed"), # iCalendar.
+    path("appointments/calendar/reset", views.calendar_reset, name="calendar-reset"),
+    path("appointments/export", views.appointments_export, name="appointments-export"), # CSV or JSON lines, staff only.
 
     # User personal data and picture uploading
     path("users/<int:user_id>", views.user_detail, name="user-detail"),
@@ -24,4 +46,7 @@ urlpatterns = [
     path("register", views.register, name="register"),
     path("login", views.login_view, name="login"),
     path("logout", views.logout_view, name="logout"),
+
+    # Monitoring
+    path("metrics", views.metrics, name="metrics"), # Prometheus text format.
 ]
\ No newline at end of file
@@ -3,17 +3,58 @@ from django.urls import reverse
 from django.db.models import Q
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
 from django.conf import settings
+from django.utils.html import escape
+from django.utils.http import http_date
+from django.utils.cache import get_conditional_response
+from django.utils._os import safe_join
+from django.core.exceptions import SuspiciousFileOperation
+from django.views.decorators.http import require_POST, require_safe
+from django.db import router
+
+from asgiref.sync import sync_to_async
 
 import datetime as dt
+import mimetypes
+import os
+import stat as st
+
+from .models import (
+    User, Specialty, Appointment, CalendarFeed, SlotTaken, SeriesNotBooked, BOOKED, 
+    compiled_schedule)
+
+from .forms import BookForm, BookSeriesForm, CancelForm, UserCreateForm, UserUpdateForm, PictureForm, LoginForm
+
+from .helpers import (
+    confirmation_email, series_confirmation_email, cancellation_email, doctor_to_dict, next_weekdays, 
+    appointment_cursor, parse_appointment_cursor, json_response_with_etag,
+    login_required_async, streaming_response)
+
+from .search import search_doctor_ids, search_key, search_words
+
+from .availability import earliest_available
+
+from . import suggest
+
+from .metrics import registry as metrics_registry
+
+from . import media as media_files
+
+from . import ical
 
-from .models import User, Specialty, Appointment
+from . import export
 
-from .forms import BookForm, CancelForm, UserCreateForm, UserUpdateForm, PictureForm, LoginForm
+from . import archive
 
-from .helpers import confirmation_email, cancellation_email, doctor_to_dict, next_weekdays
+from . import cache as result_cache
+
+from .db import run_atomic
+
+from .routers import is_pinned, pin_to_primary, read_from_replica
 
 #
 # Find a doctor
@@ -22,37 +63,76 @@ def index(request):
     return render(request, 'doctors/index.html')
 
 # API endpoint. Returns JSON.
+@read_from_replica
 def search(request):
     search_term = request.GET.get("search_term")
     if search_term is None:
         return HttpResponse(status=400) # bad request
-    # build query object to search doctors across first_name, last_name 
-    #   and specialty
-    query = Q(is_doctor=True)
-    query_matches_term = Q(first_name__icontains=search_term)
-    query_matches_term.add(Q(last_name__icontains=search_term), Q.OR)
-    query_matches_term.add(Q(specialty__name__icontains=search_term), Q.OR)
-    query.add(query_matches_term, Q.AND)
-    doctors_query_set = User.objects.filter(query).values(
-        'id', 'first_name', 'last_name', 'specialty__name', 'picture')
-    doctors_list = list(map(doctor_to_dict, doctors_query_set))
-    return JsonResponse({'results': doctors_list}, status=200)
+    # ids of the matching doctors, most relevant first, from the full-text 
+    #   index over first_name, last_name, specialty and description
+    # identical searches are served from the cache, which is kept up to 
+    #   date by the signal receivers of signals.py
+    key = search_key(search_term)
+    entry = result_cache.search_results.get(key)
+    if entry is None:
+        entry = search_entry(key, search_term)
+    content, etag = entry[:2]
+    return json_response_with_etag(request, content, etag)
+
+def search_entry(key, search_term):
+    '''
+    Queries the doctors matching the search term and caches the response
+    '''
+    doctor_ids = search_doctor_ids(search_term)
+    doctors_query_set = User.objects.filter(id__in=doctor_ids, is_doctor=True).values(
+        'id', 'first_name', 'last_name', 'specialty_id', 'specialty__name', 'picture')
+    doctors_by_id = {doctor['id']: doctor for doctor in doctors_query_set}
+    doctors_list = [
+        doctor_to_dict(doctors_by_id[doctor_id]) for doctor_id in doctor_ids 
+        if doctor_id in doctors_by_id]
+    content = JsonResponse({'results': doctors_list}).content
+    entry = (content, result_cache.etag(content), search_words(search_term))
+    tags = [('doctor', doctor['id']) for doctor in doctors_by_id.values()]
+    tags += [('specialty', doctor['specialty_id']) for doctor in doctors_by_id.values()]
+    result_cache.search_results.set(key, entry, tags)
+    return entry
+
+# API endpoint. Returns JSON.
+def search_suggest(request):
+    prefix = request.GET.get("prefix")
+    if prefix is None:
+        return HttpResponse(status=400) # bad request
+    # completions come from the in-memory trie, no database query is made
+    suggestions = [
+        # escape user generated content to prevent XSS attacks
+        {'text': escape(text), 'kind': kind} for text, kind in suggest.complete(prefix)]
+    return JsonResponse({'suggestions': suggestions}, status=200)
 
 
 #
 # Book and manage appointments
 #
+
+# Number of dates to display on the booking screen
+NUM_DATES = 10
+# Maximum number of dates returned by the time_availabilities_batch view
+MAX_AVAILABILITY_DATES = 60
+# Default and maximum number of appointments returned by the earliest view
+NUM_EARLIEST = 10
+MAX_EARLIEST = 50
+# Number of appointments per page on the appointments screen
+APPOINTMENTS_PAGE_SIZE = 20
+
 @login_required
+@read_from_replica
 def book(request, doctor_id):
-    # Number of dates to display on the booking screen
-    NUM_DATES = 10
     doctor = get_object_or_404(User, pk=doctor_id)
     if not doctor.is_doctor:
         return HttpResponse(status=400) # bad request
     # Make sure doctors cannot book appointments with themselves
     if request.user == doctor:
         return HttpResponseRedirect(reverse("doctors:index"))
-    dates = next_weekdays(dt.date.today(), NUM_DATES)
+    dates = doctor.working_days(dt.date.today(), NUM_DATES)
     return render(request, 'doctors/book.html', {
         'doctor': doctor,
         'dates': dates,
@@ -60,25 +140,125 @@ def book(request, doctor_id):
 
 # API endpoint
 @login_required
+@read_from_replica
 def time_availabilities(request):
     doctor_id = request.GET.get("doctor_id")
     date = request.GET.get("date")
     if doctor_id is None or date is None:
         return HttpResponse(status=400) # bad request
+    try:
+        doctor_id = int(doctor_id)
+        date_object = dt.datetime.strptime(date, "%Y%m%d").date()
+    except ValueError:
+        return HttpResponse(status=400) # bad request
+    # served from the cache until an appointment of the doctor on that date
+    #   is booked or cancelled
+    key = result_cache.slots_key(doctor_id, date_object)
+    # users who just booked or cancelled read the slots from the primary 
+    #   instead of the cache, which may have been filled from a replica
+    #   that had not caught up yet
+    entry = None if is_pinned(request) else result_cache.time_slots.get(key)
+    if entry is None:
+        doctor = get_object_or_404(User, pk=doctor_id)
+        if not doctor.is_doctor:
+            return HttpResponse(status=400) # bad request
+        time_slots = doctor.available_time_slots(date_object)
+        entry = time_slots_entry(key, doctor_id, time_slots)
+    content, etag = entry
+    # the slots are only shown to logged in users
+    return json_response_with_etag(request, content, etag, cache_control='private, no-cache')
+
+
+def time_slots_entry(key, doctor_id, time_slots):
+    '''
+    Caches the response of the time_availabilities view
+    '''
+    entry = time_slots_content(time_slots)
+    result_cache.time_slots.set(key, entry, [('doctor', doctor_id)])
+    return entry
+
+def time_slots_content(time_slots):
+    '''
+    Returns the (content, etag) response of the time_availabilities view
+    '''
+    time_slot_strings = [time_slot.strftime("%H:%M") for time_slot in time_slots]
+    content = JsonResponse({'time_slots': time_slot_strings}).content
+    return (content, result_cache.etag(content))
+
+
+# API endpoint. Time slots for all the weekdays of a date range.
+@login_required
+@read_from_replica
+def time_availabilities_batch(request):
+    doctor_id = request.GET.get("doctor_id")
+    if doctor_id is None:
+        return HttpResponse(status=400) # bad request
+    start_string = request.GET.get("start")
+    end_string = request.GET.get("end")
+    if (start_string is None) != (end_string is None):
+        return HttpResponse(status=400) # bad request
+    if start_string is not None:
+        try:
+            start = dt.datetime.strptime(start_string, "%Y%m%d").date()
+            end = dt.datetime.strptime(end_string, "%Y%m%d").date()
+        except ValueError:
+            return HttpResponse(status=400) # bad request
+        # past dates cannot be booked
+        start = max(start, dt.date.today() + dt.timedelta(days=1))
+        # avoid looping over very long ranges, weekdays are 5/7 of the days
+        if (end - start).days > MAX_AVAILABILITY_DATES * 7 // 5 + 7:
+            return HttpResponse(status=400) # bad request
     doctor = get_object_or_404(User, pk=doctor_id)
     if not doctor.is_doctor:
         return HttpResponse(status=400) # bad request
+    if start_string is None:
+        # the dates displayed on the booking screen
+        dates = doctor.working_days(dt.date.today(), NUM_DATES)
+    else:
+        dates = compiled_schedule(doctor.id).days_between(start, end)
+    if len(dates) > MAX_AVAILABILITY_DATES:
+        return HttpResponse(status=400) # bad request
+    time_slots_by_date = doctor.available_time_slots_by_date(dates)
+    availabilities = {
+        date.strftime("%Y%m%d"): [time_slot.strftime("%H:%M") for time_slot in time_slots]
+        for date, time_slots in time_slots_by_date.items()}
+    return JsonResponse({'availabilities': availabilities}, status=200)
+
+
+# API endpoint. Earliest free appointments with the doctors of a specialty.
+@login_required
+@read_from_replica
+def earliest(request):
+    specialty_name = request.GET.get("specialty")
+    if specialty_name is None:
+        return HttpResponse(status=400) # bad request
     try:
-        date_object = dt.datetime.strptime(date, "%Y%m%d").date()
-    except:
+        count = int(request.GET.get("count", NUM_EARLIEST))
+        # horizon, in number of weekdays
+        num_dates = int(request.GET.get("days", NUM_DATES))
+    except ValueError:
+        return HttpResponse(status=400) # bad request
+    if not 0 < count <= MAX_EARLIEST or not 0 < num_dates <= MAX_AVAILABILITY_DATES:
         return HttpResponse(status=400) # bad request
-    time_slots = doctor.available_time_slots(date_object)
-    time_slot_strings = [time_slot.strftime("%H:%M") for time_slot in time_slots];
-    return JsonResponse({'time_slots': time_slot_strings}, status=200)
+    specialty = get_object_or_404(Specialty, name__iexact=specialty_name)
+    # the horizon is counted in weekdays, doctors may also work on weekends
+    today = dt.date.today()
+    last = next_weekdays(today, num_dates)[-1]
+    dates = [today + dt.timedelta(days=days) for days in range(1, (last - today).days + 1)]
+    slots = earliest_available(specialty, dates, count)
+    # doctors may have more than one of the earliest slots
+    doctors_query_set = User.objects.filter(id__in={slot[0] for slot in slots}).values(
+        'id', 'first_name', 'last_name', 'specialty__name', 'picture')
+    doctors_by_id = {doctor['id']: doctor_to_dict(doctor) for doctor in doctors_query_set}
+    results = [
+        dict(doctors_by_id[doctor_id], date=date.strftime("%Y%m%d"), time=time.strftime("%H:%M"))
+        for doctor_id, date, time in slots]
+    return JsonResponse({'results': results}, status=200)
 
 
 # API endpoint.
 @login_required
+@pin_to_primary
 def appointment_book(request):
     def flash_problem():
         messages.add_message(
@@ -104,23 +284,19 @@ def appointment_book(request):
             flash_problem()
             return HttpResponse(status=400) # bad request
         else:
-            if patient.slot_is_taken(date, time):
-                messages.add_message(
-                    request, messages.INFO, 'You already have another appointment at the time you chose.', 'danger')
+            # checking the slot is free, booking it and queuing the 
+            #   confirmation email is a single transaction, retried when
+            #   the database is locked by another writer
+            try:
+                run_atomic(book_and_queue_email, doctor, patient, date, time)
+            except SlotTaken as conflict:
+                messages.add_message(request, messages.INFO, conflict_message(conflict, patient), 'danger')
+                return HttpResponse(status=409) # conflict
+            except ValueError:
+                # e.g. past dates, or times the doctor does not work, checked
+                #   against the current schedule rather than a cached one
+                flash_problem()
                 return HttpResponse(status=400) # bad request
-            doctor.book(patient, date, time)
-            # make sure the email configuration has been set
-            if settings.EMAIL_HOST_USER:
-                # Send email to the patient.
-                try:
-                    confirmation_email(
-                        to_first_name=patient.first_name, 
-                        to_email=patient.email, 
-                        doctor=doctor.get_full_name(),
-                        date=date.strftime("%d %B %Y"), 
-                        time=time.strftime("%H:%M"),)
-                except Exception as e: 
-                    print(e)
             messages.add_message(
                 request, messages.INFO, f"Your appointment with Doctor {doctor.get_full_name()} has been booked.", 'info')
             return HttpResponse(status=204) # no content
@@ -129,22 +305,161 @@ def appointment_book(request):
         return HttpResponse(status=400) # bad request
 
 
+def book_and_queue_email(doctor, patient, date, time):
+    doctor.book(patient, date, time)
+    # make sure the email configuration has been set
+    if settings.EMAIL_HOST_USER:
+        # Queue email to the patient, sent by the send_emails command
+        confirmation_email(
+            to_first_name=patient.first_name, 
+            to_email=patient.email, 
+            doctor=doctor.get_full_name(),
+            date=date.strftime("%d %B %Y"), 
+            time=time.strftime("%H:%M"),)
+
+# API endpoint.
+@login_required
+@pin_to_primary
+def appointment_book_series(request):
+    '''
+    Books a series of appointments with a doctor, all of them or none, and
+    returns the outcome of each of its slots: booked with the id of the 
+    appointment, or why it cannot be booked (see models.SeriesNotBooked)
+    '''
+    if request.method != 'POST':
+        return HttpResponse(status=400) # bad request
+    form = BookSeriesForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400) # bad request
+    doctor = get_object_or_404(User, pk=form.cleaned_data.get('doctor_id'))
+    patient = request.user
+    if not doctor.is_doctor or doctor == patient:
+        return HttpResponse(status=400) # bad request
+    series = form.cleaned_data.get('series')
+    # a single transaction for the whole series and its confirmation email,
+    #   retried when the database is locked by another writer
+    try:
+        appointments = run_atomic(book_series_and_queue_email, doctor, patient, series)
+    except SeriesNotBooked as error:
+        return JsonResponse(
+            {'booked': False, 'slots': series_outcomes(series, error.outcomes)}, status=409) # conflict
+    return JsonResponse({'booked': True, 'slots': series_outcomes(
+        series, [BOOKED] * len(series), [appointment.id for appointment in appointments])}, status=201)
+
+
+def book_series_and_queue_email(doctor, patient, series):
+    appointments = doctor.book_series(patient, series)
+    # make sure the email configuration has been set
+    if settings.EMAIL_HOST_USER:
+        # a single email for the whole series
+        series_confirmation_email(
+            to_first_name=patient.first_name,
+            to_email=patient.email,
+            doctor=doctor.get_full_name(),
+            dates_and_times=[
+                (date.strftime("%d %B %Y"), time.strftime("%H:%M")) for date, time in series])
+    return appointments
+
+def series_outcomes(series, outcomes, appointment_ids=None):
+    return [
+        {'date': date.strftime("%Y%m%d"), 'time': time.strftime("%H:%M"), 'outcome': outcome,
+         'appointment_id': appointment_ids[index] if appointment_ids else None}
+        for index, ((date, time), outcome) in enumerate(zip(series, outcomes))]
+
+def conflict_message(conflict, patient):
+    if conflict.user_id == patient.id:
+        return 'You already have another appointment at the time you chose.'
+    return 'The time you chose is no longer available.'
+
+
+def upcoming_appointments_page(user, after=None):
+    '''
+    Returns a page of upcoming appointments and the cursor of the next page,
+    None for the last page. The number of queries does not depend on the
+    page size
+    '''
+    appointments = list(user.upcoming_appointments(after=after, limit=APPOINTMENTS_PAGE_SIZE + 1))
+    next_cursor = None
+    if len(appointments) > APPOINTMENTS_PAGE_SIZE:
+        appointments = appointments[:APPOINTMENTS_PAGE_SIZE]
+        next_cursor = appointment_cursor(appointments[-1])
+    return appointments, next_cursor
+
+
 @login_required
 def appointments(request):
-    if request.user.is_doctor:
-        # doctors may book appointments (as patients) with other doctors
-        query = Q(doctor=request.user)
-        query.add(Q(patient=request.user), Q.OR)
-        appointments = Appointment.objects.filter(query).select_related('patient').all()
-    else:
-        appointments = Appointment.objects.filter(patient=request.user).select_related('doctor').all()
+    # doctors may book appointments (as patients) with other doctors
+    appointments, next_cursor = upcoming_appointments_page(request.user)
+    # the feed is created the first time the user opens the page
+    feed, _ = CalendarFeed.objects.get_or_create(user=request.user)
     return render(request, 'doctors/appointments.html', {
         'appointments': appointments,
+        'next_cursor': next_cursor,
+        'calendar_url': request.build_absolute_uri(
+            reverse('doctors:calendar-feed', args=[feed.token])),
     })
 
 
+# API endpoint. Next page of upcoming appointments, as rendered cards.
+@login_required
+def appointments_more(request):
+    try:
+        after = parse_appointment_cursor(request.GET.get("after", ""))
+    except ValueError:
+        return HttpResponse(status=400) # bad request
+    appointments, next_cursor = upcoming_appointments_page(request.user, after)
+    html = render_to_string('doctors/appointment_cards.html', {
+        'appointments': appointments,
+    }, request=request)
+    return JsonResponse({'html': html, 'next_cursor': next_cursor}, status=200)
+
+
+# iCalendar feed of the appointments of a user, for calendar clients. 
+#   Authenticated by the token of its URL. The version of the feed is the 
+#   last change of the appointments of the user, so a client that already 
+#   has it gets a 304 after a single query
+@require_safe
+@read_from_replica
+def calendar_feed(request, token):
+    feed = CalendarFeed.objects.filter(token=token).values_list('user_id', 'changed').first()
+    if feed is None:
+        raise Http404
+    user_id, changed = feed
+    etag = f'"{user_id}-{int(changed.timestamp() * 1000000)}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(changed.timestamp()),
+        'Cache-Control': 'private, no-cache',
+    }
+    # 304 not modified
+    response = HttpResponse(headers=headers)
+    conditional_response = get_conditional_response(
+        request, etag=etag, last_modified=int(changed.timestamp()), response=response)
+    if conditional_response is not response:
+        return conditional_response
+    # the feed is generated after the view returns, out of read_from_replica,
+    #   so the database is chosen now
+    content = ical.feed(
+        user_id, changed, request.get_host().split(':')[0], using=router.db_for_read(Appointment))
+    headers['Content-Disposition'] = 'inline; filename="appointments.ics"'
+    return streaming_response(content, 'text/calendar; charset=utf-8', headers)
+
+
+# Gives the calendar feed a new URL, the previous one stops working
+@login_required
+@require_POST
+def calendar_reset(request):
+    feed, created = CalendarFeed.objects.get_or_create(user=request.user)
+    if not created:
+        feed.reset_token()
+    messages.add_message(
+        request, messages.INFO, 'Your calendar link has been changed.', 'info')
+    return HttpResponseRedirect(reverse("doctors:appointments"))
+
+
 # API endpoint.
 @login_required
+@pin_to_primary
 def appointment_cancel(request):
     def flash_problem():
         messages.add_message(
@@ -159,26 +474,169 @@ def appointment_cancel(request):
         if appointment.doctor != request.user and appointment.patient != request.user:
             flash_problem()
             return HttpResponse(status=400) # bad request
-        appointment.delete()
+        # retried when the database is locked by another writer
+        run_atomic(cancel_and_queue_email, appointment)
         messages.add_message(
             request, messages.INFO, 'Your appointment has been cancelled.', 'info')
-        # make sure the email configuration has been set
-        if settings.EMAIL_HOST_USER:
-            # Send email to the patient.
-            try:
-                cancellation_email(
-                    to_first_name=appointment.patient.first_name, 
-                    to_email=appointment.patient.email, 
-                    doctor=appointment.doctor.get_full_name(), 
-                    date=appointment.date.strftime("%d %B %Y"), 
-                    time=appointment.time.strftime("%H:%M"),)
-            except Exception as e: 
-                    print(e)
         return HttpResponse(status=204) # no content
     else:
         flash_problem()
         return HttpResponse(status=400) # bad request
 
+def cancel_and_queue_email(appointment):
+    appointment.delete()
+    # make sure the email configuration has been set
+    if settings.EMAIL_HOST_USER:
+        # Queue email to the patient, sent by the send_emails command
+        cancellation_email(
+            to_first_name=appointment.patient.first_name, 
+            to_email=appointment.patient.email, 
+            doctor=appointment.doctor.get_full_name(), 
+            date=appointment.date.strftime("%d %B %Y"), 
+            time=appointment.time.strftime("%H:%M"),)
+
+
+# Export of the appointments for the staff, e.g. for billing, as CSV or 
+#   JSON lines, sent as they are read from the database. Optional filters:
+#   start and end dates (YYYYMMDD, both included), doctor_id, specialty_id
+@staff_member_required
+@require_safe
+def appointments_export(request):
+    format = request.GET.get("format", "csv")
+    if format not in export.FORMATS:
+        return HttpResponse(status=400) # bad request
+    filters = {}
+    try:
+        for name in ("start", "end"):
+            if request.GET.get(name):
+                filters[name] = dt.datetime.strptime(request.GET[name], "%Y%m%d").date()
+        for name in ("doctor_id", "specialty_id"):
+            if request.GET.get(name):
+                filters[name] = int(request.GET[name])
+    except ValueError:
+        return HttpResponse(status=400) # bad request
+    # archived appointments included
+    querysets = [
+        export.filter_appointments(appointments, **filters) for appointments in archive.appointments()]
+    return export.export_response(querysets, format)
+
+
+#
+# Async versions of the API endpoints, served instead of the synchronous 
+#   ones when the project runs under ASGI (see urls.py), so that a request 
+#   waiting for the database does not hold a worker thread. Django 4.1 has 
+#   no async transactions nor async raw SQL, those run in a thread with 
+#   sync_to_async. Emails are queued in the booking transaction and sent by
+#   the send_emails worker, never on the event loop
+#
+
+# API endpoint. Returns JSON.
+@read_from_replica
+async def search_async(request):
+    search_term = request.GET.get("search_term")
+    if search_term is None:
+        return HttpResponse(status=400) # bad request
+    # cache hits do not leave the event loop, unless the cache is shared
+    key = search_key(search_term)
+    entry = await result_cache.search_results.aget(key)
+    if entry is None:
+        entry = await sync_to_async(search_entry)(key, search_term)
+    content, etag = entry[:2]
+    return json_response_with_etag(request, content, etag)
+
+# API endpoint
+@login_required_async
+@read_from_replica
+async def time_availabilities_async(request):
+    doctor_id = request.GET.get("doctor_id")
+    date = request.GET.get("date")
+    if doctor_id is None or date is None:
+        return HttpResponse(status=400) # bad request
+    try:
+        doctor_id = int(doctor_id)
+        date_object = dt.datetime.strptime(date, "%Y%m%d").date()
+    except ValueError:
+        return HttpResponse(status=400) # bad request
+    key = result_cache.slots_key(doctor_id, date_object)
+    entry = None if is_pinned(request) else await result_cache.time_slots.aget(key)
+    if entry is None:
+        doctor = await User.objects.filter(pk=doctor_id).afirst()
+        if doctor is None:
+            raise Http404
+        if not doctor.is_doctor:
+            return HttpResponse(status=400) # bad request
+        time_slots = await doctor.aavailable_time_slots(date_object)
+        entry = time_slots_content(time_slots)
+        await result_cache.time_slots.aset(key, entry, [('doctor', doctor_id)])
+    content, etag = entry
+    return json_response_with_etag(request, content, etag, cache_control='private, no-cache')
+
+# API endpoint.
+@login_required_async
+@pin_to_primary
+async def appointment_book_async(request):
+    def flash_problem():
+        messages.add_message(
+            request, messages.INFO, 'We were not able to book your appointment.', 'danger')
+    if request.method != 'POST':
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    form = BookForm(request.POST)
+    if not form.is_valid():
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    try:
+        date = dt.datetime.strptime(form.cleaned_data.get('date'), "%Y%m%d").date()
+        time = dt.datetime.strptime(form.cleaned_data.get('time'), "%H:%M").time()
+    except ValueError:
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    doctor = await User.objects.filter(pk=form.cleaned_data.get('doctor_id')).afirst()
+    if doctor is None:
+        raise Http404
+    if not doctor.is_doctor:
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    patient = request.user
+    try:
+        await sync_to_async(run_atomic)(book_and_queue_email, doctor, patient, date, time)
+    except SlotTaken as conflict:
+        messages.add_message(request, messages.INFO, conflict_message(conflict, patient), 'danger')
+        return HttpResponse(status=409) # conflict
+    except ValueError:
+        # e.g. past dates, or times the doctor does not work
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    messages.add_message(
+        request, messages.INFO, f"Your appointment with Doctor {doctor.get_full_name()} has been booked.", 'info')
+    return HttpResponse(status=204) # no content
+
+# API endpoint.
+@login_required_async
+@pin_to_primary
+async def appointment_cancel_async(request):
+    def flash_problem():
+        messages.add_message(
+            request, messages.INFO, 'We were not able to cancel your appointment.', 'danger')
+    if request.method != 'POST':
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    form = CancelForm(request.POST)
+    if not form.is_valid():
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    appointment = await Appointment.objects.select_related('doctor', 'patient').filter(
+        pk=form.cleaned_data.get('appointment_id')).afirst()
+    if appointment is None:
+        raise Http404
+    if appointment.doctor != request.user and appointment.patient != request.user:
+        flash_problem()
+        return HttpResponse(status=400) # bad request
+    await sync_to_async(run_atomic)(cancel_and_queue_email, appointment)
+    messages.add_message(
+        request, messages.INFO, 'Your appointment has been cancelled.', 'info')
+    return HttpResponse(status=204) # no content
+
 
 #
 # View and update user details, and upload a picture
@@ -338,4 +796,68 @@ def logout_view(request):
     logout(request)
     messages.add_message(
         request, messages.INFO, 'You have logged out.', 'info')
-    return HttpResponseRedirect(reverse("doctors:login"))
\ No newline at end of file
+    return HttpResponseRedirect(reverse("doctors:login"))
+
+
+#
+# Monitoring
+#
+
+# Prometheus endpoint. Histograms of the requests handled by this process.
+#   Served to the staff and to the METRICS_ALLOWED_IPS, e.g. the Prometheus
+#   server
+def metrics(request):
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponse(status=403) # forbidden
+    return HttpResponse(
+        metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+#
+# Media
+#
+
+# User pictures. Content-addressed pictures and their renditions are cached
+#   by browsers for a year, other files are revalidated with their ETag.
+#   Supports conditional requests (304) and single byte ranges (206).
+@require_safe
+def media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404
+    if not st.S_ISREG(stat.st_mode):
+        raise Http404
+    etag = media_files.etag(path, full_path, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': media_files.cache_control(path),
+        'Accept-Ranges': 'bytes',
+    }
+    # 304 not modified, or 412 precondition failed
+    response = HttpResponse(headers=headers)
+    conditional_response = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime), response=response)
+    if conditional_response is not response:
+        return conditional_response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    # a range of another version of the file is not sent
+    if if_range is None or if_range in (etag, headers['Last-Modified']):
+        try:
+            byte_range = media_files.parse_range(request.headers.get('Range'), stat.st_size)
+        except ValueError:
+            headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return HttpResponse(status=416, headers=headers) # range not satisfiable
+    if byte_range is None:
+        return FileResponse(open(full_path, 'rb'), content_type=content_type, headers=headers)
+    first, last = byte_range
+    with open(full_path, 'rb') as f:
+        f.seek(first)
+        content = f.read(last - first + 1)
+    headers['Content-Range'] = f'bytes {first}-{last}/{stat.st_size}'
+    return HttpResponse(content, status=206, content_type=content_type, headers=headers) # partial content
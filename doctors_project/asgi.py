@@ -9,8 +9,20 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'doctors_project.settings')
+# serve the async versions of the API endpoints (see doctors/urls.py)
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+# as get_asgi_application, with the handler of the responses streamed from
+#   the database (see doctors/helpers.py)
+django.setup(set_prefix=False)
+from doctors.helpers import StreamingASGIHandler
+
+django_application = StreamingASGIHandler()
+
+# streams of the time slots of the booking pages, imported once Django is set up
+from doctors.live import LiveSlotsRouter
+
+application = LiveSlotsRouter(django_application)
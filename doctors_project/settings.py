@@ -51,6 +51,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the request latency it measures covers the other middleware
+    'doctors.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,7 +66,9 @@ ROOT_URLCONF = 'doctors_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django templates, with their render time measured for the
+        #   metrics (see doctors/middleware.py)
+        'BACKEND': 'doctors.middleware.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -80,17 +84,84 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'doctors_project.wsgi.application'
 
+# Addresses allowed to read /metrics without logging in as staff, e.g. the
+#   Prometheus server, given as a comma separated list:
+#   METRICS_ALLOWED_IPS=10.0.0.5,10.0.0.6
+#   None by default: behind a reverse proxy on the same host, every request
+#   comes from the loopback address
+METRICS_ALLOWED_IPS = list(filter(None, os.getenv('METRICS_ALLOWED_IPS', '').split(',')))
+
+# Serve the async versions of the API endpoints, set by asgi.py
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# SQLite production profile, turned on with SQLITE_PRODUCTION=1: persistent
+#   connections and the SQLITE_PRODUCTION_PRAGMAS below. Off, Django's
+#   defaults are kept, e.g. for development or a database on a network drive
+SQLITE_PRODUCTION = os.getenv('SQLITE_PRODUCTION') == '1'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # keep connections open between requests, in seconds
+        'CONN_MAX_AGE': int(os.getenv('CONN_MAX_AGE', 600 if SQLITE_PRODUCTION else 0)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # seconds a connection waits for another one to release a lock
+            'timeout': 20,
+        },
+        'TEST': {
+            # a file instead of an in-memory database, so that tests run
+            #   with concurrent connections
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# Pragmas set on each new SQLite connection by the production profile (see doctors/db.py)
+SQLITE_PRODUCTION_PRAGMAS = {
+    # write-ahead log: readers and the writer do not block each other
+    'journal_mode': 'WAL',
+    # with WAL, only sync at checkpoints, commits stay durable across crashes
+    #   of the application but not across power losses
+    'synchronous': 'NORMAL',
+    # milliseconds to wait for the write lock before "database is locked"
+    'busy_timeout': 5000,
+    # read the database file through a 256 MB memory map
+    'mmap_size': 256 * 1024 * 1024,
+    # page cache of 64 MB per connection (negative values are in KB)
+    'cache_size': -64 * 1024,
+}
+SQLITE_PRAGMAS = SQLITE_PRODUCTION_PRAGMAS if SQLITE_PRODUCTION else {}
+
+# Read-only copies of the database, e.g. kept up to date with Litestream or
+#   LiteFS, given as a comma separated list of paths:
+#   DATABASE_REPLICAS=/var/lib/doctors/replica1.sqlite3,/var/lib/doctors/replica2.sqlite3
+#   Pointing one to db.sqlite3 is a local stand-in for testing.
+#   The views decorated with read_from_replica read from them (see doctors/routers.py)
+DATABASE_REPLICAS = []
+for index, path in enumerate(filter(None, os.getenv('DATABASE_REPLICAS', '').split(','))):
+    alias = f'replica{index + 1}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        # read-only connection
+        'NAME': f'file:{path}?mode=ro',
+        # the journal mode is set by the primary and cannot be set read-only
+        'SQLITE_PRAGMAS': {
+            name: value for name, value in SQLITE_PRAGMAS.items()
+            if name not in ('journal_mode', 'synchronous')},
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['doctors.routers.ReplicaRouter']
+# seconds users read from the primary after booking or cancelling, so that
+#   they see their change even if the replicas lag behind
+REPLICA_PIN_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -141,6 +212,13 @@ LOGIN_URL = reverse_lazy('doctors:login')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'images')
 MEDIA_URL = '/images/'
 
+# Responses of the search and time_availabilities API endpoints are cached 
+#   in memory by each process (see doctors/cache.py). Set RESULT_CACHE to the
+#   alias of one of the CACHES to share them between processes instead
+RESULT_CACHE = None
+# e.g. {'search': {'MAXSIZE': 2048, 'TTL': 60}, 'time_slots': {'MAXSIZE': 10000, 'TTL': 30}}
+RESULT_CACHE_OPTIONS = {}
+
 # See the SQL queries that django is executing
 # LOGGING = {
 #       'version': 1,
@@ -17,9 +17,12 @@ from django.contrib import admin
 from django.urls import include, path
 
 from django.conf import settings
-from django.conf.urls.static import static
+
+from doctors.views import media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("", include("doctors.urls")),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    # user pictures, served with caching headers
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", media, name="media"),
+]
@@ -0,0 +1,124 @@
+# Contention benchmark of the booking path:
+#   several threads, each with its own database connection, try to book the
+#   time slots of a single doctor at the same time. Reports the throughput
+#   and checks that no slot was booked twice and that the busy slots masks
+#   match the appointments.
+# Test users are created at the start and deleted at the end.
+#
+# Usage:
+#   python manage.py runscript bench_booking --script-args threads=8 attempts=50 days=5
+
+from django.db import connection
+from django.db.models import Count
+
+from doctors.models import Specialty, User, Appointment, BusySlots, SlotTaken
+from doctors.helpers import next_weekdays
+from doctors.schedules import DEFAULT_TIME_SLOTS
+
+import datetime
+import random
+import threading
+import time
+
+USERNAME_PREFIX = 'bench_booking_'
+
+
+def parse_args(args):
+    options = {'threads': 8, 'attempts': 50, 'days': 5, 'seed': 0}
+    for arg in args:
+        name, value = arg.split('=')
+        options[name] = int(value)
+    return options
+
+
+def create_users(num_patients):
+    specialty, _ = Specialty.objects.get_or_create(name='Benchmark')
+    doctor = User.objects.create(
+        username=f'{USERNAME_PREFIX}doctor', email=f'{USERNAME_PREFIX}doctor@bench.org',
+        first_name='bench', last_name='doctor', is_doctor=True, specialty=specialty)
+    patients = [
+        User.objects.create(
+            username=f'{USERNAME_PREFIX}{i}', email=f'{USERNAME_PREFIX}{i}@bench.org',
+            first_name='bench', last_name=f'patient {i}')
+        for i in range(num_patients)]
+    return doctor, patients
+
+
+def delete_users():
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+    Specialty.objects.filter(name='Benchmark').delete()
+
+
+def booker(doctor, patient, slots, attempts, seed, results):
+    rng = random.Random(seed)
+    booked = conflicts = errors = 0
+    try:
+        for _ in range(attempts):
+            date, slot_time = rng.choice(slots)
+            try:
+                doctor.book(patient, date, slot_time)
+                booked += 1
+            except SlotTaken:
+                conflicts += 1
+            except Exception as e:
+                # e.g. database is locked
+                errors += 1
+                print(f"  {patient.username}: {e}")
+    finally:
+        connection.close()
+    results.append((booked, conflicts, errors))
+
+
+def check_correctness(doctor):
+    problems = []
+    appointments = Appointment.objects.filter(doctor=doctor)
+    doubles = appointments.values('date', 'time').annotate(n=Count('id')).filter(n__gt=1)
+    if doubles.exists():
+        problems.append(f"{doubles.count()} slots booked more than once")
+    masks = dict(doctor.busy_slots.values_list('date', 'mask'))
+    expected = {}
+    for date, slot_time in appointments.values_list('date', 'time'):
+        expected[date] = expected.get(date, 0) | Appointment.TIME_SLOT_BITS[slot_time]
+    for date in masks.keys() | expected.keys():
+        if masks.get(date, 0) != expected.get(date, 0):
+            problems.append(f"busy slots mask of {date} does not match the appointments")
+    return problems
+
+
+def run(*args):
+    options = parse_args(args)
+    delete_users()
+    doctor, patients = create_users(options['threads'])
+    dates = next_weekdays(datetime.date.today(), options['days'])
+    # the benchmark doctor works the default schedule
+    slots = [(date, slot_time) for date in dates for slot_time in DEFAULT_TIME_SLOTS]
+    # each thread needs its own database connection
+    connection.close()
+
+    results = []
+    threads = [
+        threading.Thread(target=booker, args=(
+            doctor, patient, slots, options['attempts'], options['seed'] + i, results))
+        for i, patient in enumerate(patients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    booked = sum(result[0] for result in results)
+    conflicts = sum(result[1] for result in results)
+    errors = sum(result[2] for result in results)
+    attempts = booked + conflicts + errors
+    problems = check_correctness(doctor)
+    delete_users()
+
+    print(f"{options['threads']} threads, {attempts} booking attempts on {len(slots)} slots in {elapsed:.2f}s")
+    print(f"  throughput: {attempts / elapsed:.1f} attempts/s")
+    print(f"  booked: {booked}, conflicts: {conflicts}, errors: {errors}")
+    if problems:
+        for problem in problems:
+            print(f"  PROBLEM: {problem}")
+    else:
+        print("  correctness: no slot was booked twice, busy slots match the appointments")
@@ -0,0 +1,172 @@
+# Load comparison of the WSGI and ASGI deployments of the API endpoints:
+#   starts gunicorn with wsgi.py (synchronous views in worker threads) and
+#   uvicorn with asgi.py (async views on the event loop), then sends the same
+#   mix of time slots and search requests to each from concurrent clients
+#   logged in as a benchmark patient. Reports the throughput and the p50/p95/p99
+#   latency as JSON, e.g. to benchmarks/wsgi_vs_asgi.json.
+# Needs gunicorn and uvicorn, which are not requirements of the application:
+#   pip install gunicorn uvicorn
+# The benchmark patient is created at the start and deleted at the end.
+#
+# Usage:
+#   python manage.py runscript bench_servers --script-args concurrency=32 requests=2000 threads=8 output=benchmarks/wsgi_vs_asgi.json
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.urls import reverse
+
+from doctors.models import User
+from doctors.helpers import next_weekdays
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+USERNAME = 'bench_servers_patient'
+PORT = 8765
+SEARCH_TERMS = ['dent', 'derm', 'cardio', 'smith', 'anderson', 'general', 'jane', 'psy']
+
+SERVERS = {
+    # the synchronous views, one request per thread
+    'wsgi': lambda options: [
+        sys.executable, '-m', 'gunicorn', 'doctors_project.wsgi:application',
+        '--bind', f'127.0.0.1:{PORT}', '--workers', str(options['workers']),
+        '--threads', str(options['threads']), '--log-level', 'warning'],
+    # the async views, see doctors/urls.py
+    'asgi': lambda options: [
+        sys.executable, '-m', 'uvicorn', 'doctors_project.asgi:application',
+        '--port', str(PORT), '--workers', str(options['workers']), '--log-level', 'warning'],
+}
+
+
+def parse_args(args):
+    options = {
+        'concurrency': 32, 'requests': 2000, 'workers': 1, 'threads': 8,
+        'days': 20, 'seed': 0, 'output': None}
+    for arg in args:
+        name, value = arg.split('=')
+        options[name] = value if name == 'output' else int(value)
+    return options
+
+
+def create_session():
+    User.objects.filter(username=USERNAME).delete()
+    patient = User.objects.create_user(
+        username=USERNAME, email=f'{USERNAME}@bench.org', first_name='bench', last_name='patient')
+    session = SessionStore()
+    session[SESSION_KEY] = str(patient.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = patient.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def make_paths(options):
+    '''
+    The same requests, in the same order, for both servers
+    '''
+    rng = random.Random(options['seed'])
+    doctor_ids = list(User.objects.filter(is_doctor=True).values_list('id', flat=True))
+    dates = next_weekdays(datetime.date.today(), options['days'])
+    paths = []
+    for _ in range(options['requests']):
+        if rng.random() < 0.8:
+            date = rng.choice(dates).strftime('%Y%m%d')
+            paths.append(f"{reverse('doctors:time-slots')}?doctor_id={rng.choice(doctor_ids)}&date={date}")
+        else:
+            paths.append(f"{reverse('doctors:search')}?search_term={rng.choice(SEARCH_TERMS)}")
+    return paths
+
+
+def wait_until_up(process):
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError('the server did not start')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{PORT}/search/?search_term=a', timeout=1)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError('the server did not start')
+
+
+def fetch(path, cookie):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{PORT}{path}', headers={'Cookie': cookie})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    return time.perf_counter() - start, status
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def load(name, options, paths, cookie):
+    env = {**os.environ, 'ASYNC_VIEWS': '1' if name == 'asgi' else '0'}
+    process = subprocess.Popen(SERVERS[name](options), cwd=settings.BASE_DIR, env=env)
+    try:
+        wait_until_up(process)
+        # warm up the connections and the caches of the server
+        for path in paths[:50]:
+            fetch(path, cookie)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(lambda path: fetch(path, cookie), paths))
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = sorted(latency for latency, status in results if status == 200)
+    errors = len(results) - len(latencies)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run(*args):
+    options = parse_args(args)
+    session_key = create_session()
+    cookie = f'{settings.SESSION_COOKIE_NAME}={session_key}'
+    paths = make_paths(options)
+    # the servers open their own connections
+    connection.close()
+    try:
+        servers = {name: load(name, options, paths, cookie) for name in SERVERS}
+    finally:
+        User.objects.filter(username=USERNAME).delete()
+        SessionStore(session_key).delete()
+
+    report = {
+        'date': datetime.date.today().isoformat(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'options': {name: value for name, value in options.items() if name != 'output'},
+        'servers': servers,
+    }
+    output = json.dumps(report, indent=2)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(output + '\n')
+    print(output)
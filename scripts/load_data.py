@@ -6,8 +6,12 @@
 # Usage:
 #   python manage.py runscript load_data
 
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+
 from doctors.models import Specialty, User, Appointment
 from doctors.helpers import next_weekday
+from doctors.importer import Importer, PREHASHED
 import datetime
 
 EASY_PASSWORD = 'w'
@@ -64,31 +68,36 @@ def run():
     User.objects.all().delete()
     Appointment.objects.all().delete()
 
+    # all the users share the same password, hashed once
+    importer = Importer(passwords=PREHASHED)
+    password = make_password(EASY_PASSWORD)
+
     # add specialties (after clearing any previous ones)
-    for specialty in specialties:
-        Specialty.objects.create(name=specialty)
+    importer.specialties({'name': name} for name in specialties)
+
+    # add doctors
+    importer.doctors(
+        {'username': username, 'first_name': first_name, 'last_name': last_name,
+         'email': email, 'specialty': specialty, 'description': description,
+         'picture': picture, 'password': password}
+        for username, first_name, last_name, email, specialty, description, picture in doctors)
 
-    # add doctors    
-    for username, first_name, last_name, email, specialty, description, picture in doctors:
-        specialty = Specialty.objects.get(name=specialty)
-        User.objects.create_user(
-            username=username, email=email, password=EASY_PASSWORD,
-            first_name=first_name, last_name=last_name, is_doctor=True,
-            specialty=specialty, description=description, picture=picture)
-        
     # add patients
-    for username, first_name, last_name, email, picture in patients:
-        User.objects.create_user(
-            first_name=first_name, last_name=last_name, username=username, 
-            email=email, password=EASY_PASSWORD, picture=picture)
+    importer.patients(
+        {'username': username, 'first_name': first_name, 'last_name': last_name,
+         'email': email, 'picture': picture, 'password': password}
+        for username, first_name, last_name, email, picture in patients)
 
     # book appointments
-    for patient_username, doctor_username, date, time in appointments:
-        patient = User.objects.get(username=patient_username)
-        doctor = User.objects.get(username=doctor_username)
-        doctor.book(patient, date, time)
+    importer.appointments(
+        {'patient': patient_username, 'doctor': doctor_username,
+         'date': date.isoformat(), 'time': time.strftime('%H:%M')}
+        for patient_username, doctor_username, date, time in appointments)
+    # content-addressed and resized pictures of the users
+    call_command('pictures')
+    call_command('thumbnails')
 
     print(f"Done loading initial data into the database:")
     print(f"  Added {len(specialties)} specialties, {len(doctors)} doctors, {len(patients)} patients, and {len(appointments)} appointments")
     print(f"You need to create a superuser account. Execute:")
-    print(f"  python manage.py createsuperuser")
\ No newline at end of file
+    print(f"  python manage.py createsuperuser")